@@ -0,0 +1,290 @@
+from collections import Counter
+import threading
+import tempfile
+import asyncio
+import hashlib
+import time
+import io
+import os
+import re
+
+from aiohttp import web
+import aiohttp
+
+from defs import *
+
+# optional; without it, images are only checked and stored as uploaded
+try:
+    from PIL import Image, ImageSequence
+except ImportError:
+    Image = None
+
+
+IMAGE_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"\xff\xd8\xff": "image/jpeg",
+    b"GIF87a": "image/gif",
+    b"GIF89a": "image/gif",
+}
+
+
+# enough to tell all of the above apart
+SNIFF_SIZE = 12
+CHUNK_SIZE = 64 * 1024
+
+
+# don't trust the content type that discord gives us, it's from the uploader
+def sniff_image(data):
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for sig, mime in IMAGE_SIGNATURES.items():
+        if data.startswith(sig):
+            return mime
+
+
+def shrink(frame):
+    frame = frame.convert("RGBA")
+    frame.thumbnail((AVATAR_SIZE, AVATAR_SIZE))
+    return frame
+
+
+# legacy names are prefixed with the id of the mask that uploaded them
+AVATAR_NAME_REGEX = re.compile(r"(?:[a-z]{5}_)?([0-9a-f]{40})\.(png|jpeg|gif|webp)")
+# names are content hashes, so a file at a given url never changes
+AVATAR_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+
+class AvatarResponse(web.FileResponse):
+    def __init__(self, path, sha):
+        super().__init__(path, headers=AVATAR_HEADERS)
+        self.sha = sha
+
+
+# FileResponse sets its own (mtime-based) etag when it's prepared, replace it
+async def set_avatar_etag(request, response):
+    if isinstance(response, AvatarResponse):
+        response.etag = response.sha
+
+
+# runs in the avatar pool. returns (image, ext), or None if pillow can't read it
+def transcode_avatar(path):
+    out = io.BytesIO()
+    try:
+        with Image.open(path) as im:
+            # header only so far; check before decoding anything
+            if im.width * im.height > AVATAR_MAX_PIXELS:
+                return None
+            if getattr(im, "is_animated", False):
+                # counting only reads the frame headers
+                frames = im.n_frames
+                if (
+                    frames > AVATAR_MAX_FRAMES
+                    or frames * im.width * im.height > AVATAR_MAX_TOTAL_PIXELS
+                ):
+                    return None
+                im.seek(0)
+                frames = [
+                    (shrink(frame), frame.info.get("duration", 100))
+                    for frame in ImageSequence.Iterator(im)
+                ]
+                frames[0][0].save(
+                    out,
+                    "WEBP",
+                    save_all=True,
+                    append_images=[frame for frame, _ in frames[1:]],
+                    duration=[duration for _, duration in frames],
+                    loop=0,
+                    quality=AVATAR_QUALITY,
+                )
+            else:
+                shrink(im).save(out, "WEBP", quality=AVATAR_QUALITY)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return None
+    return (out.getvalue(), "webp")
+
+
+# hosted avatars are stored by content, so masks with the same image share a file
+# masks.avatar holds the file name; the avatars table counts references to it
+class GestaltAvatars:
+    def is_hosted_avatar(self, url):
+        return bool(url) and not LINK_REGEX.fullmatch(url)
+
+    def hosted_avatar_local_path(self, avatar):
+        return os.path.join(AVATAR_DIRECTORY, avatar)
+
+    def hosted_avatar_fix(self, url):
+        return AVATAR_URL_BASE + url if self.is_hosted_avatar(url) else url
+
+    def temp_avatar(self):
+        # not a valid avatar name, and collected by reconcile if left behind
+        return tempfile.mkstemp(dir=AVATAR_DIRECTORY, prefix=".", suffix=".part")
+
+    # renamed into place, so a half-written file never appears under a real name
+    def place_avatar(self, temp, name):
+        path = self.hosted_avatar_local_path(name)
+        with self.avatar_files_lock:
+            if os.path.exists(path):
+                # already stored for another mask. touch it so gc doesn't race us
+                os.utime(path)
+                os.remove(temp)
+            else:
+                os.replace(temp, path)
+
+    # over the original download, which isn't needed anymore
+    def write_avatar(self, temp, image, ext):
+        # hashlib and i/o release GIL
+        with open(temp, "wb") as f:
+            f.write(image)
+        return "%s.%s" % (hashlib.sha1(image).hexdigest(), ext)
+
+    # returns (sha1, ext) of what was written, or None if it was rejected
+    async def stream_avatar(self, url, f):
+        limit = AVATAR_MAX_SIZE_MB * 1024 * 1024
+        sha = hashlib.sha1()
+        (head, size) = (b"", 0)
+        async with self.session.get(url) as r:
+            if r.status != 200 or (r.content_length or 0) > limit:
+                return None
+            async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+                # the header could be lying, or missing
+                if (size := size + len(chunk)) > limit:
+                    return None
+                if len(head) < SNIFF_SIZE:
+                    head += chunk[:SNIFF_SIZE]
+                    if len(head) >= SNIFF_SIZE and not sniff_image(head):
+                        return None
+                sha.update(chunk)
+                # small writes to the page cache, not worth a thread each
+                f.write(chunk)
+        if (mime := sniff_image(head)) not in VALID_MIME_TYPES:
+            return None
+        return (sha.hexdigest(), mime.removeprefix("image/"))
+
+    # streamed to disk so that a huge response can't balloon memory use
+    # returns the stored file name, or None if it isn't a usable image
+    async def download_avatar(self, url):
+        (fd, temp) = self.temp_avatar()
+        name = None
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if not (streamed := await self.stream_avatar(url, f)):
+                    return None
+            if Image:
+                if not (
+                    converted := await asyncio.get_running_loop().run_in_executor(
+                        self.avatar_pool, transcode_avatar, temp
+                    )
+                ):
+                    return None
+                name = await asyncio.to_thread(self.write_avatar, temp, *converted)
+            else:
+                name = "%s.%s" % streamed
+            # the file might be another mask's, which could let go of it meanwhile
+            self.storing_avatars[name] += 1
+            await asyncio.to_thread(self.place_avatar, temp, name)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        finally:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+            # nothing awaits between here and the mask being updated
+            if name in self.storing_avatars:
+                self.storing_avatars -= Counter({name: 1})
+        # the reference itself is counted by trigger when masks.avatar is set
+        self.execute("insert or ignore into avatars values (?, 0)", (name,))
+        return name
+
+    def release_avatar(self, avatar):
+        # being stored for some other mask right now, see download_avatar()
+        if not self.is_hosted_avatar(avatar) or self.storing_avatars[avatar]:
+            return
+        if self.fetchone(
+            "select 1 from avatars where avatar = ? and refs > 0", (avatar,)
+        ):
+            return
+        self.execute("delete from avatars where avatar = ?", (avatar,))
+        try:
+            os.remove(self.hosted_avatar_local_path(avatar))
+        except FileNotFoundError:
+            pass
+
+    def list_old_avatars(self):
+        cutoff = time.time() - AVATAR_GC_GRACE
+        with os.scandir(AVATAR_DIRECTORY) as it:
+            return [
+                entry.name
+                for entry in it
+                if entry.is_file() and entry.stat().st_mtime < cutoff
+            ]
+
+    # files left behind by crashes, failed writes, or masks deleted some other way
+    async def reconcile_avatars(self):
+        self.execute("delete from avatars where refs <= 0")
+        candidates = await asyncio.to_thread(self.list_old_avatars)
+        for i in range(0, len(candidates), AVATAR_GC_BATCH):
+            # recheck every batch; masks may have changed while we were away
+            used = {
+                row[0]
+                for row in self.fetchall(
+                    "select avatar from masks where avatar not null"
+                )
+            }
+            batch = [
+                name
+                for name in candidates[i : i + AVATAR_GC_BATCH]
+                if name not in used and not self.storing_avatars[name]
+            ]
+            if removed := await asyncio.to_thread(self.remove_avatars, batch):
+                self.log("Removed %i orphaned avatar(s).", removed)
+
+    # returns how many were removed. any of them could have been reused meanwhile
+    # (place_avatar() touches them), so that's checked again under the same lock
+    def remove_avatars(self, names):
+        cutoff = time.time() - AVATAR_GC_GRACE
+        removed = 0
+        for name in names:
+            path = self.hosted_avatar_local_path(name)
+            with self.avatar_files_lock:
+                try:
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def make_avatar_app(self):
+        app = web.Application()
+        app.router.add_get("/{name}", self.serve_avatar)
+        app.on_response_prepare.append(set_avatar_etag)
+        return app
+
+    async def start_avatar_server(self):
+        self.avatar_runner = web.AppRunner(self.make_avatar_app(), access_log=None)
+        await self.avatar_runner.setup()
+        await web.TCPSite(
+            self.avatar_runner, AVATAR_SERVER_HOST, AVATAR_SERVER_PORT
+        ).start()
+        self.log("Serving avatars on %s:%i", AVATAR_SERVER_HOST, AVATAR_SERVER_PORT)
+
+    async def serve_avatar(self, request):
+        self.stats["avatar requests"] += 1
+        name = request.match_info["name"]
+        match = AVATAR_NAME_REGEX.fullmatch(name)
+        path = self.hosted_avatar_local_path(name)
+        if not (match and os.path.isfile(path)):
+            self.stats["avatar 404"] += 1
+            raise web.HTTPNotFound()
+        if request.if_none_match and any(
+            etag.value in (match[1], "*") for etag in request.if_none_match
+        ):
+            self.stats["avatar 304"] += 1
+            response = web.Response(status=304, headers=AVATAR_HEADERS)
+            response.etag = match[1]
+            return response
+        self.stats["avatar 200"] += 1
+        self.stats["avatar bytes"] += os.path.getsize(path)
+        # uses sendfile() where the platform has it
+        return AvatarResponse(path, match[1])
@@ -0,0 +1,63 @@
+from collections import namedtuple
+import asyncio
+import time
+
+from defs import *
+
+
+# a data migration too big to do in one statement without stalling the bot
+# step is run with the (first, last) rowids of each chunk of table, in order
+# cutover is run once afterwards, e.g. to add constraints or drop old columns
+# anything written while it runs must already be in the new form
+# (so, code or triggers need to be updated in the same release.)
+Backfill = namedtuple("Backfill", ["table", "step", "cutover"], defaults=[()])
+
+# a migration schedules one with "insert into backfills values ('name', 0, 0)"
+BACKFILLS = {
+    # schema/28.sql. text ids are kept if there's nothing to replace them with
+    "history_keys": Backfill(
+        "history",
+        "update history set "
+        "proxkey = (select proxkey from proxies where proxies.proxid = history.proxid),"
+        "maskkey = (select maskkey from masks where masks.maskid = history.maskid),"
+        "proxid = iif("
+        "exists(select 1 from proxies where proxies.proxid = history.proxid),"
+        "NULL, proxid),"
+        "maskid = iif("
+        "exists(select 1 from masks where masks.maskid = history.maskid),"
+        "NULL, maskid) "
+        "where msgid between ? and ? and (proxid not null or maskid not null)",
+    ),
+}
+
+
+class GestaltBackfill:
+    async def run_backfills(self):
+        for row in self.fetchall("select * from backfills where not done"):
+            if not (job := BACKFILLS.get(row["name"])):
+                # retired, or from a newer version. the rest can still run
+                self.log("Backfill %s: unknown, skipping.", row["name"])
+                continue
+            # progress is committed along with the chunk itself, so can resume
+            position = row["position"]
+            self.log("Backfill %s: starting at rowid %i.", row["name"], position)
+            start = time.perf_counter()
+            # rowids can be snowflakes, so go by count, not by range
+            while last := self.fetchone(
+                "select max(rowid) from (select rowid from %s where rowid > ? "
+                "order by rowid limit ?)" % job.table,
+                (position, BACKFILL_CHUNK),
+            )[0]:
+                self.execute(job.step, (position + 1, last))
+                position = last
+                self.execute(
+                    "update backfills set position = ? where name = ?",
+                    (position, row["name"]),
+                )
+                await asyncio.sleep(BACKFILL_DELAY)
+            for statement in job.cutover:
+                self.execute(statement)
+            self.execute("update backfills set done = 1 where name = ?", (row["name"],))
+            self.log(
+                "Backfill %s: done in %.3fs.", row["name"], time.perf_counter() - start
+            )
@@ -1,9 +1,9 @@
-from functools import cache
+from collections import namedtuple
+import bisect
 import json
 import time
 import asyncio
 from datetime import datetime
-import os
 import re
 
 import aiohttp
@@ -25,6 +25,13 @@ def parse_tags(tags):
     return split
 
 
+def check_name_length(name):
+    if len(name) > MAX_WEBHOOK_NAME_LENGTH:
+        raise UserError(
+            f"That name is too long ({len(name)}>{MAX_WEBHOOK_NAME_LENGTH})."
+        )
+
+
 def unparse_tags(prefix, postfix):
     return "`%s`" % (
         f"`{prefix}text{postfix}`".replace("``", "`\N{ZWNBSP}`").replace(
@@ -33,6 +40,12 @@ def unparse_tags(prefix, postfix):
     )
 
 
+WORD_REGEX = re.compile(r"\S+")
+NEWLINE_REGEX = re.compile("\n")
+
+
+# the message is split into words once, and reads move through it by offset
+# so a long command isn't copied or rescanned for every little thing read from it
 class CommandReader:
     BOOL_KEYWORDS = {
         "on": 1,
@@ -52,48 +65,108 @@ class CommandReader:
 
     def __init__(self, message, command=None):
         self.msg = message
-        self.cmd = command or message.content
+        self.lex(message.content if command is None else command)
+
+    def lex(self, text):
+        self.text = text
+        spans = [m.span() for m in WORD_REGEX.finditer(text)]
+        (self.starts, self.ends) = (
+            [start for start, _ in spans],
+            [end for _, end in spans],
+        )
+        (self.pos, self.end) = (0, len(text))
+        # reads that strip the end too (quotes, links) go up to here
+        self.stripped = self.ends[-1] if spans else 0
+        self.newlines = [m.start() for m in NEWLINE_REGEX.finditer(text)]
+
+    # what's left to read. only copied when someone asks for it
+    @property
+    def cmd(self):
+        return self.text[self.pos : self.end]
+
+    @cmd.setter
+    def cmd(self, value):
+        self.lex(value)
+
+    # for going back after looking ahead
+    def tell(self):
+        return (self.pos, self.end)
+
+    def seek(self, state):
+        (self.pos, self.end) = state
+
+    # start of the next word at or after pos, or the end if there isn't one
+    def skip(self, pos):
+        i = bisect.bisect_right(self.ends, pos)
+        return max(self.starts[i], pos) if i < len(self.starts) else len(self.text)
 
     def is_empty(self):
-        return self.cmd == ""
+        return self.pos >= self.end
 
-    @staticmethod
-    @cache
-    def get_token_regex(token):
-        return re.compile(re.escape(token) + r"\s*(.*)", re.DOTALL | re.IGNORECASE)
+    # between pos and what's left to read
+    def any_newline(self, pos):
+        i = bisect.bisect_left(self.newlines, pos)
+        return i < len(self.newlines) and self.newlines[i] < self.end
 
     def read_token(self, token):
-        if match := self.get_token_regex(token).fullmatch(self.cmd):
-            self.cmd = match[1]
-        return bool(match)
+        end = self.pos + len(token)
+        if match := self.text[self.pos : end].lower() == token.lower():
+            self.pos = self.skip(end)
+        return match
 
     def read_clear(self):
         if self.read_token("-clear"):
             return CLEAR
 
     def read_word(self):
-        # add empty strings to pad array if string empty or no split
-        split = self.cmd.split(maxsplit=1) + ["", ""]
-        self.cmd = split[1]
-        return split[0]
+        i = bisect.bisect_right(self.ends, self.pos)
+        if i == len(self.ends) or self.is_empty():
+            self.pos = len(self.text)
+            return ""
+        # may start partway into a word, e.g. right after a quote or link
+        word = self.text[max(self.starts[i], self.pos) : self.ends[i]]
+        self.pos = self.skip(self.ends[i])
+        return word
+
+    def read_keyword(self):
+        return self.read_word().lower()
+
+    def read_all(self):
+        return self.read_token("-all")
+
+    # everything left, as is
+    def read_raw(self):
+        (ret, self.pos) = (self.cmd, len(self.text))
+        return ret
 
     def try_read_quote(self):
-        if not self.is_empty() and (regex := QUOTE_REGEXES.get(self.cmd[0])):
-            if match := regex.fullmatch(self.cmd):
-                self.cmd = match.group(2).strip()
+        if not self.is_empty() and (regex := QUOTE_REGEXES.get(self.text[self.pos])):
+            # whatever follows has to be on the same line
+            if (match := regex.match(self.text, self.pos, self.end)) and not (
+                self.any_newline(match.end())
+            ):
+                (self.pos, self.end) = (self.skip(match.end()), self.stripped)
                 return match.group(1)
 
     def read_quote(self):
         return self.try_read_quote() or self.read_word()
 
+    # <a|b> in a command path, see CommandNode
+    def read_any(self, types):
+        for name in types.split("|"):
+            if name in LOOKUPS:
+                return None if name == "account" else self.read_quote()
+            if value := getattr(self, "read_" + name)():
+                return value
+        return value
+
     def read_bool_int(self):
         return self.BOOL_KEYWORDS.get(self.read_word().lower())
 
     def read_remainder(self):
         if quote := self.try_read_quote():
             return quote
-        (ret, self.cmd) = (self.cmd, "")
-        return ret
+        return self.read_raw()
 
     # discord.ext includes a MemberConverter
     # but that's only available whem using discord.ext Command
@@ -111,8 +184,8 @@ class CommandReader:
                 return chan
 
     def read_link(self):
-        if m := LINK_REGEX.match(self.cmd):
-            self.cmd = self.cmd.removeprefix(m[0]).strip()
+        if m := LINK_REGEX.match(self.text, self.pos, self.end):
+            (self.pos, self.end) = (self.skip(m.end()), self.stripped)
             return m[1]  # excluding <...> if present
 
     def read_message(self, bot):
@@ -120,14 +193,14 @@ class CommandReader:
             if ref.cached_message:
                 return ref.cached_message
             msgid, chanid = ref.message_id, ref.channel_id
-            cmd = self.cmd
-        elif m := MESSAGE_LINK_REGEX.match(self.cmd):
+            after = self.tell()
+        elif m := MESSAGE_LINK_REGEX.match(self.text, self.pos, self.end):
             msgid, chanid = int(m[2]), int(m[1])
-            cmd = self.cmd.removeprefix(m[0]).strip()
+            after = (self.skip(m.end()), self.stripped)
         else:
             return None
         if chan := bot.get_channel(chanid):
-            self.cmd = cmd
+            self.seek(after)
             return discord.PartialMessage(channel=chan, id=msgid)
         return None
 
@@ -139,6 +212,179 @@ class CommandReader:
             pass
 
 
+# what a command needs before it's run, checked in this order (see do_command())
+# None means to quietly do nothing. member is checked after the mask is looked up
+GUARDS = {
+    "user": "Please use `gs;consent` to begin.",
+    "guild": ERROR_DM,
+    "administrator": "You need `Manage Server` permissions to do that.",
+    "manage_channels": "You need `Manage Channels` permissions to do that.",
+    "admin": None,
+    "member": "Only members of the mask can do that.",
+}
+# for commands that are known, but not what comes after them
+ERROR_ACTION = "Unknown action. See `{p}help` for what can be done.".format(
+    p=COMMAND_PREFIX
+)
+# these need the database, so they're only looked up once everything else is ok
+# account is the user's row, which was already fetched and reads nothing
+LOOKUPS = ("proxy", "mask", "account")
+
+
+Command = namedtuple("Command", "name handler guards args")
+
+
+# words of commands, see COMMANDS
+class CommandNode:
+    def __init__(self):
+        self.words = {}  # word: (node, whether the word is passed to the handler)
+        self.slot = None  # (types, node)
+        self.command = None
+        self.guards = None  # the ones every command past here has
+
+    # narrows guards down to the ones every command past here has
+    def share(self, guards):
+        if self.guards is not None:
+            guards = tuple(guard for guard in self.guards if guard in guards)
+        self.guards = tuple(guards)
+
+    # path segments are:
+    # a|b: literal word, with aliases
+    # {a|b}: same, but the word is passed to the handler
+    # <a|b>: argument read by CommandReader.read_a() or else .read_b()
+    # (proxy and mask read a name, then are looked up)
+    @classmethod
+    def build(cls, commands):
+        root = cls()
+        for path, guards, handler in commands:
+            (node, args) = (root, [])
+            for seg in path.split():
+                node.share(guards)
+                if seg[0] == "<":
+                    args.append(seg[1:-1])
+                    if seg == "<account>":
+                        continue
+                    node.slot = node.slot or (seg[1:-1], cls())
+                    # one kind of argument per spot, or it'd be ambiguous
+                    assert node.slot[0] == seg[1:-1], path
+                    node = node.slot[1]
+                else:
+                    captured = seg[0] == "{"
+                    words = seg.strip("{}").split("|")
+                    if captured:
+                        args.append("word")
+                    child = node.words.get(words[0], (cls(),))[0]
+                    node.words |= {word: (child, captured) for word in words}
+                    node = child
+            node.share(guards)
+            node.command = Command(
+                handler.split("_", 1)[1].replace("_", " "), handler, guards, args
+            )
+        return root
+
+    # returns (command, [raw args]), (None, guards) if it only got partway
+    # or None if it isn't a command at all
+    def find(self, reader):
+        (node, raw) = (self, [])
+        while True:
+            rest = reader.tell()
+            word = reader.read_word().lower()
+            if word in node.words:
+                (node, captured) = node.words[word]
+                if captured:
+                    raw.append(word)
+                continue
+            reader.seek(rest)
+            if node.slot and not (word == "" and node.command):
+                (types, node) = node.slot
+                raw.append(reader.read_any(types))
+                continue
+            # an unknown subcommand isn't this command
+            if node.command and (word == "" or not node.words):
+                return (node.command, raw)
+            return None if node is self else (None, node.guards)
+
+
+# (path, guards, handler)
+COMMANDS = [
+    # info and server management commands are always available
+    ("help <keyword>", (), "cmd_help"),
+    ("explain", (), "cmd_explain"),
+    ("invite", (), "cmd_invite"),
+    ("permcheck <word>", (), "run_permcheck"),
+    ("log channel <channel>", ("guild", "administrator"), "run_log_channel"),
+    ("log disable", ("guild", "administrator"), "cmd_log_disable"),
+    (
+        "channel <channel> mode <word>",
+        ("guild", "manage_channels"),
+        "run_channel_mode",
+    ),
+    ("consent <account>", (), "cmd_consent"),
+    # ... these are not
+    ("proxy|p", ("user",), "cmd_proxy_list"),
+    ("proxy|p list <all>", ("user",), "cmd_proxy_list"),
+    ("proxy|p <proxy>", ("user",), "cmd_proxy_view"),
+    ("proxy|p <proxy> tags <clear|remainder>", ("user",), "run_proxy_tags"),
+    # removed command
+    ("proxy|p <proxy> auto", ("user",), "run_proxy_auto"),
+    ("proxy|p <proxy> rename <remainder>", ("user",), "run_proxy_rename"),
+    (
+        "proxy|p <proxy> {%s} <bool_int>" % "|".join(ProxyFlags.__members__),
+        ("user",),
+        "run_proxy_flag",
+    ),
+    ("autoproxy|ap <remainder>", ("user", "guild"), "run_autoproxy"),
+    ("account|a config <account>", ("user",), "cmd_config_list"),
+    ("account|a config default|defaults", ("user",), "cmd_config_default"),
+    ("account|a config <word>", ("user",), "run_config_unknown"),
+    (
+        "account|a config <account> {%s} <bool_int>" % "|".join(Prefs.__members__),
+        ("user",),
+        "run_config_update",
+    ),
+    ("account|a color|colour <clear|color>", ("user",), "run_account_color"),
+    ("swap|s open <member> <remainder>", ("user", "guild"), "run_swap_open"),
+    ("swap|s close|off <proxy>", ("user",), "run_swap_close"),
+    ("mask|m new <remainder>", ("user",), "run_mask_new"),
+    ("mask|m <mask>", ("user",), "cmd_mask_view"),
+    ("mask|m <mask> join", ("user",), "run_mask_join"),
+    (
+        "mask|m <mask> invite <member>",
+        ("user", "guild", "member"),
+        "run_mask_invite",
+    ),
+    (
+        "mask|m <mask> remove <member>",
+        ("user", "guild", "member"),
+        "run_mask_remove",
+    ),
+    ("mask|m <mask> add <word>", ("user", "member"), "run_mask_add"),
+    ("mask|m <mask> nick|name <remainder>", ("user", "member"), "run_mask_nick"),
+    ("mask|m <mask> avatar <clear|link>", ("user", "member"), "run_mask_avatar"),
+    (
+        "mask|m <mask> color|colour <clear|color>",
+        ("user", "member"),
+        "run_mask_color",
+    ),
+    ("mask|m <mask> rules <remainder>", ("user", "member"), "run_mask_rules"),
+    (
+        "mask|m <mask> nominate <member>",
+        ("user", "guild", "member"),
+        "run_mask_nominate",
+    ),
+    # checks membership itself, see run_mask_leave()
+    ("mask|m <mask> leave <member>", ("user",), "run_mask_leave"),
+    ("edit|e <raw>", ("user",), "run_edit"),
+    ("become|bc <proxy>", ("user",), "run_become"),
+    ("pluralkit|pk swap <member> <word>", ("user",), "run_pk_swap"),
+    ("pluralkit|pk close <proxy>", ("user",), "run_pk_close"),
+    ("pluralkit|pk sync", ("user", "guild"), "run_pk_sync"),
+    ("motd <remainder>", ("user", "admin"), "run_motd"),
+    ("stats", ("user", "admin"), "cmd_stats"),
+]
+COMMAND_TREE = CommandNode.build(COMMANDS)
+
+
 class GestaltCommands:
     def get_user_proxy(self, message, name):
         if name == "":
@@ -146,10 +392,11 @@ class GestaltCommands:
 
         # can't do 'and ? in (proxid, cmdname)'; breaks case insensitivity
         proxies = self.fetchall(
-            "select proxies.*, guildmasks.guildid from proxies "
+            "select proxies.*, guildmasks.guildid, maskkey from proxies "
             "left join guildmasks on ("
             "(guildmasks.guildid, guildmasks.maskid) = (?, proxies.maskid)"
-            ") where userid = ? and (proxid = ? or cmdname = ?) and state != ?",
+            ") left join masks on masks.maskid = proxies.maskid "
+            "where userid = ? and (proxid = ? or cmdname = ?) and state != ?",
             (
                 message.guild.id if message.guild else 0,
                 message.author.id,
@@ -169,6 +416,19 @@ class GestaltCommands:
     async def cmd_help(self, message, topic):
         await self.reply(message, HELPMSGS.get(topic, HELPMSGS[""]))
 
+    async def cmd_explain(self, message):
+        await self.reply(message, plain=EXPLAIN)
+
+    async def cmd_consent(self, message, user):
+        if user:
+            return await self.reply(message, WARNING)
+        await self.initiate_vote(
+            gesp.VoteNewUser(
+                user=message.author.id,
+                context=gesp.ProgramContext.from_message(message),
+            )
+        )
+
     async def cmd_invite(self, message):
         if (await self.application_info()).bot_public:
             await self.reply(
@@ -177,12 +437,32 @@ class GestaltCommands:
 
     async def cmd_permcheck(self, message, guildid):
         guildid = message.guild.id if guildid == "" else int(guildid)
-        guild = self.get_guild(guildid)
-        if guild == None or guild.get_member(message.author.id) == None:
+        await self.reply_lines(
+            message,
+            *self.pages_permcheck(message.author, None, guildid),
+            source=("permcheck", guildid),
+        )
+
+    # page sources return (embed, lines) for reply_lines()
+    # they're also used to rebuild pages that aren't in memory, see Pages
+    def page_source(self, name):
+        return {
+            "permcheck": self.pages_permcheck,
+            "proxies": self.pages_proxies,
+            "stats": self.pages_stats,
+        }.get(name)
+
+    def pages_permcheck(self, user, _guild, guildid):
+        guild = self.get_guild(int(guildid))
+        if guild == None or guild.get_member(user.id) == None:
             raise UserError("That guild is unknown or you are not a member.")
 
-        memberauth = guild.get_member(message.author.id)
-        lines = []
+        return (
+            discord.Embed(title=f"Permission check for {escape(guild.name)}"),
+            self.permcheck_lines(guild, guild.get_member(user.id)),
+        )
+
+    def permcheck_lines(self, guild, memberauth):
         for chan in guild.channels:
             if chan.type not in ALLOWED_CHANNELS:
                 continue
@@ -198,13 +478,7 @@ class GestaltCommands:
             if "read_messages" in errors:
                 errors = ["read_messages"]
             errors = REACT_CONFIRM if errors == [] else ", ".join(errors)
-            lines.append(f"{chan.mention}: {errors}")
-
-        await self.reply_lines(
-            message,
-            discord.Embed(title=f"Permission check for {escape(guild.name)}"),
-            lines,
-        )
+            yield f"{chan.mention}: {errors}"
 
     def proxy_string(self, proxy):
         line = "%s[`%s`] " % (ProxySymbol[proxy["type"]], proxy["proxid"])
@@ -238,45 +512,56 @@ class GestaltCommands:
             line += " (%s)" % parens.strip()
         return line
 
-    async def cmd_proxy_list(self, message, all_):
-        guild = message.guild
-        all_ |= bool(not guild)
-        rows = sorted(
-            self.fetchall(
-                "select proxies.*, guildmasks.guildid, masks.nick from proxies "
-                "left join guildmasks on ("
-                "(guildmasks.guildid, guildmasks.maskid) = (?, proxies.maskid)"
-                ") left join masks using (maskid) "
-                "where userid = ?",
-                (guild.id if guild else 0, message.author.id),
-            ),
-            key=lambda row: (
-                # randomize so it's not just in order of account creation
-                1000 + abs(hash(str(row["otherid"])))
-                if row["type"]
-                in (ProxyType.swap, ProxyType.pkswap, ProxyType.pkreceipt)
-                else row["type"]
-            ),
-        )
-
-        lines = []
-        # must be at least one: the override
-        for proxy in rows:
-            if (all_ or self.proxy_visible_in(proxy, guild)) and (
-                line := self.proxy_string(proxy)
-            ):
-                lines.append(line)
-
+    async def cmd_proxy_list(self, message, all_=False):
         await self.reply_lines(
             message,
-            discord.Embed(
-                title=f"Proxies of {escape(message.author.display_name)}:"
-            ).set_footer(
+            *self.pages_proxies(message.author, message.guild, int(all_)),
+            source=("proxies", int(all_)),
+        )
+
+    def pages_proxies(self, user, guild, all_):
+        all_ = bool(int(all_) or not guild)
+        return (
+            discord.Embed(title=f"Proxies of {escape(user.display_name)}:").set_footer(
                 text=None if all_ else "Proxies in other servers may have been omitted."
             ),
-            lines,
+            self.proxy_lines(user, guild, all_),
         )
 
+    # a few rows at a time, so an open list doesn't hold on to all of them
+    def proxy_lines(self, user, guild, all_):
+        after = (-1, 0)  # (sortkey, proxkey) of the last row so far
+        while rows := self.fetchall(
+            "select * from (" "select proxies.*, guildmasks.guildid, masks.nick, iif("
+            # shuffle swaps so they're not just in order of account creation
+            "proxies.type in (?, ?, ?),"
+            "1000 + (proxies.otherid % 1000003) * 2654435761 % 4294967291,"
+            "proxies.type) as sortkey from proxies "
+            "left join guildmasks on ("
+            "(guildmasks.guildid, guildmasks.maskid) = (?, proxies.maskid)"
+            ") left join masks using (maskid) "
+            "where userid = ?"
+            ") where (sortkey, proxkey) > (?, ?) "
+            "order by sortkey, proxkey limit ?",
+            (
+                ProxyType.swap,
+                ProxyType.pkswap,
+                ProxyType.pkreceipt,
+                guild.id if guild else 0,
+                user.id,
+                *after,
+                PAGES_ROWS,
+            ),
+        ):
+            after = (rows[-1]["sortkey"], rows[-1]["proxkey"])
+            # must be at least one: the override
+            yield from (
+                line
+                for proxy in rows
+                if (all_ or self.proxy_visible_in(proxy, guild))
+                and (line := self.proxy_string(proxy))
+            )
+
     def get_cards_proxy(self, proxy, recurse=True):
         embed = discord.Embed()
         yield embed
@@ -323,11 +608,10 @@ class GestaltCommands:
         embed.insert_field_at(0, name="Type", value=friendly)
 
         # assume that proxies too old for a creation date have incomplete count
-        if proxy["msgcount"]:
+        if count := self.get_msgcount(proxy, self.proxy_msgcounts, "proxkey"):
             embed.add_field(
                 name="Message Count",
-                value="%i%s"
-                % (proxy["msgcount"] or 0, "" if proxy["created"] else "+"),
+                value="%i%s" % (count, "" if proxy["created"] else "+"),
             )
 
         if proxy["prefix"] is not None:
@@ -467,38 +751,38 @@ class GestaltCommands:
         await self.mark_success(message, True)
 
     async def cmd_autoproxy_view(self, message):
+        state = self.get_autoproxy(message.author)
         ap = self.fetchone(
-            "select latch, become, proxies.*, guildmasks.guildid, masks.nick "
-            "from members "
-            "left join proxies using (proxid) "
-            "left join guildmasks using (guildid, maskid) "
+            "select proxies.*, guildmasks.guildid, masks.nick "
+            "from proxies "
+            "left join guildmasks on ("
+            "(guildmasks.guildid, guildmasks.maskid) = (?, proxies.maskid)"
+            ") "
             "left join masks using (maskid) "
-            "where (members.userid, members.guildid) = (?, ?)",
-            (message.author.id, message.guild.id),
+            "where proxkey = ?",
+            (message.guild.id, state["ap"]),
         )
         # NOTE: valid == False if proxy has been deleted
-        # the lack of joined row from proxies sets fetched proxid to NULL
-        if valid := ap and ap["proxid"]:
+        if valid := bool(ap):
             if not (valid := self.proxy_usable_in(ap, message.guild)):
                 self.set_autoproxy(message.author, None)
         proxy_string = valid and self.proxy_string(ap)
 
         lines = []
-        if ap:
-            if ap["latch"]:
-                lines.append("Your autoproxy is set to latch in this server.")
-                if proxy_string:
-                    lines.append("Your current latched proxy is:")
-                else:
-                    lines.append("However, no proxy is latched.")
+        if state["latch"]:
+            lines.append("Your autoproxy is set to latch in this server.")
             if proxy_string:
-                if not ap["latch"]:
-                    lines.append("Your autoproxy in this server is set to:")
-                lines.append(proxy_string)
-                if ap["become"] < 1.0:
-                    lines.append(
-                        "This proxy is in Become mode (%i%%)." % int(ap["become"] * 100)
-                    )
+                lines.append("Your current latched proxy is:")
+            else:
+                lines.append("However, no proxy is latched.")
+        if proxy_string:
+            if not state["latch"]:
+                lines.append("Your autoproxy in this server is set to:")
+            lines.append(proxy_string)
+            if state["become"] < 1.0:
+                lines.append(
+                    "This proxy is in Become mode (%i%%)." % int(state["become"] * 100)
+                )
         if not lines:
             lines.append("You have no autoproxy enabled in this server.")
         lines.append(
@@ -517,7 +801,7 @@ class GestaltCommands:
                 raise UserError("You can't autoproxy your override.")
             if not self.proxy_usable_in(proxy, message.guild):
                 raise UserError("You can't use that proxy in this guild.")
-            self.set_autoproxy(member, proxy["proxid"], latch=0)
+            self.set_autoproxy(member, proxy["proxkey"], latch=0)
             if and_proxy:
                 return await self.do_proxy(
                     message,
@@ -629,10 +913,10 @@ class GestaltCommands:
         embed.add_field(name="Members", value=mask["members"])
 
         # assume that masks too old for a creation date have incomplete count
-        if mask["msgcount"]:
+        if count := self.get_msgcount(mask, self.mask_msgcounts, "maskkey"):
             embed.add_field(
                 name="Message Count",
-                value="%i%s" % (mask["msgcount"], "" if mask["created"] else "+"),
+                value="%i%s" % (count, "" if mask["created"] else "+"),
             )
 
         embed.add_field(
@@ -761,11 +1045,8 @@ class GestaltCommands:
         authid = message.author.id
         # avoid potential race conditions if a user joins at the same time
         mask = self.fetchone("select * from masks where maskid = ?", (maskid,))
-        if mask["members"] == 1:
-            # triggers will delete mask and guildmasks
-            if self.is_hosted_avatar(mask["avatar"]):
-                os.remove(self.hosted_avatar_local_path(mask["avatar"]))
-        elif authid in gesp.Rules.from_json(mask["rules"]).named:
+        # if this is the last member, triggers will delete mask and guildmasks
+        if mask["members"] > 1 and authid in gesp.Rules.from_json(mask["rules"]).named:
             if not member:
                 raise UserError(
                     "You are named in the rules of this mask and must "
@@ -776,6 +1057,8 @@ class GestaltCommands:
                 )
             self.nominate(maskid, authid, member.id)
         gesp.ActionRemove(maskid, authid).execute(self)
+        # no-op unless that was the last member
+        self.release_avatar(mask["avatar"])
         await self.mark_success(message, True)
 
     async def cmd_edit(self, message, target, content):
@@ -784,27 +1067,19 @@ class GestaltCommands:
         channel = message.channel
         if target:
             try:
-                proxied = self.fetchone(
-                    "select authid from history where msgid = ?", (target.id,)
-                )
+                proxied = self.get_history(target.id)
             except OverflowError:  # malformed message link
                 raise UserError("That message link is invalid.")
             if not proxied or proxied["authid"] != message.author.id:
                 return UserError("You did not proxy that message.")
         else:
-            proxied = self.fetchone(
-                # redundant chanid != 0 to enable use of index
-                "select max(msgid) as msgid, authid from history "
-                "where (chanid, authid) = (?, ?) and chanid != 0",
-                (channel.id, message.author.id),
-            )
-            if not proxied["msgid"]:
+            if not (msgid := self.get_last_history(channel.id, message.author.id)):
                 raise UserError("Could not find a recent message to edit.")
-            then = discord.utils.snowflake_time(proxied["msgid"])
+            then = discord.utils.snowflake_time(msgid)
             now = discord.utils.utcnow()
             if then <= now and (now - then).total_seconds() > TIMEOUT_EDIT:
                 raise UserError("Could not find a recent message to edit.")
-            target = channel.get_partial_message(proxied["msgid"])
+            target = channel.get_partial_message(msgid)
 
         if isinstance(target, discord.PartialMessage):
             try:
@@ -845,7 +1120,7 @@ class GestaltCommands:
         await self.make_log_message(edited, message, old=target)
 
     async def cmd_become(self, message, proxy):
-        self.set_autoproxy(message.author, proxy["proxid"], become=0.0)
+        self.set_autoproxy(message.author, proxy["proxkey"], become=0.0)
         await self.mark_success(message, True)
 
     async def cmd_log_channel(self, message, channel):
@@ -871,6 +1146,21 @@ class GestaltCommands:
         )
         await self.mark_success(message, True)
 
+    async def cmd_stats(self, message):
+        await self.reply_lines(message, *self.pages_stats(), source=("stats", ""))
+
+    def pages_stats(self, *_):
+        return (
+            discord.Embed(title="Stats since startup"),
+            [
+                "%s: **%s**" % (name, round(value, 3))
+                for name, value in sorted(
+                    (dict(self.stats) | self.history_filter_stats()).items()
+                )
+            ]
+            or ["Nothing yet."],
+        )
+
     async def pk_api_get(self, url):
         await self.pk_ratelimit.block()
         try:
@@ -993,373 +1283,299 @@ class GestaltCommands:
             return
         message = reader.msg
         chanid = message.channel.id
-        self.expected_pk_errors[chanid] = None
+        expected = self.shard_cache(message.guild).expected_pk_errors
+        expected[chanid] = None
 
         try:
             await self.cmd_edit(message, target, reader.cmd)
         except UserError:
-            self.expected_pk_errors.pop(chanid, None)
+            expected.pop(chanid, None)
         else:
             await asyncio.sleep(0.5)  # pk can be slow to respond
-            if error := self.expected_pk_errors.pop(chanid, None):
+            if error := expected.pop(chanid, None):
                 if error.id > message.id:  # in case something went wrong
                     await self.try_delete(error)
 
-    # parse, convert, and validate arguments, then call the relevant function
-    async def do_command(self, reader, user):
-        message = reader.msg
-        arg = reader.read_word().lower()
-        authid = message.author.id
-
-        # info and server management commands are always available
-        if arg == "help":
-            return await self.cmd_help(message, reader.read_word().lower())
-
-        elif arg == "explain":
-            return await self.reply(message, plain=EXPLAIN)
-
-        elif arg == "invite":
-            return await self.cmd_invite(message)
-
-        elif arg == "permcheck":
-            guildid = reader.read_word()
-            if re.search("[^0-9]", guildid) or not (guildid or message.guild):
-                raise UserError("Please provide a valid guild ID.")
-            return await self.cmd_permcheck(message, guildid)
-
-        elif arg == "log":
-            if not message.guild:
-                raise UserError(ERROR_DM)
-            if not message.author.guild_permissions.administrator:
-                raise UserError("You need `Manage Server` permissions to do that.")
-
-            arg = reader.read_word().lower()
-            if arg == "channel":
-                channel = reader.read_channel()
-                if not channel:
-                    raise UserError("Please mention a channel.")
-
-                return await self.cmd_log_channel(message, channel)
-
-            if arg == "disable":
-                return await self.cmd_log_disable(message)
-
-            return
-
-        elif arg == "channel":
-            if not message.guild:
-                raise UserError(ERROR_DM)
-            if not message.author.guild_permissions.manage_channels:
-                raise UserError("You need `Manage Channels` permissions to do that.")
-
-            channel = reader.read_channel()
-            if not channel:
-                raise UserError("Please mention a channel.")
-
-            arg = reader.read_word()
-            if arg == "mode":
-                mode = reader.read_word()
-                if mode not in ChannelMode.__members__.keys():
-                    raise UserError("Invalid channel mode.")
-
-                return await self.cmd_channel_mode(message, channel, mode)
-
-            return
+    def get_mask(self, message, name):
+        try:
+            # if get_user_proxy succeeds, ['maskid'] must exist
+            maskid = self.get_user_proxy(message, name)["maskid"]
+        except UserError:
+            maskid = name  # could save error, but would be confusing
+        if not (
+            row := self.fetchone("select * from masks where maskid = ?", (maskid,))
+        ):
+            raise UserError("Mask not found.")
+        return row
+
+    def passes(self, guard, message, user):
+        if guard == "user":
+            return bool(user)
+        if guard == "guild":
+            return bool(message.guild)
+        if guard == "admin":
+            return message.author.id in self.admins
+        return getattr(message.author.guild_permissions, guard)
+
+    # raises if a guard fails, or returns False if it fails quietly
+    # (member is checked once the mask is looked up)
+    def check_guards(self, guards, message, user):
+        for guard in guards:
+            if guard != "member" and not self.passes(guard, message, user):
+                if GUARDS[guard]:
+                    raise UserError(GUARDS[guard])
+                return False
+        return True
 
-        # ... these are not
-        if not user:
-            if arg == "consent":
-                return await self.initiate_vote(
-                    gesp.VoteNewUser(
-                        user=authid, context=gesp.ProgramContext.from_message(message)
-                    )
+    def lookup(self, kind, message, user, raw):
+        if kind == "account":
+            return user
+        value = next(raw)
+        if kind == "proxy":
+            return self.get_user_proxy(message, value)
+        if kind == "mask":
+            return self.get_mask(message, value)
+        return value
+
+    # checks for what's looked up, before the cmd_ functions get it
+    # (the path and guards in COMMANDS are checked before these are called)
+
+    async def run_permcheck(self, message, guildid):
+        if re.search("[^0-9]", guildid) or not (guildid or message.guild):
+            raise UserError("Please provide a valid guild ID.")
+        await self.cmd_permcheck(message, guildid)
+
+    async def run_log_channel(self, message, channel):
+        if not channel:
+            raise UserError("Please mention a channel.")
+        await self.cmd_log_channel(message, channel)
+
+    async def run_channel_mode(self, message, channel, mode):
+        if not channel:
+            raise UserError("Please mention a channel.")
+        if mode not in ChannelMode.__members__.keys():
+            raise UserError("Invalid channel mode.")
+        await self.cmd_channel_mode(message, channel, mode)
+
+    async def run_proxy_tags(self, message, proxy, tags):
+        if proxy["type"] == ProxyType.pkreceipt:
+            raise UserError("You cannot assign tags to that proxy.")
+        await self.cmd_proxy_tags(message, proxy, tags)
+
+    async def run_proxy_auto(self, message, proxy):
+        await self.cmd_help(message, "autoproxy")
+
+    async def run_proxy_rename(self, message, proxy, newname):
+        if not newname:
+            raise UserError("Please provide a new name.")
+        await self.cmd_proxy_rename(message, proxy["proxid"], newname)
+
+    async def run_proxy_flag(self, message, proxy, name, value):
+        if value is None:
+            raise UserError('Please specify "on" or "off".')
+        if name == "autoadd":
+            if proxy["type"] != ProxyType.mask:
+                raise UserError("That only applies to Masks.")
+            await self.cmd_mask_autoadd(message, proxy, value)
+            # continue to normal command to actually change the flag
+        await self.cmd_proxy_flag(message, proxy, name, value)
+
+    async def run_autoproxy(self, message, arg):
+        if arg:
+            return await self.cmd_autoproxy_set(message, arg)
+        await self.cmd_autoproxy_view(message)
+
+    async def run_config_unknown(self, message, name):
+        raise UserError("That setting does not exist.")
+
+    async def run_config_update(self, message, user, name, value):
+        if value is None:
+            raise UserError('Please specify "on" or "off".')
+        await self.cmd_config_update(message, user, name, value)
+
+    async def run_account_color(self, message, color):
+        if not color:
+            raise UserError("Please enter a color (e.g. `#012345`)")
+        await self.cmd_account_update(message, color)
+
+    def check_member(self, member):
+        if member.id == self.user.id:
+            raise UserError(ERROR_BLURSED)
+        if not self.can_use_gestalt(member):
+            raise UserError(ERROR_CURSED)
+
+    async def run_swap_open(self, message, member, tags):
+        if member is None:
+            raise UserError("User not found.")
+        self.check_member(member)
+        await self.cmd_swap_open(message, member, tags or None)
+
+    async def run_swap_close(self, message, proxy):
+        if proxy["type"] != ProxyType.swap:
+            raise UserError("You do not have a swap with that ID.")
+        await self.cmd_swap_close(message, proxy)
+
+    async def run_mask_new(self, message, name):
+        if not name:
+            raise UserError("Please provide a name.")
+        check_name_length(name)
+        await self.cmd_mask_new(message, name)
+
+    async def run_mask_join(self, message, mask):
+        if self.is_member_of(maskid := mask["maskid"].lower(), message.author.id):
+            raise UserError("You are already a member.")
+        await self.cmd_mask_join(message, maskid)
+
+    async def run_mask_invite(self, message, mask, member):
+        if not member:
+            raise UserError("Please @mention someone.")
+        if self.is_member_of(maskid := mask["maskid"].lower(), member.id):
+            raise UserError("That user is already a member.")
+        self.check_member(member)
+        await self.cmd_mask_invite(message, maskid, member)
+
+    async def run_mask_remove(self, message, mask, member):
+        if not member:
+            raise UserError("Please @mention someone.")
+        if not self.is_member_of(maskid := mask["maskid"].lower(), member.id):
+            raise UserError("That user is not a member.")
+        await self.cmd_mask_remove(message, maskid, member)
+
+    async def run_mask_add(self, message, mask, code):
+        invite = None
+        if code:
+            # TODO better invite in harness for better tests
+            try:
+                invite = await self.fetch_invite(
+                    code, with_counts=False, with_expiration=False
                 )
-            raise UserError("Please use `gs;consent` to begin.")
-
-        elif arg == "consent":
-            return await self.reply(message, WARNING)
-
-        elif arg in ["proxy", "p"]:
-            name = reader.read_quote()
-
-            if name in ["", "list"]:
-                return await self.cmd_proxy_list(message, reader.read_token("-all"))
-
-            arg = reader.read_word().lower()
-            proxy = self.get_user_proxy(message, name)
-
-            if arg == "":
-                return await self.cmd_proxy_view(message, proxy)
-
-            if arg == "tags":
-                if proxy["type"] == ProxyType.pkreceipt:
-                    raise UserError("You cannot assign tags to that proxy.")
-                arg = reader.read_clear() or reader.read_remainder()
-                return await self.cmd_proxy_tags(message, proxy, arg)
-
-            elif arg == "auto":
-                # removed command
-                return await self.cmd_help(message, "autoproxy")
-
-            elif arg == "rename":
-                newname = reader.read_remainder()
-                if not newname:
-                    raise UserError("Please provide a new name.")
-                return await self.cmd_proxy_rename(message, proxy["proxid"], newname)
-
-            elif arg in ProxyFlags.__members__.keys():
-                if (value := reader.read_bool_int()) is None:
-                    raise UserError('Please specify "on" or "off".')
-                if arg == "autoadd":
-                    if proxy["type"] != ProxyType.mask:
-                        raise UserError("That only applies to Masks.")
-                    await self.cmd_mask_autoadd(message, proxy, value)
-                    # continue to normal command to actually change the flag
-                return await self.cmd_proxy_flag(message, proxy, arg, value)
-
-        elif arg in ["autoproxy", "ap"]:
-            if not message.guild:
-                raise UserError(ERROR_DM)
-
-            if arg := reader.read_remainder():
-                return await self.cmd_autoproxy_set(message, arg)
-            return await self.cmd_autoproxy_view(message)
-
-        elif arg in ["account", "a"]:
-            arg = reader.read_word().lower()
-            if arg == "config":
-                arg = reader.read_word().lower()
-                if len(arg) == 0:
-                    return await self.cmd_config_list(message, user)
-
-                if arg in ["default", "defaults"]:
-                    return await self.cmd_config_default(message)
-
-                if not arg in Prefs.__members__.keys():
-                    raise UserError("That setting does not exist.")
-
-                if (value := reader.read_bool_int()) is None:
-                    raise UserError('Please specify "on" or "off".')
-
-                return await self.cmd_config_update(message, user, arg, value)
-
-            elif arg in ["color", "colour"]:
-                if not (arg := reader.read_clear() or reader.read_color()):
-                    raise UserError("Please enter a color (e.g. `#012345`)")
-
-                return await self.cmd_account_update(message, arg)
-
-        elif arg in ["swap", "s"]:
-            arg = reader.read_word().lower()
-            if arg == "open":
-                if not message.guild:
-                    raise UserError(ERROR_DM)
-
-                if (member := reader.read_member()) is None:
-                    raise UserError("User not found.")
-                tags = reader.read_remainder() or None
-
-                if member.id == self.user.id:
-                    raise UserError(ERROR_BLURSED)
-                if not self.can_use_gestalt(member):
-                    raise UserError(ERROR_CURSED)
-
-                return await self.cmd_swap_open(message, member, tags)
-
-            elif arg in ["close", "off"]:
-                name = reader.read_quote()
-                proxy = self.get_user_proxy(message, name)
-                if proxy["type"] != ProxyType.swap:
-                    raise UserError("You do not have a swap with that ID.")
-
-                return await self.cmd_swap_close(message, proxy)
-
-        elif arg in ["mask", "m"]:
-            if reader.read_token("new"):
-                if not (name := reader.read_remainder()):
-                    raise UserError("Please provide a name.")
-                if len(name) > MAX_WEBHOOK_NAME_LENGTH:
-                    raise UserError(
-                        f"That name is too long ({len(name)}>{MAX_WEBHOOK_NAME_LENGTH})."
-                    )
-
-                return await self.cmd_mask_new(message, name)
-
-            else:
-                maskid = reader.read_quote()
-                action = reader.read_word().lower()
-
-                # TODO clean this up
-                try:
-                    # if get_user_proxy succeeds, ['maskid'] must exist
-                    maskid = self.get_user_proxy(message, maskid)["maskid"]
-                except UserError:
-                    pass  # could save error, but would be confusing
-                row = self.fetchone("select * from masks where maskid = ?", (maskid,))
-                if not row:
-                    raise UserError("Mask not found.")
-                maskid = maskid.lower()  # TODO rules cache requires this...
-
-                if action == "":
-                    return await self.cmd_mask_view(message, row)
-
-                if action == "join":
-                    if self.is_member_of(maskid, authid):
-                        raise UserError("You are already a member.")
-                    return await self.cmd_mask_join(message, maskid)
-
-                if action == "invite":
-                    if not message.guild:
-                        raise UserError(ERROR_DM)
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that.")
-                    if not (member := reader.read_member()):
-                        raise UserError("Please @mention someone.")
-                    if self.is_member_of(maskid, member.id):
-                        raise UserError("That user is already a member.")
-                    # this bit again
-                    if member.id == self.user.id:
-                        raise UserError(ERROR_BLURSED)
-                    if not self.can_use_gestalt(member):
-                        raise UserError(ERROR_CURSED)
-                    return await self.cmd_mask_invite(message, maskid, member)
-
-                if action == "remove":
-                    if not message.guild:
-                        raise UserError(ERROR_DM)
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that.")
-                    if not (member := reader.read_member()):
-                        raise UserError("Please @mention someone.")
-                    if not self.is_member_of(maskid, member.id):
-                        raise UserError("That user is not a member.")
-                    return await self.cmd_mask_remove(message, maskid, member)
-
-                if action == "add":
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that.")
-                    invite = None
-                    if code := reader.read_word():
-                        # TODO better invite in harness for better tests
-                        try:
-                            invite = await self.fetch_invite(
-                                code, with_counts=False, with_expiration=False
-                            )
-                        except:
-                            raise UserError("That invite is invalid.")
-                        if isinstance(invite.guild, discord.PartialInviteGuild):
-                            raise UserError("I am not a member of that server.")
-                    elif not message.guild:
-                        raise UserError("Please provide an invite.")
-                    return await self.cmd_mask_add(message, maskid, invite)
-
-                if newaction := gesp.ActionChange.valid(action):
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that.")
-
-                    if newaction == "nick":
-                        if not (arg := reader.read_remainder()):
-                            raise UserError("Please provide a new name.")
-                        if len(arg) > MAX_WEBHOOK_NAME_LENGTH:
-                            raise UserError(
-                                f"That name is too long ({len(arg)}>{MAX_WEBHOOK_NAME_LENGTH})."
-                            )
-                    if newaction == "avatar":
-                        arg = reader.read_clear() or reader.read_link()
-                        if AVATAR_URL_BASE and str(arg).startswith(AVATAR_URL_BASE):
-                            raise UserError(ERROR_CURSED)
-                        if CDN_REGEX.fullmatch(str(arg)):
-                            raise UserError("Please reupload the attachment.")
-                        if AVATAR_URL_BASE and not arg and message.attachments:
-                            arg = message.attachments[0]
-                            if arg.content_type not in VALID_MIME_TYPES:
-                                raise UserError("That attachment is not a valid image.")
-                            if arg.size > AVATAR_MAX_SIZE_MB * 1024 * 1024:
-                                raise UserError(
-                                    "That attachment is too large "
-                                    "(max %iMB)" % AVATAR_MAX_SIZE_MB
-                                )
-                            return await self.cmd_mask_avatar_attachment(
-                                message, maskid, arg
-                            )
-                        if not arg:
-                            raise UserError("Please provide a valid URL or attachment.")
-                    if newaction == "color":
-                        if not (arg := reader.read_clear() or reader.read_color()):
-                            raise UserError("Please enter a color (e.g. `#012345`)")
-
-                    return await self.cmd_mask_update(message, maskid, newaction, arg)
-
-                if action == "rules":
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that.")
-                    rules = reader.read_remainder()
-                    if rules not in RuleType.__members__.keys():
-                        raise UserError("Unknown rule type.")
-                    return await self.cmd_mask_rules(message, maskid, rules)
-
-                if action == "nominate":
-                    if not message.guild:
-                        raise UserError(ERROR_DM)
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that.")
-                    if not (member := reader.read_member()):
-                        raise UserError("You need to nominate someone!")
-                    if not self.is_member_of(maskid, member.id):
-                        raise UserError("That user is not a member.")
-                    if member.id == authid:
-                        raise UserError(ERROR_CURSED)
-                    return await self.cmd_mask_nominate(message, row, member)
-
-                if action == "leave":
-                    if not self.is_member_of(maskid, authid):
-                        raise UserError("Only members of the mask can do that?")
-                    if member := reader.read_member():
-                        if not self.is_member_of(maskid, member.id):
-                            raise UserError("That user is not a member.")
-                        if member.id == authid:
-                            raise UserError(ERROR_CURSED)
-                    return await self.cmd_mask_leave(message, maskid, member)
-
-        elif arg in ["edit", "e"]:
-            return await self.cmd_edit(message, reader.read_message(self), reader.cmd)
-
-        elif arg in ["become", "bc"]:
-            proxy = self.get_user_proxy(message, reader.read_quote())
-            if proxy["type"] == ProxyType.override:
-                raise UserError("You are already yourself!")
-            if proxy["state"] != ProxyState.active:
-                raise UserError("That proxy is not active.")
-
-            return await self.cmd_become(message, proxy)
-
-        elif arg in ["pluralkit", "pk"]:
-
-            arg = reader.read_word()
-            if arg == "swap":
-                if (member := reader.read_member()) is None:
-                    raise UserError("User not found.")
-                pkid = reader.read_word()
-
-                return await self.cmd_pk_swap(message, member, pkid)
-
-            elif arg == "close":
-                swap = self.get_user_proxy(message, reader.read_quote())
-                if swap["type"] not in (ProxyType.pkreceipt, ProxyType.pkswap):
-                    raise UserError("Please provide a swap receipt.")
-
-                return await self.cmd_pk_close(message, swap)
+            except:
+                raise UserError("That invite is invalid.")
+            if isinstance(invite.guild, discord.PartialInviteGuild):
+                raise UserError("I am not a member of that server.")
+        elif not message.guild:
+            raise UserError("Please provide an invite.")
+        await self.cmd_mask_add(message, mask["maskid"].lower(), invite)
+
+    async def run_mask_nick(self, message, mask, nick):
+        if not nick:
+            raise UserError("Please provide a new name.")
+        check_name_length(nick)
+        await self.cmd_mask_update(message, mask["maskid"].lower(), "nick", nick)
+
+    async def run_mask_avatar(self, message, mask, url):
+        maskid = mask["maskid"].lower()
+        if AVATAR_URL_BASE and str(url).startswith(AVATAR_URL_BASE):
+            raise UserError(ERROR_CURSED)
+        if CDN_REGEX.fullmatch(str(url)):
+            raise UserError("Please reupload the attachment.")
+        if AVATAR_URL_BASE and not url and message.attachments:
+            attach = message.attachments[0]
+            if attach.content_type not in VALID_MIME_TYPES:
+                raise UserError("That attachment is not a valid image.")
+            if attach.size > AVATAR_MAX_SIZE_MB * 1024 * 1024:
+                raise UserError(
+                    "That attachment is too large (max %iMB)" % AVATAR_MAX_SIZE_MB
+                )
+            return await self.cmd_mask_avatar_attachment(message, maskid, attach)
+        if not url:
+            raise UserError("Please provide a valid URL or attachment.")
+        await self.cmd_mask_update(message, maskid, "avatar", url)
+
+    async def run_mask_color(self, message, mask, color):
+        if not color:
+            raise UserError("Please enter a color (e.g. `#012345`)")
+        await self.cmd_mask_update(message, mask["maskid"].lower(), "color", color)
+
+    async def run_mask_rules(self, message, mask, rules):
+        if rules not in RuleType.__members__.keys():
+            raise UserError("Unknown rule type.")
+        await self.cmd_mask_rules(message, mask["maskid"].lower(), rules)
+
+    async def run_mask_nominate(self, message, mask, member):
+        if not member:
+            raise UserError("You need to nominate someone!")
+        if not self.is_member_of(mask["maskid"].lower(), member.id):
+            raise UserError("That user is not a member.")
+        if member.id == message.author.id:
+            raise UserError(ERROR_CURSED)
+        await self.cmd_mask_nominate(message, mask, member)
+
+    async def run_mask_leave(self, message, mask, member):
+        maskid = mask["maskid"].lower()
+        if not self.is_member_of(maskid, message.author.id):
+            raise UserError("Only members of the mask can do that?")
+        if member:
+            if not self.is_member_of(maskid, member.id):
+                raise UserError("That user is not a member.")
+            if member.id == message.author.id:
+                raise UserError(ERROR_CURSED)
+        await self.cmd_mask_leave(message, maskid, member)
+
+    async def run_edit(self, message, content):
+        reader = CommandReader(message, content)
+        await self.cmd_edit(message, reader.read_message(self), reader.cmd)
+
+    async def run_become(self, message, proxy):
+        if proxy["type"] == ProxyType.override:
+            raise UserError("You are already yourself!")
+        if proxy["state"] != ProxyState.active:
+            raise UserError("That proxy is not active.")
+        await self.cmd_become(message, proxy)
+
+    async def run_pk_swap(self, message, member, pkid):
+        if member is None:
+            raise UserError("User not found.")
+        await self.cmd_pk_swap(message, member, pkid)
+
+    async def run_pk_close(self, message, swap):
+        if swap["type"] not in (ProxyType.pkreceipt, ProxyType.pkswap):
+            raise UserError("Please provide a swap receipt.")
+        await self.cmd_pk_close(message, swap)
+
+    async def run_pk_sync(self, message):
+        if not message.reference:
+            raise UserError("Please reply to a proxied message.")
+        await self.cmd_pk_sync(message)
 
-            elif arg == "sync":
-                if not message.guild:
-                    raise UserError(ERROR_DM)
-                if not message.reference:
-                    raise UserError("Please reply to a proxied message.")
+    async def run_motd(self, message, motd):
+        self.execute("update meta set motd = ?", (motd,))
+        await self.update_status()
+        await self.mark_success(message, True)
 
-                return await self.cmd_pk_sync(message)
+    # found is from COMMAND_TREE.find(reader). check it, look things up, then run it
+    async def do_command(self, reader, found, user):
+        message = reader.msg
+        if not found:
+            if not user:
+                raise UserError(GUARDS["user"])
+            return
+        (command, raw) = found
+        if not command:
+            if not user:
+                raise UserError(GUARDS["user"])
+            # same answer as the commands there would give, if it isn't allowed
+            if not self.check_guards(raw, message, user):
+                return
+            # a typo, most likely. nothing has been looked up, so don't bother
+            self.stats["command unknown"] += 1
+            raise UserError(ERROR_ACTION)
 
-        elif arg == "motd":
-            if message.author.id in self.admins:
-                self.execute("update meta set motd = ?", (reader.read_remainder(),))
-                await self.update_status()
-                await self.mark_success(message, True)
+        name = "command " + command.name
+        self.stats[name] += 1
+        start = time.perf_counter()
+        try:
+            if not self.check_guards(command.guards, message, user):
+                return
+            raw = iter(raw)
+            args = [self.lookup(kind, message, user, raw) for kind in command.args]
+            if "member" in command.guards:
+                mask = args[command.args.index("mask")]
+                if not self.is_member_of(mask["maskid"].lower(), message.author.id):
+                    raise UserError(GUARDS["member"])
+            await getattr(self, command.handler)(message, *args)
+        except Exception:
+            self.stats[name + " errors"] += 1
+            raise
+        finally:
+            self.stats[name + " seconds"] += time.perf_counter() - start
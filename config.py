@@ -1,8 +1,24 @@
 DEFAULT_DB = "gestalt.db"
 AVATAR_DIRECTORY = "avatars"
 AVATAR_URL_BASE = ""
+# serve AVATAR_DIRECTORY from the bot itself, at the root of this address
+# (AVATAR_URL_BASE should then point here.) None to use another web server
+AVATAR_SERVER_HOST = "127.0.0.1"
+AVATAR_SERVER_PORT = None
 
 AVATAR_MAX_SIZE_MB = 2
+# uploads are converted to webp no larger than this, if Pillow is installed
+AVATAR_SIZE = 256
+AVATAR_QUALITY = 85
+AVATAR_MAX_PIXELS = 4096 * 4096
+# for animations, every frame is decoded. so those are limited all together too
+AVATAR_MAX_FRAMES = 500
+AVATAR_MAX_TOTAL_PIXELS = 4 * AVATAR_MAX_PIXELS
+AVATAR_WORKERS = 2
+# orphaned avatar files are removed during cleanup, this many at a time
+AVATAR_GC_BATCH = 100
+# files younger than this (in seconds) are never considered orphans
+AVATAR_GC_GRACE = 60 * 60
 
 PK_ID = 466378653216014359
 PK_ENDPOINT = "https://api.pluralkit.me/v2"
@@ -21,6 +37,45 @@ DELETE_DELAY = 0.4
 
 TIMEOUT_EDIT = 10 * 60
 TIMEOUT_PAGES = 20 * 60
+# pages kept per pagination; others are rebuilt if they come up again
+PAGES_CACHED = 4
+# rows fetched at a time for lists that are paged through
+PAGES_ROWS = 50
+# votes and pages ending at the same time are deactivated this many at once
+EXPIRY_CONCURRENCY = 5
+
+# token buckets, (tokens per second, burst), per user and per guild
+# commands are charged as soon as they're read, proxies only when they match
+THROTTLES = {
+    "proxy": {"user": (1, 10), "guild": (20, 200)},
+    "command": {"user": (0.5, 6), "guild": (5, 40)},
+    "heavy": {"user": (0.1, 3), "guild": (1, 10)},
+}
+# commands that (can) start votes, page through lists, or call other services
+THROTTLE_HEAVY = {
+    "consent",
+    "proxy list",
+    "permcheck",
+    "stats",
+    "mask new",
+    "mask join",
+    "mask invite",
+    "mask remove",
+    "mask add",
+    "mask nick",
+    "mask avatar",
+    "mask color",
+    "mask rules",
+    "mask nominate",
+    "mask leave",
+    "swap open",
+    "pk swap",
+    "pk sync",
+}
+# waits up to this long are queued; anything longer is turned away
+THROTTLE_QUEUE = 2.0
+# buckets that have filled back up are forgotten, but never more than this many
+THROTTLE_CAP = 50000
 
 REPLACEMENTS = [
     (r"\bam\b", "are"),
@@ -42,6 +97,8 @@ REACT_DELETE = "\N{CROSS MARK}"
 # but this has visibility issues on ultradark theme
 REACT_CONFIRM = "\N{WHITE HEAVY CHECK MARK}"
 REACT_WAIT = "\N{HOURGLASS}"
+# on a proxy that was turned away for being one too many, see THROTTLES
+REACT_THROTTLED = "\N{SNAIL}"
 
 REACT_FIRST = "\N{BLACK LEFT-POINTING DOUBLE TRIANGLE}"
 REACT_PREV = "\N{BLACK LEFT-POINTING TRIANGLE}"
@@ -61,8 +118,39 @@ DEFAULT_PREFS = ["errors"]
 BECOME_MAX = 50
 
 CLEANUP_TIMEOUT = 1200  # in seconds
+# proxied messages are written to history in batches of this size (or on commit)
+HISTORY_BATCH = 100
+# the filter of history msgids is sized for this many times the rows it starts with
+HISTORY_FILTER_HEADROOM = 2
+HISTORY_FILTER_MIN = 1 << 14
+# rows read at a time when it has to be rebuilt while running
+HISTORY_FILTER_CHUNK = 10000
+# rows per chunk, and seconds between chunks, for long data migrations
+BACKFILL_CHUNK = 1000
+BACKFILL_DELAY = 0.1
+# when running some shards in one process and some in another
+# (otherwise the database is only committed on cleanup)
+COMMIT_TIMEOUT = 1
+# REST calls in flight at once, by priority (critical, normal, cosmetic)
+# each only waits on its own kind, so reactions can't hold up proxying
+# critical ones aren't limited: discord.py already waits on each route, and a
+# slot held through one channel's 429 would hold up proxying everywhere else
+REST_CONCURRENCY = [None, 5, 3]
+# cosmetic calls (reactions, log messages) are dropped if this many are waiting
+REST_BACKLOG = 20
+# seconds before showing that a slow command is being worked on
+PROGRESS_DELAY = 1.0
+# how long a proxied message waits for earlier ones in the same channel
+SEQUENCE_TIMEOUT = 10
 
-LAST_MESSAGE_CACHE_SIZE = 20
+LAST_MESSAGE_CACHE_SIZE = 20  # per channel
+LAST_MESSAGE_CACHE_MAX = 100000  # per shard; least recent channels go first
+# other people's messages are remembered for about this many seconds, so that
+# deleting them (e.g. after proxying) is free. split into generations that are
+# dropped whole; a generation also ends early if it fills up, capping memory
+IGNORE_DELETE_WINDOW = 600
+IGNORE_DELETE_GENERATIONS = 3
+IGNORE_DELETE_CAP = 300000
 MERGE_PADDING = "\N{HAIR SPACE}\N{KHMER VOWEL INHERENT AA}"
 
 WEBHOOK_NAME = "Gestalt webhook"
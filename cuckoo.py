@@ -0,0 +1,92 @@
+import random
+import array
+
+
+MASK64 = (1 << 64) - 1
+
+
+# like a set of ints, except membership is only "no" or "probably"
+# unlike a bloom filter, things can be removed. but only remove what was added!
+# (removing something else could remove a match for something that was)
+# https://www.cs.cmu.edu/~dga/papers/cuckoo-conext2014.pdf
+class CuckooFilter:
+    BUCKET_SIZE = 4
+    MAX_KICKS = 500
+
+    def __init__(self, capacity):
+        # power of two so that a fingerprint's other bucket is just an xor away
+        self.nbuckets = 1 << max(0, (capacity - 1) // self.BUCKET_SIZE).bit_length()
+        # 16 bit fingerprints, 0 = empty. about 1 in 8000 false positives
+        self.slots = array.array("H", bytes(2 * self.BUCKET_SIZE * self.nbuckets))
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.slots.itemsize * len(self.slots)
+
+    # snowflakes are mostly timestamp, so mix them up first
+    def locate(self, x):
+        x = (x * 0x9E3779B97F4A7C15) & MASK64
+        x ^= x >> 29
+        return ((x & 0xFFFF) or 1, (x >> 16) & (self.nbuckets - 1))
+
+    def other(self, bucket, fp):
+        return bucket ^ ((fp * 0x5BD1E995) & (self.nbuckets - 1))
+
+    def bucket(self, i):
+        return range(i * self.BUCKET_SIZE, (i + 1) * self.BUCKET_SIZE)
+
+    def put(self, i, fp):
+        for slot in self.bucket(i):
+            if not self.slots[slot]:
+                self.slots[slot] = fp
+                return True
+
+    def __contains__(self, x):
+        (fp, i) = self.locate(x)
+        return any(
+            self.slots[slot] == fp
+            for slot in (*self.bucket(i), *self.bucket(self.other(i, fp)))
+        )
+
+    # returns False if it's too full. something else was dropped, so rebuild it
+    def add(self, x):
+        (fp, i) = self.locate(x)
+        self.count += 1
+        if self.put(i, fp) or self.put(i := self.other(i, fp), fp):
+            return True
+        for _ in range(self.MAX_KICKS):
+            slot = random.choice(self.bucket(i))
+            (fp, self.slots[slot]) = (self.slots[slot], fp)
+            if self.put(i := self.other(i, fp), fp):
+                return True
+        self.count -= 1
+        return False
+
+    def discard(self, x):
+        (fp, i) = self.locate(x)
+        for slot in (*self.bucket(i), *self.bucket(self.other(i, fp))):
+            if self.slots[slot] == fp:
+                self.slots[slot] = 0
+                self.count -= 1
+                return
+
+
+# stands in for a filter that's being rebuilt: anything might be in it
+class EverythingFilter:
+    count = nbytes = 0
+
+    def __len__(self):
+        return 0
+
+    def __contains__(self, x):
+        return True
+
+    def add(self, x):
+        return True
+
+    def discard(self, x):
+        pass
@@ -1,5 +1,6 @@
 from functools import reduce
 import enum
+import os
 import re
 
 import discord
@@ -137,6 +138,13 @@ PERMS = discord.permissions.Permissions(
 MAX_WEBHOOK_NAME_LENGTH = 80
 
 
+# pragma user_version. schema/N.sql takes the database from N - 1 to N
+SCHEMA_VERSION = 28
+# unversioned databases are assumed to have had everything up to here applied
+LEGACY_SCHEMA_VERSION = 24
+SCHEMA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema")
+
+
 VALID_MIME_TYPES = [
     "image/jpeg",
     "image/png",
@@ -206,6 +214,14 @@ class ProxyState(enum.IntEnum):
     active = 2
 
 
+# for REST calls, see Gestalt.Scheduler
+@enum.unique
+class Priority(enum.IntEnum):
+    critical = 0  # proxying itself
+    normal = 1
+    cosmetic = 2  # can be dropped if discord is pushing back
+
+
 @enum.unique
 class ActionType(enum.IntEnum):
     join = 0
@@ -242,12 +258,13 @@ class RuleType(enum.IntEnum):
 PK_EDIT = re.compile(PK_EDIT, re.IGNORECASE)
 BE_REGEX = re.compile(r"\\?> ?Be (.*?)\.?", re.IGNORECASE)
 # convert into dict of single opening char : regex matching all ending chars
+# (matched at an offset; it's up to the reader what comes after)
 QUOTE_REGEXES = reduce(
     dict.__or__,
     map(
         lambda tup: {
             opening: re.compile(
-                "%s([^%s]*)%s(.*)"
+                "%s([^%s]*)%s"
                 % (
                     opening,
                     "".join(tup[1]),
@@ -4,11 +4,9 @@ from datetime import timedelta
 import dataclasses as dc
 import sqlite3 as sqlite
 import asyncio
-import hashlib
 import json
 import math
 import time
-import os
 import re
 
 import discord
@@ -365,14 +363,6 @@ class ActionChange(VotableAction, _type=ActionType.change):
         if self.which not in self.cols:
             raise ValueError(self.which)
 
-    def save_avatar(self, bot, image):
-        # hashlib and i/o release GIL
-        digest = hashlib.sha1(image).hexdigest()
-        name = "%s_%s.%s" % (self.mask, digest, self.ext)
-        with open(bot.hosted_avatar_local_path(name), "wb") as f:
-            f.write(image)
-        return name
-
     async def execute(self, bot):
         if self.which == "avatar":
             if not (
@@ -383,17 +373,11 @@ class ActionChange(VotableAction, _type=ActionType.change):
                 return
             prev = prev[0]
             if self.ext:
-                try:
-                    async with bot.session.get(self.value) as r:
-                        if r.status != 200:
-                            return
-                        image = await r.read()
-                except:
+                if not (name := await bot.download_avatar(self.value)):
+                    bot.log("%i: download failed or not an image", self.message)
                     return
-                self.value = await asyncio.to_thread(self.save_avatar, bot, image)
+                self.value = name
                 bot.log("%i: saved %s", self.message, self.value)
-            if self.value != prev and bot.is_hosted_avatar(prev):
-                os.remove(bot.hosted_avatar_local_path(prev))
         bot.execute(
             {
                 "nick": "update masks set nick = ? where maskid = ?",
@@ -402,6 +386,8 @@ class ActionChange(VotableAction, _type=ActionType.change):
             }[self.which],
             (self.value, self.mask),
         )
+        if self.which == "avatar" and self.value != prev:
+            bot.release_avatar(prev)
 
 
 @dc.dataclass
@@ -673,14 +659,17 @@ class Vote(metaclass=serializable):
     def complete(self):
         raise NotImplementedError()
 
+    # limited by avatar changes; cdn link expiry w/some padding
+    @property
+    def expires(self):
+        return discord.utils.snowflake_time(self.context.message) + timedelta(
+            days=1, seconds=-10
+        )
+
     # is vote no longer accepting interactions due to being complete OR expired
     @property
     def inactive(self):
-        return self.complete or (
-            discord.utils.utcnow() - discord.utils.snowflake_time(self.context.message)
-            # limited by avatar changes; cdn link expiry w/some padding
-            > timedelta(days=1, seconds=-10)
-        )
+        return self.complete or discord.utils.utcnow() > self.expires
 
     async def on_done(self, bot):
         raise NotImplementedError()
@@ -756,7 +745,7 @@ class VoteCreate(VoteConfirm, _type=VoteType.create):
 
     async def on_done(self, bot):
         bot.execute(
-            "insert into masks values " "(?, ?, NULL, NULL, NULL, ?, 0, 0)",
+            "insert into masks values " "(?, ?, NULL, NULL, NULL, ?, 0, 0, NULL)",
             ((maskid := bot.gen_id()), self.name, time.time()),
         )
         user = self.get_user()
@@ -997,15 +986,24 @@ async def respond(interaction, content):
     )
 
 
+# see Vote.to_json()
+VOTE_GUILD = "json_extract(state, '$.data.context.guild')"
+
+
 class GestaltVoting:
+    # other processes may be running other shards, don't touch their votes
     def load(self):
         self.votes = {
             row["msgid"]: Vote.from_json(row["state"])
-            for row in self.fetchall("select * from votes")
+            for row in self.fetchall(
+                "select * from votes where owns_guild(%s)" % VOTE_GUILD
+            )
         }
+        for msgid, vote in self.votes.items():
+            self.expire_vote_at(msgid, vote)
 
     def save(self):
-        self.execute("delete from votes")
+        self.execute("delete from votes where owns_guild(%s)" % VOTE_GUILD)
         self.cur.executemany(
             "insert into votes values (?, ?)",
             ((msg, vote.to_json()) for msg, vote in self.votes.items()),
@@ -1051,6 +1049,28 @@ class GestaltVoting:
             if channel.guild:
                 self.mkhistory(msg, vote.context.initiator)
             self.votes[msg.id] = vote
+            self.expire_vote_at(msg.id, vote)
+
+    def expire_vote_at(self, msgid, vote):
+        if vote.context.message:
+            self.expiry.add(
+                msgid, vote.expires.timestamp(), partial(self.expire_vote, msgid)
+            )
+
+    # turn the buttons off, instead of leaving them to say it's expired
+    async def expire_vote(self, msgid):
+        if not (vote := self.votes.pop(msgid, None)):
+            return
+        chanid = vote.context.channel
+        try:
+            channel = self.get_channel(chanid) or await self.fetch_channel(chanid)
+            await self.scheduler.run(
+                Priority.cosmetic,
+                channel.get_partial_message(msgid).edit(view=vote.view(True)),
+                droppable=False,
+            )
+        except discord.HTTPException:
+            pass
 
     def is_mask_in(self, maskid, guildid):
         return bool(
@@ -1106,6 +1126,7 @@ class GestaltVoting:
         coro = vote.on_interaction(interaction, self)
         if vote.complete:
             del self.votes[msgid]
+            self.expiry.cancel(msgid)
             await vote.on_done(self)
         await coro
 
@@ -1,13 +1,19 @@
 #!/usr/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from collections import defaultdict
-from functools import reduce
+from collections import defaultdict, namedtuple, OrderedDict, Counter, deque
+from datetime import timedelta
+from functools import reduce, partial
+from itertools import chain
 import sqlite3 as sqlite
+import itertools
+import threading
 import asyncio
+import logging
 import random
+import heapq
 import signal
-import math
 import time
 import sys
 import os
@@ -19,18 +25,80 @@ import discord
 
 from defs import *
 import commands
+import backfill
+import cuckoo
+import avatars
 import auth
 import gesp
 
 
-class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
-    def __init__(self, *, dbfile):
-        super().__init__(intents=INTENTS)
+class Gestalt(
+    discord.AutoShardedClient,
+    commands.GestaltCommands,
+    gesp.GestaltVoting,
+    avatars.GestaltAvatars,
+    backfill.GestaltBackfill,
+):
+    # shard_ids=None means this process runs every shard
+    def __init__(self, *, dbfile, shard_ids=None, shard_count=None):
+        super().__init__(intents=INTENTS, shard_ids=shard_ids, shard_count=shard_count)
 
         sqlite.register_adapter(type(CLEAR), lambda _: None)
         self.conn = sqlite.connect(dbfile)
         self.conn.row_factory = sqlite.Row
+        self.conn.create_function("owns_guild", 1, self.owns_guild, deterministic=True)
         self.cur = self.conn.cursor()
+        # see get_proxy_match()
+        self.proxy_cur = self.conn.cursor()
+        self.proxy_cur.row_factory = lambda _, row: self.ProxyRecord(*row)
+        if shard_ids is not None:
+            # other processes share the database, so let them read while we write
+            self.execute("pragma journal_mode = wal")
+        self.migrate()
+
+        self.active_pages = {}  # msgid: Pages
+        self.shard_caches = defaultdict(self.ShardCache)
+        self.sequencer = self.Sequencer()
+        self.delete_queues = {}  # chanid: [message], see delete_original()
+        self.delete_tasks = {}  # chanid: task deleting that queue
+        # msgcount changes since the last commit, by proxkey and by maskkey
+        # (most messages would otherwise be two extra row updates)
+        self.proxy_msgcounts = Counter()
+        self.mask_msgcounts = Counter()
+        self.autoproxy_cache = self.AutoproxyCache(self)
+        # history rows not written yet, see get_history()
+        self.pending_history = {}  # msgid: row
+        # almost all reactions and deletes aren't ours. skip the db for those
+        self.build_history_filter()
+        self.history_filter_task = None  # see rebuild_history_filter()
+        self.ignore_delete_cache = self.RecentIds(
+            IGNORE_DELETE_WINDOW, IGNORE_DELETE_GENERATIONS, IGNORE_DELETE_CAP
+        )
+        # image decoding is cpu-heavy, keep it off the event loop
+        self.avatar_pool = ThreadPoolExecutor(
+            max_workers=AVATAR_WORKERS, thread_name_prefix="avatar"
+        )
+        self.avatar_runner = None
+        self.storing_avatars = Counter()  # name: downloads placing it, see avatars.py
+        # placing a file and collecting it can't overlap
+        self.avatar_files_lock = threading.Lock()
+        self.stats = Counter()  # for gs;stats
+        self.scheduler = self.Scheduler(self.stats)
+        self.throttles = {
+            (kind, scope): self.Throttle(rate, burst, THROTTLE_CAP)
+            for kind, scopes in THROTTLES.items()
+            for scope, (rate, burst) in scopes.items()
+        }
+        self.throttle_warned = set()  # (kind, authid), told once until it passes
+        self.expiry = self.Expiry()
+        # discord.py handles 429s itself, but only tells the logs about them
+        for logger in ("discord.http", "discord.webhook.async_"):
+            logging.getLogger(logger).addFilter(self.scheduler.on_log)
+        self.load()
+
+    # the current schema, for new databases. old ones get there with migrate()
+    # add schema/N.sql and bump SCHEMA_VERSION when changing anything here
+    def create_schema(self):
         self.execute(
             "create table if not exists meta("
             "singleton integer unique,"
@@ -60,8 +128,10 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             "guildid integer,"
             "authid integer,"
             "otherid integer,"
-            "proxid text,"
-            "maskid text)"
+            "proxid text,"  # only for rows from before proxkey
+            "maskid text,"  # same, or if it isn't a mask (pkswap member id)
+            "proxkey integer,"
+            "maskkey integer)"
         )
         # for gs;edit
         # to quickly find the last message sent by a user in a channel
@@ -74,11 +144,11 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             "create table if not exists members("
             "userid integer,"
             "guildid integer,"
-            "proxid text collate nocase,"  # same collation for joining
+            "proxkey integer,"
             "latch integer,"  # 0 = off, -1 = on. positive values reserved
             "become real,"  # 1.0 except in Become mode
             "primary key(userid, guildid),"
-            "check(proxid not null or become >= 1.0))"
+            "check(proxkey not null or become >= 1.0))"
         )
         self.execute(
             "create table if not exists users("
@@ -96,7 +166,7 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         )
         self.execute(
             "create table if not exists proxies("
-            "proxid text primary key collate nocase,"  # of form 'abcde'
+            "proxid text unique collate nocase,"  # of form 'abcde'
             "cmdname text collate nocase,"
             "userid integer,"
             "prefix text,"
@@ -108,6 +178,8 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             "state integer,"  # see enum ProxyState
             "created integer,"  # unix timestamp
             "msgcount integer,"
+            # internal. never reused, unlike plain rowids
+            "proxkey integer primary key autoincrement,"
             "unique(maskid, userid))"
         )
         # for swaps/pkswaps
@@ -129,14 +201,15 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         )
         self.execute(
             "create table if not exists masks("
-            "maskid text primary key collate nocase,"
+            "maskid text unique collate nocase,"
             "nick text,"
             "avatar text,"
             "color text,"
             "rules text,"
             "created integer,"
             "members integer,"
-            "msgcount integer)"
+            "msgcount integer,"
+            "maskkey integer primary key autoincrement)"
         )
         self.execute(
             "create trigger if not exists mask_proxy_create "
@@ -159,32 +232,33 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             "delete from masks where maskid = new.maskid;"
             "end"
         )
+        # refcounts of hosted avatar files, see avatars.py
         self.execute(
-            "create trigger if not exists mask_history_create "
-            "after insert on history when new.maskid not null begin "
-            "update masks set msgcount = msgcount + 1 "
-            "where maskid = new.maskid;"
-            "end"
+            "create table if not exists avatars("
+            "avatar text primary key,"  # file name, from content hash
+            "refs integer)"
         )
         self.execute(
-            "create trigger if not exists mask_history_delete "
-            "after delete on history when old.maskid not null begin "
-            "update masks set msgcount = msgcount - 1 "
-            "where maskid = old.maskid;"
+            "create trigger if not exists mask_avatar_create "
+            "after insert on masks when new.avatar not null begin "
+            "update avatars set refs = refs + 1 "
+            "where avatar = new.avatar;"
             "end"
         )
         self.execute(
-            "create trigger if not exists history_create "
-            "after insert on history when new.proxid not null begin "
-            "update proxies set msgcount = msgcount + 1 "
-            "where proxid = new.proxid;"
+            "create trigger if not exists mask_avatar_update "
+            "after update of avatar on masks begin "
+            "update avatars set refs = refs + 1 "
+            "where avatar = new.avatar;"
+            "update avatars set refs = refs - 1 "
+            "where avatar = old.avatar;"
             "end"
         )
         self.execute(
-            "create trigger if not exists history_delete "
-            "after delete on history when old.proxid not null begin "
-            "update proxies set msgcount = msgcount - 1 "
-            "where proxid = old.proxid;"
+            "create trigger if not exists mask_avatar_delete "
+            "after delete on masks when old.avatar not null begin "
+            "update avatars set refs = refs - 1 "
+            "where avatar = old.avatar;"
             "end"
         )
         self.execute(
@@ -195,24 +269,77 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         self.execute(
             "create table if not exists taken(" "id text unique collate nocase" ")"
         )
+        # see backfill.py
+        self.execute(
+            "create table if not exists backfills("
+            "name text primary key,"
+            "position integer,"  # last rowid done
+            "done integer)"
+        )
 
-        self.active_pages = {}  # msgid: Pages
-        self.expected_pk_errors = {}  # chanid: message | None
-        self.last_message_cache = self.LastMessageCache()
-        self.ignore_delete_cache = set()
-        self.load()
+    def migrate(self):
+        # nothing to do on most startups
+        if (version := self.fetchone("pragma user_version")[0]) == SCHEMA_VERSION:
+            return
+        if version == 0:
+            if not self.fetchone("select 1 from sqlite_master where name = 'meta'"):
+                self.create_schema()
+                self.execute("pragma user_version = %i" % SCHEMA_VERSION)
+                self.conn.commit()
+                return
+            # from before versioning, when migrations were applied by hand
+            version = LEGACY_SCHEMA_VERSION
+            self.execute("pragma user_version = %i" % version)
+        elif version > SCHEMA_VERSION:
+            # written by a newer version of the bot. better not to touch it
+            raise RuntimeError(
+                "Database schema is version %i, but this code only knows up to %i."
+                % (version, SCHEMA_VERSION)
+            )
+        for version in range(version + 1, SCHEMA_VERSION + 1):
+            with open(os.path.join(SCHEMA_DIRECTORY, "%i.sql" % version)) as f:
+                script = f.read()
+            self.log("Applying schema/%i.sql...", version)
+            start = time.perf_counter()
+            try:
+                self.conn.executescript(
+                    "begin;\n%s;\npragma user_version = %i;\ncommit;"
+                    % (script, version)
+                )
+            except:
+                self.conn.rollback()
+                raise
+            self.log("Done in %.3fs.", time.perf_counter() - start)
 
     def __del__(self):
         self.save()
         self.log("Closing database.")
-        self.conn.commit()
+        self.commit()
         self.conn.close()
 
     # close on SIGINT, SIGTERM
     def handler(self):
         self.loop.create_task(self.close())
+        self.commit()
+
+    def commit(self):
+        self.flush_history()
+        self.cur.executemany(
+            "update proxies set msgcount = msgcount + ? where proxkey = ?",
+            ((count, key) for key, count in self.proxy_msgcounts.items()),
+        )
+        self.cur.executemany(
+            "update masks set msgcount = msgcount + ? where maskkey = ?",
+            ((count, key) for key, count in self.mask_msgcounts.items()),
+        )
+        self.proxy_msgcounts.clear()
+        self.mask_msgcounts.clear()
+        self.autoproxy_cache.flush()
         self.conn.commit()
 
+    async def commit_loop(self):
+        self.commit()
+
     def log(self, text, *args):
         print(text % args, flush=True)
 
@@ -245,6 +372,15 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         # this could go in __init__ but that would break testing
         # also, this is a decorator, but that would break testing too
         tasks.loop(seconds=CLEANUP_TIMEOUT)(self.cleanup).start()
+        self.expiry_task = self.loop.create_task(self.expiry_loop())
+        if self.shard_ids is not None:
+            # don't hold the write lock for long, other processes are waiting
+            tasks.loop(seconds=COMMIT_TIMEOUT)(self.commit_loop).start()
+        if AVATAR_SERVER_PORT is not None:
+            await self.start_avatar_server()
+        # the database is shared, so only one process needs to do this
+        if self.owns_guild(None):
+            self.backfill_task = self.loop.create_task(self.run_backfills())
 
     async def update_status(self):
         motd = self.fetchone("select motd from meta")["motd"]
@@ -268,23 +404,28 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             self.admins = [info.owner.id]
         await self.update_status()
 
+    async def on_shard_ready(self, shard_id):
+        # new session, not resumed. events may have been missed in the meantime
+        self.log("Shard %i ready.", shard_id)
+        self.shard_caches.pop(shard_id, None)
+
     async def close(self):
         await self.session.close()
+        self.avatar_pool.shutdown(wait=False, cancel_futures=True)
+        if self.avatar_runner:
+            await self.avatar_runner.cleanup()
         await super().close()
 
     async def cleanup(self):
-        self.conn.commit()
-        self.ignore_delete_cache.clear()
-        self.votes = {
-            msgid: vote for msgid, vote in self.votes.items() if not vote.inactive
-        }
+        self.commit()
+        self.autoproxy_cache.clear()
+        for throttle in self.throttles.values():
+            throttle.prune()
+        self.throttle_warned.clear()
 
-        for pages in list(filter(self.Pages.is_expired, self.active_pages.values())):
-            try:
-                await pages.deactivate(self)
-            except:
-                pass
-            del self.active_pages[pages.message.id]
+        # shared between processes, only needs to be done by one of them
+        if AVATAR_URL_BASE and self.owns_guild(None):
+            await self.reconcile_avatars()
 
     def can_use_gestalt(self, member):
         if member.bot:
@@ -293,10 +434,93 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             return any(member.get_role(roleid) for roleid in ALLOWED_BOT_ROLES)
         return True
 
+    # everything that the bot does on its own goes through here
+    # so that when discord is pushing back, proxying is what gets through
+    class Scheduler:
+        def __init__(self, stats):
+            self.stats = stats
+            # a lane per priority, each with its own slots (None = no limit)
+            self.slots = list(REST_CONCURRENCY)
+            self.waiting = [deque() for _ in REST_CONCURRENCY]  # futures, in order
+            # monotonic time until 429s are expected to stop, by channel or webhook
+            # (None is for everything, from a global rate limit)
+            self.backoff = {}
+
+        def backing_off(self, scope):
+            now = time.monotonic()
+            return now < self.backoff.get(None, 0) or now < self.backoff.get(scope, 0)
+
+        # scope is the channel that the call is in, for 429s that only apply there
+        async def run(self, priority, coro, droppable=True, scope=None):
+            waiting = self.waiting[priority]
+            if (
+                droppable
+                and priority == Priority.cosmetic
+                and (len(waiting) >= REST_BACKLOG or self.backing_off(scope))
+            ):
+                coro.close()
+                self.stats["rest calls dropped"] += 1
+                return False  # none of the calls we make return this
+            if self.slots[priority] is None:
+                return await coro
+            if self.slots[priority]:
+                self.slots[priority] -= 1
+            else:
+                turn = asyncio.get_running_loop().create_future()
+                waiting.append(turn)
+                try:
+                    await turn
+                except asyncio.CancelledError:
+                    # the slot was already handed over, so pass it on
+                    if turn.done() and not turn.cancelled():
+                        self.release(priority)
+                    raise
+            try:
+                return await coro
+            finally:
+                self.release(priority)
+
+        def release(self, priority):
+            waiting = self.waiting[priority]
+            while waiting:
+                if not (turn := waiting.popleft()).done():
+                    turn.set_result(None)
+                    return
+            self.slots[priority] += 1
+
+        # attached to the loggers of both discord.http and webhooks
+        def on_log(self, record):
+            if not record.args:
+                return True
+            if record.msg.startswith("We are being rate limited."):
+                (method, url, retry_after) = record.args
+                path = url.split("/api/v10")[-1]
+                # one route for all channels, messages, emojis, etc
+                route = re.sub(r"/[0-9]{15,}", "/:id", path)
+                route = re.sub(r"/reactions/[^/]+", "/reactions/:emoji", route)
+                self.stats["429 %s %s" % (method, route)] += 1
+                if not (match := re.match(r"/channels/([0-9]+)", path)):
+                    return True
+                scope = int(match[1])
+            elif record.msg.startswith("Webhook ID %s is rate limited."):
+                # almost always a proxy being sent
+                (scope, retry_after) = record.args
+                scope = int(scope)
+                self.stats["429 webhook"] += 1
+            elif record.msg.startswith("Global rate limit has been hit."):
+                ((retry_after,), scope) = (record.args, None)
+                self.stats["429 global"] += 1
+            else:
+                return True
+            now = time.monotonic()
+            self.backoff = {k: v for k, v in self.backoff.items() if v > now}
+            self.backoff[scope] = max(self.backoff.get(scope, 0), now + retry_after)
+            return True
+
     async def try_delete(self, message, delay=None):
         if self.has_perm(message.channel, manage_messages=True):
             try:
-                await message.delete(delay=delay)
+                await self.scheduler.run(Priority.critical, message.delete(delay=delay))
             except discord.errors.NotFound:
                 # task failed successfully
                 # this might indicate a conflict with another proxy bot
@@ -306,157 +530,507 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
                 pass
             return True
 
-    async def try_add_reaction(self, message, reaction):
+    # originals pile up while a delete is in progress, then go in one request
+    # that's done in the background, so the proxy doesn't wait on someone else's
+    async def delete_original(self, message, delay=None):
+        if delay:
+            await asyncio.sleep(delay)
+        channel = message.channel
+        if not self.has_perm(channel, manage_messages=True):
+            return
+        self.delete_queues.setdefault(channel.id, []).append(message)
+        if channel.id not in self.delete_tasks:
+            self.delete_tasks[channel.id] = self.loop.create_task(
+                self.drain_deletes(channel)
+            )
+
+    async def drain_deletes(self, channel):
+        try:
+            while batch := self.delete_queues.pop(channel.id, None):
+                await self.delete_batch(channel, batch)
+        finally:
+            del self.delete_tasks[channel.id]
+
+    async def delete_batch(self, channel, messages):
+        # bulk deletes don't work on messages older than two weeks
+        cutoff = discord.utils.time_snowflake(
+            discord.utils.utcnow() - timedelta(days=14, minutes=-1)
+        )
+        single = [message for message in messages if message.id < cutoff]
+        bulk = [message for message in messages if message.id >= cutoff]
+        for i in range(0, len(bulk), 100):
+            if len(chunk := bulk[i : i + 100]) == 1:
+                single += chunk
+                continue
+            try:
+                await self.scheduler.run(
+                    Priority.critical, channel.delete_messages(chunk)
+                )
+                self.stats["bulk deletes"] += 1
+            except discord.HTTPException:
+                single += chunk  # e.g. one of them was already deleted
+        for message in single:
+            await self.try_delete(message)
+
+    async def try_add_reaction(self, message, reaction, priority=Priority.cosmetic):
         if self.has_perm(
             message.channel, add_reactions=True, read_message_history=True
         ):
             try:
-                await message.add_reaction(reaction)
-                return True
+                return (
+                    await self.scheduler.run(
+                        priority,
+                        message.add_reaction(reaction),
+                        scope=message.channel.id,
+                    )
+                    is not False
+                )
             except discord.errors.NotFound:
                 pass
 
     async def mark_success(self, message, success):
         await self.try_add_reaction(message, REACT_CONFIRM if success else REACT_DELETE)
 
-    class LastMessageCache(defaultdict):
+    def shard_of(self, guildid):
+        # dms are always on shard 0
+        return (guildid >> 22) % (self.shard_count or 1) if guildid else 0
+
+    def owns_guild(self, guildid):
+        return self.shard_ids is None or self.shard_of(guildid) in self.shard_ids
+
+    # state built up from gateway events, so it's only good for one session
+    class ShardCache:
         def __init__(self):
-            super().__init__(dict)
+            self.last_message = Gestalt.LastMessageCache()
+            self.expected_pk_errors = {}  # chanid: message | None
+
+    def shard_cache(self, guild):
+        return self.shard_caches[self.shard_of(guild and guild.id)]
+
+    # just what should_pad() needs, not the whole message and proxy
+    class LastMessage:
+        __slots__ = ("nick", "proxid", "flags")
+
+        def __init__(self, nick, proxid, flags):
+            (self.nick, self.proxid, self.flags) = (nick, proxid, flags)
+
+    # channels are evicted least recently proxied in first
+    class LastMessageCache(OrderedDict):
+        def __init__(self):
+            super().__init__()
+            self.size = 0  # total messages, across all channels
 
         def insert(self, message, proxy):
-            channel = self[message.channel.id]
+            if (chanid := message.channel.id) in self:
+                self.move_to_end(chanid)
+            channel = self.setdefault(chanid, {})
             if len(channel) >= LAST_MESSAGE_CACHE_SIZE:
                 channel.pop(next(iter(channel)))
-            channel[message.id] = (message, proxy)
+                self.size -= 1
+            channel[message.id] = Gestalt.LastMessage(
+                message.author.display_name, proxy["proxid"], proxy["flags"]
+            )
+            self.size += 1
+            while self.size > LAST_MESSAGE_CACHE_MAX:
+                self.size -= len(self.popitem(last=False)[1])
 
         def delete(self, event):
-            self[event.channel_id].pop(event.message_id, None)
+            if (channel := self.get(event.channel_id)) is None:
+                return
+            if channel.pop(event.message_id, None):
+                self.size -= 1
+                if not channel:
+                    del self[event.channel_id]
 
         def last(self, channel):
-            if cache := self[channel.id]:
+            if cache := self.get(channel.id):
                 return cache[next(reversed(cache))]
 
+    # a set that forgets things after a while, one generation at a time
+    class RecentIds:
+        def __init__(self, window, generations, cap, clock=time.monotonic):
+            self.generations = deque([set()], maxlen=generations)
+            (self.span, self.limit) = (window / generations, cap // generations)
+            self.clock = clock
+            self.started = clock()
+
+        def __contains__(self, x):
+            return any(x in generation for generation in self.generations)
+
+        def __len__(self):
+            return sum(map(len, self.generations))
+
+        def add(self, x):
+            if (
+                self.clock() - self.started >= self.span
+                or len(self.generations[-1]) >= self.limit
+            ):
+                # the oldest one falls off the other end
+                self.generations.append(set())
+                self.started = self.clock()
+            self.generations[-1].add(x)
+
+        def discard(self, x):
+            for generation in self.generations:
+                generation.discard(x)
+
+    # token buckets, one per key. a key that's never been seen has a full one
+    class Throttle:
+        def __init__(self, rate, burst, cap, clock=time.monotonic):
+            (self.rate, self.burst, self.cap) = (rate, burst, cap)
+            self.clock = clock
+            self.buckets = {}  # key: (tokens, when), oldest first
+
+        def __len__(self):
+            return len(self.buckets)
+
+        def level(self, key, now):
+            (tokens, when) = self.buckets.get(key, (self.burst, now))
+            return min(self.burst, tokens + (now - when) * self.rate)
+
+        # seconds until key has a token to spare
+        def wait(self, key):
+            return max(0, (1 - self.level(key, self.clock())) / self.rate)
+
+        # can go negative, which is how a queued message holds its place
+        def take(self, key):
+            now = self.clock()
+            tokens = self.level(key, now) - 1
+            self.buckets.pop(key, None)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.cap:
+                self.prune()
+                # everyone's busy. the least recently seen get a fresh start
+                while len(self.buckets) > self.cap:
+                    del self.buckets[next(iter(self.buckets))]
+
+        # a full bucket is the same as no bucket at all
+        def prune(self):
+            now = self.clock()
+            self.buckets = {
+                key: (tokens, when)
+                for key, (tokens, when) in self.buckets.items()
+                if tokens + (now - when) * self.rate < self.burst
+            }
+
+    # deadlines for votes and pages, so they end when they expire
+    # rather than whenever cleanup gets around to looking at them
+    class Expiry:
+        def __init__(self):
+            self.heap = []  # (when, seq, key), possibly stale. see due
+            self.due = {}  # key: (when, seq, callback)
+            self.seq = itertools.count()
+            self.wake = asyncio.Event()
+
+        def __len__(self):
+            return len(self.due)
+
+        # when is a timestamp. replaces any deadline the key already had
+        def add(self, key, when, callback):
+            self.due[key] = (when, seq := next(self.seq), callback)
+            if not self.heap or when < self.heap[0][0]:
+                self.wake.set()
+            heapq.heappush(self.heap, (when, seq, key))
+            # cancelled ones are only dropped when they come up; don't let them pile
+            if len(self.heap) > 2 * len(self.due) + 64:
+                self.heap = [(w, s, k) for k, (w, s, _) in self.due.items()]
+                heapq.heapify(self.heap)
+
+        def cancel(self, key):
+            self.due.pop(key, None)
+
+        def pop_due(self, now):
+            callbacks = []
+            while self.heap and self.heap[0][0] <= now:
+                (when, seq, key) = heapq.heappop(self.heap)
+                if self.due.get(key, (0, None))[1] == seq:
+                    callbacks.append(self.due.pop(key)[2])
+            return callbacks
+
+        # seconds until something is due, or None if nothing is
+        def delay(self, now):
+            return max(0, self.heap[0][0] - now) if self.heap else None
+
+    async def expire_due(self):
+        due = self.expiry.pop_due(discord.utils.utcnow().timestamp())
+        # the edits go through the scheduler anyway, but don't flood it either
+        for i in range(0, len(due), EXPIRY_CONCURRENCY):
+            await asyncio.gather(
+                *(callback() for callback in due[i : i + EXPIRY_CONCURRENCY]),
+                return_exceptions=True,
+            )
+
+    async def expiry_loop(self):
+        while True:
+            self.expiry.wake.clear()
+            try:
+                await asyncio.wait_for(
+                    self.expiry.wake.wait(),
+                    self.expiry.delay(discord.utils.utcnow().timestamp()),
+                )
+            except asyncio.TimeoutError:
+                pass
+            await self.expire_due()
+
     @asynccontextmanager
     async def in_progress(self, message):
+        # usually it's done before anyone would notice, so don't bother then
+        adding = None
+
+        def show():
+            nonlocal adding
+            adding = self.loop.create_task(self.try_add_reaction(message, REACT_WAIT))
+
+        timer = self.loop.call_later(PROGRESS_DELAY, show)
         try:
-            await self.try_add_reaction(message, REACT_WAIT)
             yield
         finally:
-            try:
-                await message.remove_reaction(REACT_WAIT, self.user)
-            except discord.errors.NotFound:
-                pass
+            timer.cancel()
+            if adding and await adding:
+                try:
+                    # it'd look like we were stuck forever, so this one has to go
+                    await self.scheduler.run(
+                        Priority.cosmetic,
+                        message.remove_reaction(REACT_WAIT, self.user),
+                        droppable=False,
+                    )
+                except discord.errors.NotFound:
+                    pass
 
     async def send(
-        self, channel, content="", plain="", embeds=[], view=None, reference=None
+        self,
+        channel,
+        content="",
+        plain="",
+        embeds=[],
+        view=None,
+        reference=None,
+        priority=Priority.normal,
     ):
         if self.has_perm(channel, send_messages=True):
             try:
-                return await channel.send(
-                    plain,
-                    embeds=(
-                        ([discord.Embed(description=content)] if content else [])
-                        + embeds
+                return await self.scheduler.run(
+                    priority,
+                    channel.send(
+                        plain,
+                        embeds=(
+                            ([discord.Embed(description=content)] if content else [])
+                            + embeds
+                        ),
+                        view=view,
+                        reference=reference,
                     ),
-                    view=view,
-                    reference=reference,
+                    scope=channel.id,
                 )
             except discord.HTTPException as e:
                 if reference and e.code == 50035:
                     # Invalid Form Body\nIn message_reference: Unknown message
                     # (reference has probably been deleted; retry)
-                    return await self.send(channel, content, plain, embeds, view)
+                    return await self.send(
+                        channel, content, plain, embeds, view, priority=priority
+                    )
                 raise
 
-    async def reply(self, replyto, content="", plain="", embeds=[]):
-        msg = await self.send(replyto.channel, content, plain, embeds)
+    async def reply(self, replyto, content="", plain="", embeds=[], view=None):
+        msg = await self.send(replyto.channel, content, plain, embeds, view)
         # insert into history to allow initiator to delete message if desired
         if msg and replyto.guild:
             await self.try_add_reaction(msg, REACT_DELETE)
             self.mkhistory(msg, replyto.author.id)
         return msg
 
+    # the buttons carry everything needed to show their page, even after restarts
+    # custom id is pages:authid:source:arg:index:control, see page_source()
+    # pages are only built as they're viewed, and only a few are kept around
     class Pages:
+        # where each one goes from index i of n (None if we haven't got there yet)
         CONTROLS = {
-            REACT_FIRST: -math.inf,
-            REACT_PREV: -1,
-            REACT_NEXT: 1,
-            REACT_LAST: math.inf,
+            "first": (REACT_FIRST, lambda i, n: 0),
+            "prev": (REACT_PREV, lambda i, n: max(i - 1, 0)),
+            "next": (
+                REACT_NEXT,
+                lambda i, n: i + 1 if n is None else min(i + 1, n - 1),
+            ),
+            # -1 = wherever the end turns out to be
+            "last": (REACT_LAST, lambda i, n: -1 if n is None else n - 1),
         }
 
-        def __init__(self, message, embed, pages):
-            (self.message, self.embed, self.pages) = (message, embed, pages)
-            self.index = 0
+        def __init__(self, embed, lines, rebuild, authid, source, limit=25):
+            (self.embed, self.rebuild, self.limit) = (embed, rebuild, limit)
+            (self.authid, self.source) = (authid, source)
+            self.message = None
+            self.restart(lines)
+
+        # rebuild() gives the lines again, for going back to pages we let go of
+        def restart(self, lines=None):
+            lines = self.rebuild() if lines is None else lines
+            self.pager = self.paginate(lines, self.limit)
+            self.cache = OrderedDict()  # index: page, most recently used last
+            self.built = 0
+            self.count = None
+
+        def pull(self):
+            try:
+                self.cache[self.built] = next(self.pager)
+            except StopIteration:
+                self.count = self.built
+                return False
+            self.built += 1
+            # at least the page asked for and the one past it, see page()
+            while len(self.cache) > max(PAGES_CACHED, 2):
+                self.cache.popitem(last=False)
+            return True
 
+        # returns (index, page), clamped. always builds one ahead to know if it's last
+        def page(self, index):
+            if index < 0:
+                while self.pull():
+                    pass
+                index = self.count - 1
+            while self.count is None and self.built <= index + 1 and self.pull():
+                pass
+            if self.count is not None:
+                index = min(index, self.count - 1)
+            if index not in self.cache:
+                self.restart()
+                return self.page(index)
+            self.cache.move_to_end(index)
+            return (index, self.cache[index])
+
+        # running sizes, so it doesn't add up the whole page for every line
         @staticmethod
-        def make_page(embed, pages, index=0):
-            page = embed.copy()
-            page.description = pages[index]
-            if len(pages) > 1:
-                page.title = f"[{index+1}/{len(pages)}] {page.title or ''}"
-            return page
-
-        @classmethod
-        async def reply(cls, bot, replyto, embed, lines, limit):
-            pages = [[]]
+        def paginate(lines, limit=25):
+            (page, size) = ([], 0)
             for line in lines:
-                if (
-                    len(pages[-1]) == limit
-                    or sum(map(len, pages[-1])) + len(line) > 2048
-                ):
-                    pages.append([])
-                pages[-1].append(line)
-            pages = list(map("\n".join, pages))
+                if len(page) == limit or size + len(line) > 2048:
+                    yield "\n".join(page)
+                    (page, size) = ([], 0)
+                page.append(line)
+                size += len(line)
+            yield "\n".join(page)
+
+        def make_page(self, index):
+            (index, text) = self.page(index)
+            page = self.embed.copy()
+            page.description = text
+            if self.count != 1:
+                page.title = f"[{index+1}/{self.count or '?'}] {page.title or ''}"
+            return (index, page)
+
+        def view(self, index=0, disabled=False):
+            view = discord.ui.View()
+            for name, (emoji, goto) in self.CONTROLS.items():
+                target = goto(index, self.count)
+                view.add_item(
+                    discord.ui.Button(
+                        custom_id="pages:%i:%s:%s:%i:%s"
+                        % (self.authid, *self.source, target, name),
+                        emoji=emoji,
+                        style=discord.ButtonStyle.grey,
+                        disabled=disabled or target == index,
+                    )
+                )
+            return view
+
+        @staticmethod
+        def rebuilder(bot, user, guild, source):
+            (name, arg) = source
+            return lambda: bot.page_source(name)(user, guild, arg)[1]
 
+        @classmethod
+        async def reply(cls, bot, replyto, embed, lines, limit, source):
             if replyto.author.bot:
-                for index in range(len(pages)):
-                    await bot.reply(
-                        replyto, embeds=[cls.make_page(embed, pages, index)]
-                    )
+                pages = list(cls.paginate(lines, limit))
+                for index, text in enumerate(pages):
+                    page = embed.copy()
+                    page.description = text
+                    if len(pages) > 1:
+                        page.title = f"[{index+1}/{len(pages)}] {page.title or ''}"
+                    await bot.reply(replyto, embeds=[page])
                 return
 
+            self = cls(
+                embed,
+                lines,
+                cls.rebuilder(bot, replyto.author, replyto.guild, source),
+                replyto.author.id,
+                source,
+                limit,
+            )
+            (_, page) = self.make_page(0)
             if (
-                msg := await bot.reply(replyto, embeds=[cls.make_page(embed, pages)])
-            ) and len(pages) > 1:
-                for control in cls.CONTROLS.keys():
-                    await bot.try_add_reaction(msg, control)
-                return cls(msg, embed, pages)
+                msg := await bot.reply(
+                    replyto,
+                    embeds=[page],
+                    view=self.view() if self.count != 1 else None,
+                )
+            ) and self.count != 1:
+                self.message = msg
+                return self
 
-        def is_expired(self):
-            return (
-                discord.utils.utcnow() - self.message.created_at
-            ).total_seconds() > TIMEOUT_PAGES
-
-        async def on_control(self, bot, reaction, reactor):
-            if delta := self.CONTROLS.get(reaction):
-                index = max(0, min(self.index + delta, len(self.pages) - 1))
-                if self.index != index:
-                    try:
-                        await self.message.edit(
-                            embeds=[self.make_page(self.embed, self.pages, index)]
-                        )
-                        self.index = index
-                    except discord.NotFound:
-                        return
-                if reactor and bot.has_perm(self.message.channel, manage_messages=True):
-                    try:
-                        await self.message.remove_reaction(reaction, reactor)
-                    except discord.NotFound:
-                        pass
+        @classmethod
+        async def on_interaction(cls, bot, interaction):
+            (authid, name, arg, index) = interaction.data["custom_id"].split(":")[1:5]
+            if interaction.user.id != int(authid):
+                return await gesp.respond(interaction, "These aren't your pages.")
+            if not (self := bot.active_pages.get(interaction.message.id)):
+                # from before a restart, so make them again
+                if not bot.page_source(name):
+                    # renamed or removed since, so there's nothing to make
+                    return await gesp.respond(interaction, "This list has expired.")
+                try:
+                    (embed, lines) = bot.page_source(name)(
+                        interaction.user, interaction.guild, arg
+                    )
+                except UserError as e:
+                    return await gesp.respond(interaction, e.args[0])
+                self = cls(
+                    embed,
+                    lines,
+                    cls.rebuilder(
+                        bot, interaction.user, interaction.guild, (name, arg)
+                    ),
+                    int(authid),
+                    (name, arg),
+                )
+                self.message = interaction.message
+                bot.activate_pages(self)
+            # one call, instead of an edit and removing the reaction
+            (index, page) = self.make_page(int(index))
+            await interaction.response.edit_message(
+                embeds=[page], view=self.view(index)
+            )
+
+        @property
+        def expires(self):
+            return self.message.created_at.timestamp() + TIMEOUT_PAGES
 
         async def deactivate(self, bot):
-            clear = self.message.guild and bot.has_perm(
-                self.message.channel, manage_messages=True
+            await bot.scheduler.run(
+                Priority.cosmetic,
+                self.message.edit(view=self.view(disabled=True)),
+                droppable=False,
             )
-            for emoji in reversed(self.CONTROLS):
-                if clear:
-                    await self.message.clear_reaction(emoji)
-                else:
-                    await self.message.remove_reaction(emoji, bot.user)
 
-    async def reply_lines(self, replyto, embed, lines, limit=25):
-        if pages := await self.Pages.reply(self, replyto, embed, lines, limit):
-            self.active_pages[pages.message.id] = pages
+    def activate_pages(self, pages):
+        self.active_pages[msgid := pages.message.id] = pages
+        self.expiry.add(msgid, pages.expires, partial(self.expire_pages, msgid))
+
+    async def expire_pages(self, msgid):
+        if pages := self.active_pages.pop(msgid, None):
+            try:
+                await pages.deactivate(self)
+            except discord.HTTPException:
+                pass
+
+    async def reply_lines(self, replyto, embed, lines, source, limit=25):
+        if pages := await self.Pages.reply(self, replyto, embed, lines, limit, source):
+            self.activate_pages(pages)
+
+    async def on_interaction(self, interaction):
+        if (interaction.data or {}).get("custom_id", "").startswith("pages:"):
+            return await self.Pages.on_interaction(self, interaction)
+        await super().on_interaction(interaction)
 
     def gen_id(self):
         while True:
@@ -484,7 +1058,7 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         if prefix is not None and self.get_tags_conflict(userid, (prefix, postfix)):
             raise UserError(ERROR_TAGS)
         self.execute(
-            "insert into proxies values " "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+            "insert into proxies values " "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, NULL)",
             (
                 proxid := self.gen_id(),
                 cmdname,
@@ -507,46 +1081,187 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         authid,
         channel=None,
         orig=None,
-        proxy={"otherid": None, "proxid": None, "maskid": None},
+        proxy={"otherid": None, "proxkey": None, "maskid": None, "maskkey": None},
     ):
         chanid = parentid = guildid = 0
         if channel:
             (chanid, guildid) = (channel.id, channel.guild.id)
             if type(channel) == discord.Thread:
                 parentid = channel.parent.id
-        self.execute(
-            "insert into history values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (
-                message.id,
-                orig,
-                chanid,
-                parentid,
-                guildid,
-                authid,
-                proxy["otherid"],
-                proxy["proxid"],
-                proxy["maskid"],
+        self.pending_history[message.id] = {
+            "msgid": message.id,
+            "origid": orig,
+            "chanid": chanid,
+            "parentid": parentid,
+            "guildid": guildid,
+            "authid": authid,
+            "otherid": proxy["otherid"],
+            "proxid": None,
+            "maskid": None if proxy["maskkey"] else proxy["maskid"],
+            "proxkey": proxy["proxkey"],
+            "maskkey": proxy["maskkey"],
+        }
+        self.count_message(proxy["proxkey"], proxy["maskkey"], 1)
+        if not self.history_filter.add(message.id):
+            # something was dropped, so until it's rebuilt, anything could be ours
+            self.history_filter = cuckoo.EverythingFilter()
+            self.history_filter_task = self.loop.create_task(
+                self.rebuild_history_filter()
+            )
+        if len(self.pending_history) >= HISTORY_BATCH:
+            self.flush_history()
+
+    def flush_history(self):
+        self.cur.executemany(
+            "insert into history values (:msgid, :origid, :chanid, :parentid, "
+            ":guildid, :authid, :otherid, :proxid, :maskid, :proxkey, :maskkey)",
+            self.pending_history.values(),
+        )
+        self.pending_history.clear()
+
+    def history_filter_capacity(self):
+        return max(
+            HISTORY_FILTER_MIN,
+            HISTORY_FILTER_HEADROOM
+            * (
+                self.fetchone("select count(*) from history")[0]
+                + len(self.pending_history)
             ),
         )
 
-    def init_member(self, member):
-        self.execute(
-            "insert or ignore into members values " "(?, ?, NULL, 0, 1.0)",
-            (member.id, member.guild.id),
+    # only done at startup. see rebuild_history_filter() for if it fills up
+    def build_history_filter(self):
+        capacity = self.history_filter_capacity()
+        while True:
+            self.history_filter = cuckoo.CuckooFilter(capacity)
+            if all(
+                map(
+                    self.history_filter.add,
+                    chain(
+                        (
+                            row[0]
+                            for row in self.conn.execute("select msgid from history")
+                        ),
+                        self.pending_history,
+                    ),
+                )
+            ):
+                return
+            capacity *= 2
+
+    # a chunk at a time, so proxying isn't held up on a big database
+    async def rebuild_history_filter(self):
+        capacity = self.history_filter_capacity()
+        while True:
+            (rebuilt, last, ok) = (cuckoo.CuckooFilter(capacity), 0, True)
+            # msgids are snowflakes, so anything flushed meanwhile is still ahead
+            while ok and (
+                rows := self.fetchall(
+                    "select msgid from history where msgid > ? order by msgid limit ?",
+                    (last, HISTORY_FILTER_CHUNK),
+                )
+            ):
+                ok = all(rebuilt.add(row[0]) for row in rows)
+                last = rows[-1][0]
+                await asyncio.sleep(0)
+            # nothing awaits between the last chunk and here
+            if ok and all(map(rebuilt.add, self.pending_history)):
+                self.history_filter = rebuilt
+                return
+            capacity *= 2
+
+    def history_filter_stats(self):
+        skipped = self.stats["history filter skips"]
+        wasted = self.stats["history filter false positives"]
+        return {
+            "history filter entries": len(self.history_filter),
+            "history filter KiB": self.history_filter.nbytes / 1024,
+            # of lookups for messages that aren't ours
+            "history filter false positive rate": wasted / ((skipped + wasted) or 1),
+        }
+
+    # check here instead of the table, to see rows that haven't been written yet
+    def get_history(self, msgid):
+        return self.pending_history.get(msgid) or self.fetchone(
+            "select * from history where msgid = ?", (msgid,)
         )
 
-    def set_autoproxy(self, member, proxid, latch=None, become=1.0):
-        self.init_member(member)
-        self.execute(
-            "update members set (proxid, become) = (?, ?) "
-            "where (userid, guildid) = (?, ?)",
-            (proxid, become, member.id, member.guild.id),
+    # for gs;edit
+    def get_last_history(self, chanid, authid):
+        # anything pending is newer than what's been written
+        return (
+            max(
+                (
+                    row["msgid"]
+                    for row in self.pending_history.values()
+                    if (row["chanid"], row["authid"]) == (chanid, authid)
+                ),
+                default=None,
+            )
+            or self.fetchone(
+                # redundant chanid != 0 to enable use of index
+                "select max(msgid) from history "
+                "where (chanid, authid) = (?, ?) and chanid != 0",
+                (chanid, authid),
+            )[0]
         )
-        if latch is not None:
-            self.execute(
-                "update members set latch = ? " "where (userid, guildid) = (?, ?)",
-                (latch, member.id, member.guild.id),
+
+    def count_message(self, proxkey, maskkey, delta):
+        if proxkey:
+            self.proxy_msgcounts[proxkey] += delta
+        if maskkey:
+            self.mask_msgcounts[maskkey] += delta
+
+    # old proxies and masks have NULL, meaning unknown
+    def get_msgcount(self, row, counts, key):
+        if row["msgcount"] is not None:
+            return row["msgcount"] + counts[row[key]]
+
+    # the members table, which changes on every message in Become mode
+    # so writes are kept here until the next commit
+    class AutoproxyCache(dict):
+        def __init__(self, bot):
+            super().__init__()
+            self.bot = bot
+            self.dirty = set()
+
+        # keyed by (userid, guildid)
+        def __missing__(self, key):
+            row = self.bot.fetchone(
+                "select proxkey as ap, latch, become from members "
+                "where (userid, guildid) = (?, ?)",
+                key,
             )
+            self[key] = dict(row) if row else {"ap": None, "latch": 0, "become": 1.0}
+            return self[key]
+
+        def set(self, key, **kwargs):
+            self[key] = self[key] | kwargs
+            self.dirty.add(key)
+
+        def flush(self):
+            self.bot.cur.executemany(
+                "insert or replace into members values (?, ?, ?, ?, ?)",
+                (
+                    key + (self[key]["ap"], self[key]["latch"], self[key]["become"])
+                    for key in self.dirty
+                ),
+            )
+            self.dirty.clear()
+
+    def get_autoproxy(self, member):
+        return self.autoproxy_cache[(member.id, member.guild.id)]
+
+    def set_autoproxy(self, member, proxid, latch=None, become=1.0):
+        # the table checks this too, but not until it's too late to tell anyone
+        if proxid is None and become < 1.0:
+            raise sqlite.IntegrityError("CHECK constraint failed: members")
+        self.autoproxy_cache.set(
+            (member.id, member.guild.id),
+            ap=proxid,
+            become=become,
+            **({} if latch is None else {"latch": latch}),
+        )
 
     def get_tags_conflict(self, userid, pair):
         (prefix, postfix) = pair
@@ -609,15 +1324,6 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             "color": proxy["color"],
         }
 
-    def is_hosted_avatar(self, url):
-        return bool(url) and not LINK_REGEX.fullmatch(url)
-
-    def hosted_avatar_local_path(self, avatar):
-        return os.path.join(AVATAR_DIRECTORY, avatar)
-
-    def hosted_avatar_fix(self, url):
-        return AVATAR_URL_BASE + url if self.is_hosted_avatar(url) else url
-
     def get_proxy_mask(self, message, proxy):
         if proxy["guildid"] != message.guild.id:
             return
@@ -684,12 +1390,16 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
     async def execute_webhook(self, channel, **kwargs):
         hook = await self.get_webhook(channel, create=True)
         try:
-            return await hook.send(wait=True, **kwargs)
+            return await self.scheduler.run(
+                Priority.critical, hook.send(wait=True, **kwargs)
+            )
         except discord.errors.NotFound:
             if await self.confirm_webhook_deletion(hook):
                 # webhook is deleted
                 hook = await self.get_webhook(channel, create=True)
-                return await hook.send(wait=True, **kwargs)
+                return await self.scheduler.run(
+                    Priority.critical, hook.send(wait=True, **kwargs)
+                )
             else:
                 self.log("False NotFound for webhook %i", hook.id)
         except discord.errors.Forbidden:
@@ -742,18 +1452,18 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             # (that was annoying)
             message.channel.get_partial_message(message.id).jump_url,
             embeds=[embed],
+            priority=Priority.cosmetic,
         )
 
     def should_pad(self, channel, proxy, present):
-        if not (last := self.last_message_cache.last(channel)):
+        if not (last := self.shard_cache(channel.guild).last_message.last(channel)):
             return False
-        (lastmsg, lastproxy) = last
-        nick = lastmsg.author.display_name
+        nick = last.nick
         if pad := nick.endswith(MERGE_PADDING):
             nick = nick.removesuffix(MERGE_PADDING)
-        if lastproxy["proxid"] == proxy["proxid"]:
+        if last.proxid == proxy["proxid"]:
             return pad
-        if (lastproxy["flags"] | proxy["flags"]) & ProxyFlags.nomerge:
+        if (last.flags | proxy["flags"]) & ProxyFlags.nomerge:
             return (nick == present["username"]) and not pad
         return False
 
@@ -764,21 +1474,62 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             trunc += "||"
         return trunc + (REPLY_CUTOFF if len(content) > length else "")
 
+    # proxied messages in a channel go out in the order the originals came in
+    # (otherwise e.g. a message with a big attachment falls behind)
+    class Sequencer:
+        def __init__(self):
+            self.last = {}  # chanid: Turn
+
+        # call before awaiting anything, so that turns are taken in order
+        def turn(self, chanid):
+            turn = Gestalt.Turn(self, chanid, self.last.get(chanid))
+            self.last[chanid] = turn
+            return turn
+
+    class Turn:
+        def __init__(self, sequencer, chanid, prev):
+            (self.sequencer, self.chanid) = (sequencer, chanid)
+            self.prev = prev and prev.future
+            self.future = asyncio.get_running_loop().create_future()
+
+        async def wait(self):
+            if self.prev and not self.prev.done():
+                try:
+                    # don't let one stuck message hold up the whole channel
+                    await asyncio.wait_for(asyncio.shield(self.prev), SEQUENCE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+
+        # the next one can go once both this one and everything before it are done
+        def done(self):
+            if self.future.done():
+                return
+            if self.prev and not self.prev.done():
+                self.prev.add_done_callback(lambda _: self.done())
+                return
+            self.future.set_result(None)
+            if self.sequencer.last.get(self.chanid) is self:
+                del self.sequencer.last[self.chanid]
+
     async def do_proxy(self, message, content, proxy, prefs):
+        turn = self.sequencer.turn(message.channel.id)
+        try:
+            return await self.do_proxy_in_turn(message, content, proxy, prefs, turn)
+        finally:
+            turn.done()
+
+    async def do_proxy_in_turn(self, message, content, proxy, prefs, turn):
         authid = message.author.id
         channel = message.channel
-        msgfiles = []
+        attachments = []
 
         if message.attachments:
             totalsize = sum((x.size for x in message.attachments))
             if totalsize <= message.guild.filesize_limit:
                 # defer downloading attachments until after other checks
-                msgfiles = (
-                    await attach.to_file(spoiler=attach.is_spoiler())
-                    for attach in message.attachments
-                )
+                attachments = message.attachments
         # avoid error when user proxies empty message with invalid attachments
-        if not any((msgfiles, content, message.poll)):
+        if not any((attachments, content, message.poll)):
             return
 
         proxtype = proxy["type"]
@@ -797,14 +1548,13 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         # now that we know the proxy can be used here, do Become mode stuff
         if proxy["become"] is not None and proxy["become"] < 1.0:
             self.set_autoproxy(
-                message.author, proxy["proxid"], become=proxy["become"] + 1 / BECOME_MAX
+                message.author,
+                proxy["proxkey"],
+                become=proxy["become"] + 1 / BECOME_MAX,
             )
             if random.random() > proxy["become"]:
                 return
 
-        if self.should_pad(message.channel, proxy, present):
-            present["username"] += MERGE_PADDING
-
         embed = None
         if message.reference:
             try:
@@ -833,7 +1583,16 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
                     icon_url=reference.author.display_avatar,
                 )
         del present["color"]
+        # all at once, and not holding up anything sent after this
+        msgfiles = await asyncio.gather(
+            *(attach.to_file(spoiler=attach.is_spoiler()) for attach in attachments)
+        )
 
+        # everything up to here can happen while earlier messages are in progress
+        await turn.wait()
+        # depends on what was sent before, so it has to wait too
+        if self.should_pad(message.channel, proxy, present):
+            present["username"] += MERGE_PADDING
         thread = channel if type(channel) == discord.Thread else discord.utils.MISSING
         am = discord.AllowedMentions(
             everyone=channel.permissions_for(message.author).mention_everyone
@@ -842,7 +1601,7 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             new := await self.execute_webhook(
                 channel,
                 thread=thread,
-                files=msgfiles and [i async for i in msgfiles],
+                files=msgfiles,
                 embed=embed,
                 allowed_mentions=am,
                 content=self.fix_content(message.author, channel, content, proxy),
@@ -851,6 +1610,8 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             )
         ):
             return
+        self.shard_cache(message.guild).last_message.insert(new, proxy)
+        turn.done()
 
         self.mkhistory(
             new,
@@ -859,12 +1620,12 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             orig=message.id,
             proxy=proxy,
         )
-        self.last_message_cache.insert(new, proxy)
 
         if not proxy["flags"] & ProxyFlags.echo:
-            await self.try_delete(
-                message, delay=DELETE_DELAY if prefs & Prefs.delay else None
-            )
+            if prefs & Prefs.delay:
+                self.loop.create_task(self.delete_original(message, DELETE_DELAY))
+            else:
+                await self.delete_original(message)
 
         await self.make_log_message(new, message, proxy)
 
@@ -890,77 +1651,89 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             return False
         return True
 
+    # a proxy, joined with its guild mask and then the user's autoproxy state
+    # built for every message, so it's a plain tuple instead of a dict
+    class ProxyRecord(
+        namedtuple(
+            "ProxyRecord",
+            "proxid cmdname userid prefix postfix type otherid maskid flags state "
+            "created msgcount proxkey guildid nick avatar color maskkey "
+            "ap latch become",  # from members
+            defaults=[None, 0, 1.0],
+        )
+    ):
+        __slots__ = ()
+
+        # so it can be used anywhere a sqlite.Row could
+        def __getitem__(self, key):
+            return getattr(self, key) if type(key) is str else super().__getitem__(key)
+
     def get_proxy_match(self, message):
         # this is where the magic happens
         # inactive proxies get matched but only to bypass the current autoproxy
         lower = message.content.lower()
-        proxies = self.fetchall(
-            "select proxies.*, guildid, nick, avatar, color from proxies "
+        proxies = self.proxy_cur.execute(
+            "select proxid, cmdname, userid, prefix, postfix, proxies.type, otherid, "
+            "proxies.maskid, flags, state, proxies.created, proxies.msgcount, "
+            "proxkey, guildid, guildmasks.nick, guildmasks.avatar, "
+            "guildmasks.color, maskkey from proxies "
             "left join guildmasks on ("
             "(guildmasks.guildid, guildmasks.maskid) = (?, proxies.maskid)"
-            ") where userid = ?",
+            ") left join masks on masks.maskid = proxies.maskid where userid = ?",
             (message.guild.id, message.author.id),
-        )
-        # this can't be a join because we need it even if there's no proxy set
-        while not (
-            member := self.fetchone(
-                "select proxid as ap, latch, become from members "
-                "where (userid, guildid) = (?, ?)",
-                (message.author.id, message.guild.id),
-            )
-        ):
-            self.init_member(message.author)
+        ).fetchall()
+        member = self.get_autoproxy(message.author)
         if not (
             tags := bool(
                 match := discord.utils.find(
                     lambda proxy: (
-                        proxy["prefix"] is not None
-                        and lower.startswith(proxy["prefix"])
-                        and lower.endswith(proxy["postfix"])
+                        proxy.prefix is not None
+                        and lower.startswith(proxy.prefix)
+                        and lower.endswith(proxy.postfix)
                     ),
                     proxies,
                 )
             )
         ):
             match = discord.utils.find(
-                lambda proxy: proxy["proxid"] == member["ap"], proxies
+                lambda proxy: proxy.proxkey == member["ap"], proxies
             )
             if match and not self.proxy_usable_in(match, message.guild):
                 self.set_autoproxy(message.author, None)
                 return
         if match:
             return (
-                dict(match) | dict(member),
+                match._replace(**member),
                 (
                     message.content[
-                        len(match["prefix"]) : -len(match["postfix"]) or None
+                        len(match.prefix) : -len(match.postfix) or None
                     ].strip()
-                    if tags and match["flags"] & ProxyFlags.keepproxy == 0
+                    if tags and match.flags & ProxyFlags.keepproxy == 0
                     else message.content
                 ),
                 tags,
             )
 
-    async def on_user_message(self, message, user):
+    # command is from read_command(), already read so it could be throttled
+    async def on_user_message(self, message, user, command):
         authid = message.author.id
         content = message.content
 
         if user and (match := PK_EDIT.match(content)):
-            command = content.removeprefix(match[0]).strip()
-            reader = commands.CommandReader(message, command)
+            rest = content.removeprefix(match[0]).strip()
+            reader = commands.CommandReader(message, rest)
             return await self.do_pk_edit(reader)
 
         chan = self.fetchone(
             "select * from channels where chanid = ?", (message.channel.id,)
         )
         mandatory = chan and chan["mode"] == ChannelMode.mandatory
-        # command prefix is optional in DMs
-        if reader := commands.CommandReader.from_message(message):
+        if command:
             if mandatory:
                 await self.try_delete(message)
                 raise UserError("You cannot use commands in a Mandatory mode channel.")
 
-            await self.do_command(reader, user)
+            await self.do_command(*command, user)
             return
 
         if message.author.bot and content.lower() in ["yes", "no", "abstain"]:
@@ -1005,30 +1778,67 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
                     self.set_autoproxy(message.author, None)
                 return
 
-            latch = match["latch"] and match["proxid"] != match["ap"]
+            latch = match["latch"] and match["proxkey"] != match["ap"]
             if match["type"] == ProxyType.override:
                 if latch:
                     self.set_autoproxy(message.author, None)
                 return
             if not self.has_perm(message.channel, manage_messages=True):
                 raise UserError("I need `Manage Messages` permission to proxy.")
+            # charged here rather than in on_message, since most messages aren't ours
+            # (and like any other unusable proxy, it's deleted in mandatory channels)
+            if not await self.throttle(message, "proxy"):
+                await self.try_add_reaction(message, REACT_THROTTLED)
+                return
             msg = await self.do_proxy(message, stripped, match, prefs)
             if msg and latch:
-                self.set_autoproxy(message.author, match["proxid"])
+                self.set_autoproxy(message.author, match["proxkey"])
         finally:
             # if the proxy couldn't be used in this channel
             # (unsynced pkswap, swap with non-member)
             if not msg and mandatory:
                 await self.try_delete(message)
 
+    # (reader, found) for do_command(), or None if the message isn't a command
+    def read_command(self, message):
+        # command prefix is optional in DMs
+        if reader := commands.CommandReader.from_message(message):
+            return (reader, commands.COMMAND_TREE.find(reader))
+
+    # found is from read_command(), see throttle()
+    def throttle_kind(self, found):
+        command = found and found[0]
+        return "heavy" if command and command.name in THROTTLE_HEAVY else "command"
+
+    # returns whether the message can go ahead, possibly after waiting its turn
+    # the user and the guild both need a token, so one guild can't crowd out others
+    async def throttle(self, message, kind):
+        keys = [("user", message.author.id)]
+        if message.guild:
+            keys.append(("guild", message.guild.id))
+        (wait, scope) = max(
+            (self.throttles[kind, scope].wait(key), scope) for scope, key in keys
+        )
+        if wait > THROTTLE_QUEUE:
+            self.stats["throttled %s by %s" % (kind, scope)] += 1
+            return False
+        for scope, key in keys:
+            self.throttles[kind, scope].take(key)
+        if wait:
+            self.stats["throttle queued %s" % kind] += 1
+            self.stats["throttle queued seconds"] += wait
+            await asyncio.sleep(wait)
+        return True
+
     async def on_message(self, message):
         authid = message.author.id  # if webhook then webhook id
+        expected = self.shard_cache(message.guild).expected_pk_errors
         if (
             authid == PK_ID
-            and message.channel.id in self.expected_pk_errors
+            and message.channel.id in expected
             and message.content == PK_EDIT_ERROR
         ):
-            self.expected_pk_errors[message.channel.id] = message
+            expected[message.channel.id] = message
             return
 
         if (
@@ -1045,9 +1855,27 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
             and not message.webhook_id
             and self.can_use_gestalt(message.author)
         ):
+            # before the db, so a flood of commands costs as little as possible
+            if command := self.read_command(message):
+                kind = self.throttle_kind(command[1])
+                if not await self.throttle(message, kind):
+                    # only say so once, or the replies would be the flood
+                    if (kind, authid) not in self.throttle_warned:
+                        self.throttle_warned.add((kind, authid))
+                        user = self.fetchone(
+                            "select prefs from users where userid = ?", (authid,)
+                        )
+                        if ((user and user["prefs"]) or DEFAULT_PREFS) & Prefs.errors:
+                            await self.reply(
+                                message,
+                                "You're doing that too often. "
+                                "Please wait a few seconds and try again.",
+                            )
+                    return
+                self.throttle_warned.discard((kind, authid))
             user = self.fetchone("select * from users where userid = ?", (authid,))
             try:
-                await self.on_user_message(message, user)
+                await self.on_user_message(message, user, command)
             except UserError as e:
                 # an uninit'd user shouldn't ever get errors, but just in case
                 if ((user and user["prefs"]) or DEFAULT_PREFS) & Prefs.errors:
@@ -1062,20 +1890,44 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
     # these are needed for gs;edit to work
     async def on_raw_message_delete(self, payload):
         if (msgid := payload.message_id) in self.ignore_delete_cache:
-            self.ignore_delete_cache.remove(msgid)
+            self.ignore_delete_cache.discard(msgid)
             return
         if msgid in self.votes:
             del self.votes[msgid]
         if msgid in self.active_pages:
             del self.active_pages[msgid]
-        self.execute("delete from history where msgid = ?", (msgid,))
-        self.last_message_cache.delete(payload)
+        self.expiry.cancel(msgid)
+        if msgid not in self.history_filter:
+            self.stats["history filter skips"] += 1
+        elif row := self.pending_history.pop(msgid, None):
+            self.count_message(row["proxkey"], row["maskkey"], -1)
+            self.history_filter.discard(msgid)
+        # rows may not have been backfilled with keys yet, see schema/28.sql
+        elif row := self.fetchone(
+            "delete from history where msgid = ? returning "
+            "coalesce(proxkey, ("
+            "select proxkey from proxies where proxies.proxid = history.proxid"
+            ")), "
+            "coalesce(maskkey, ("
+            "select maskkey from masks where masks.maskid = history.maskid"
+            "))",
+            (msgid,),
+        ):
+            self.count_message(*row, -1)
+            self.history_filter.discard(msgid)
+        else:
+            self.stats["history filter false positives"] += 1
+        self.shard_caches[self.shard_of(payload.guild_id)].last_message.delete(payload)
 
     async def on_raw_bulk_message_delete(self, payload):
         for id in payload.message_ids:
             await self.on_raw_message_delete(
                 discord.raw_models.RawMessageDeleteEvent(
-                    {"id": id, "channel_id": payload.channel_id}
+                    {
+                        "id": id,
+                        "channel_id": payload.channel_id,
+                        "guild_id": payload.guild_id,
+                    }
                 )
             )
 
@@ -1084,44 +1936,43 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
         if payload.user_id == self.user.id:
             return
 
+        emoji = payload.emoji.name
+        # only look up the channel (maybe a fetch) once it's known to be worth it
+        if payload.guild_id:
+            # make sure this is one of ours
+            if payload.message_id not in self.history_filter:
+                self.stats["history filter skips"] += 1
+                return
+            if not (row := self.get_history(payload.message_id)):
+                self.stats["history filter false positives"] += 1
+                return
+        elif emoji != REACT_DELETE or payload.message_author_id != self.user.id:
+            return
         channel = self.get_channel(payload.channel_id) or await self.fetch_channel(
             payload.channel_id
         )
         message = channel.get_partial_message(payload.message_id)
-        emoji = payload.emoji.name
-        if channel.guild:
-            # make sure this is one of ours
-            row = self.fetchone(
-                "select authid, otherid, username "
-                "from history left join users on userid = authid "
-                "where msgid = ?",
-                (payload.message_id,),
-            )
-            if row == None:
-                return
-        else:
-            if emoji == REACT_DELETE and payload.message_author_id == self.user.id:
-                await message.delete()
-            if pages := self.active_pages.get(message.id):
-                await pages.on_control(self, emoji, None)
+        if not payload.guild_id:
+            await message.delete()
             return
 
         reactor = channel.guild.get_member(payload.user_id)
         if not self.can_use_gestalt(reactor):
             return
 
-        if payload.user_id == row["authid"] and (
-            pages := self.active_pages.get(message.id)
-        ):
-            await pages.on_control(self, emoji, reactor)
-
         if emoji == REACT_QUERY:
             try:
                 author = str(
                     self.get_user(row["authid"]) or await self.fetch_user(row["authid"])
                 )
             except discord.errors.NotFound:
-                author = row["username"]
+                author = (
+                    self.fetchone(
+                        "select username from users where userid = ?",
+                        (row["authid"],),
+                    )
+                    or [None]
+                )[0]
 
             try:
                 # this can fail depending on user's DM settings & prior messages
@@ -1143,8 +1994,22 @@ class Gestalt(discord.Client, commands.GestaltCommands, gesp.GestaltVoting):
                     await message.remove_reaction(emoji, reactor)
 
 
+# "3/8" or "0-3/8": which shards this process runs, out of how many in total
+def parse_shards(spec):
+    (ids, count) = spec.split("/")
+    (first, _, last) = ids.partition("-")
+    return {
+        "shard_ids": list(range(int(first), int(last or first) + 1)),
+        "shard_count": int(count),
+    }
+
+
+# usage: gestalt.py [database [shards]]
 def main():
-    instance = Gestalt(dbfile=sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB)
+    instance = Gestalt(
+        dbfile=sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB,
+        **(parse_shards(sys.argv[2]) if len(sys.argv) > 2 else {}),
+    )
 
     try:
         instance.run(auth.token)
@@ -0,0 +1,5 @@
+create table if not exists avatars(avatar text primary key, refs integer);
+create trigger if not exists mask_avatar_create after insert on masks when new.avatar not null begin update avatars set refs = refs + 1 where avatar = new.avatar; end;
+create trigger if not exists mask_avatar_update after update of avatar on masks begin update avatars set refs = refs + 1 where avatar = new.avatar; update avatars set refs = refs - 1 where avatar = old.avatar; end;
+create trigger if not exists mask_avatar_delete after delete on masks when old.avatar not null begin update avatars set refs = refs - 1 where avatar = old.avatar; end;
+insert or replace into avatars select avatar, count() from masks where avatar not null and avatar not like 'http://%' and avatar not like 'https://%' group by avatar;
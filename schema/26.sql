@@ -0,0 +1 @@
+create table if not exists backfills(name text primary key, position integer, done integer);
@@ -0,0 +1,4 @@
+drop trigger if exists mask_history_create;
+drop trigger if exists mask_history_delete;
+drop trigger if exists history_create;
+drop trigger if exists history_delete;
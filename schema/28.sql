@@ -0,0 +1,28 @@
+drop trigger if exists mask_proxy_create;
+drop trigger if exists mask_proxy_delete;
+drop trigger if exists mask_delete;
+drop trigger if exists mask_avatar_create;
+drop trigger if exists mask_avatar_update;
+drop trigger if exists mask_avatar_delete;
+create table proxiesnew(proxid text unique collate nocase,cmdname text collate nocase,userid integer,prefix text,postfix text,type integer,otherid integer,maskid text collate nocase,flags integer,state integer,created integer,msgcount integer,proxkey integer primary key autoincrement,unique(maskid, userid));
+insert into proxiesnew select *, rowid from proxies;
+drop table proxies;
+alter table proxiesnew rename to proxies;
+create index proxies_userid_otherid on proxies(userid, otherid);
+create table masksnew(maskid text unique collate nocase,nick text,avatar text,color text,rules text,created integer,members integer,msgcount integer,maskkey integer primary key autoincrement);
+insert into masksnew select *, rowid from masks;
+drop table masks;
+alter table masksnew rename to masks;
+create table membersnew(userid integer,guildid integer,proxkey integer,latch integer,become real,primary key(userid, guildid),check(proxkey not null or become >= 1.0));
+insert into membersnew select members.userid, members.guildid, proxkey, latch, iif(proxkey is null, 1.0, become) from members left join proxies using (proxid);
+drop table members;
+alter table membersnew rename to members;
+create trigger mask_proxy_create after insert on proxies when (new.type = 5) begin update masks set members = members + 1 where maskid = new.maskid; end;
+create trigger mask_proxy_delete after delete on proxies when (old.type = 5) begin update masks set members = members - 1 where maskid = old.maskid; end;
+create trigger mask_delete after update of members on masks when new.members = 0 begin delete from guildmasks where maskid = new.maskid; delete from masks where maskid = new.maskid; end;
+create trigger mask_avatar_create after insert on masks when new.avatar not null begin update avatars set refs = refs + 1 where avatar = new.avatar; end;
+create trigger mask_avatar_update after update of avatar on masks begin update avatars set refs = refs + 1 where avatar = new.avatar; update avatars set refs = refs - 1 where avatar = old.avatar; end;
+create trigger mask_avatar_delete after delete on masks when old.avatar not null begin update avatars set refs = refs - 1 where avatar = old.avatar; end;
+alter table history add column proxkey integer;
+alter table history add column maskkey integer;
+insert into backfills values ('history_keys', 0, 0);
@@ -2,16 +2,22 @@
 
 from tempfile import TemporaryDirectory
 from functools import reduce, partial
-from collections import defaultdict
+from collections import defaultdict, Counter
 from datetime import timedelta
 import unittest
+import hashlib
 import asyncio
+import logging
+import struct
 import json
 import math
+import time
+import zlib
 import os
 import re
 
 import discord
+import aiohttp.test_utils
 
 # change globals before importation by main program so they're inherited
 import defs
@@ -22,8 +28,16 @@ defs.AVATAR_URL_BASE = "https://gestalt.gov/"
 defs.BECOME_MAX = 1
 # don't spam the channels with error messages
 defs.DEFAULT_PREFS &= ~defs.Prefs.errors
+# the tests send commands far faster than anyone should. see test_65_throttle
+defs.THROTTLES = {
+    kind: {scope: (1000, 1000) for scope in scopes}
+    for kind, scopes in defs.THROTTLES.items()
+}
 
 import gestalt
+import backfill
+import avatars
+import cuckoo
 import gesp
 
 
@@ -252,16 +266,17 @@ class Message(Object):
         await instance.on_raw_message_delete(
             discord.raw_models.RawMessageDeleteEvent(
                 data={"channel_id": self.channel.id, "id": self.id}
+                | ({"guild_id": self.guild.id} if self.guild else {})
             )
         )
 
-    async def edit(self, embed=None, embeds=[], view=None):
+    async def edit(self, embed=None, embeds=[], view=discord.utils.MISSING):
         if self.author.id != instance.user.id:
             raise Forbidden()
         if newbeds := [embed] if embed else embeds:
             self.embeds = newbeds
-        if view:
-            self.components = view.children
+        if view is not discord.utils.MISSING:
+            self.components = view.children if view else []
         self.edited_at = warptime.now()
 
     def _react(self, emoji, user, _async=False):
@@ -276,7 +291,8 @@ class Message(Object):
                     "user_id": user.id,
                     "channel_id": self.channel.id,
                     "message_author_id": self.author.id,
-                },
+                }
+                | ({"guild_id": self.guild.id} if self.guild else {}),
                 emoji=discord.PartialEmoji(name=emoji),
                 event_type=None,
             )
@@ -306,7 +322,11 @@ class Message(Object):
         self._deleted = True
         await instance.on_raw_bulk_message_delete(
             discord.raw_models.RawBulkMessageDeleteEvent(
-                data={"ids": {self.id}, "channel_id": self.channel.id}
+                data={
+                    "ids": {self.id},
+                    "channel_id": self.channel.id,
+                    "guild_id": self.guild.id,
+                }
             )
         )
 
@@ -323,6 +343,9 @@ class PartialMessage:
     async def delete(self, delay=None):
         await self._truemsg.delete()
 
+    async def edit(self, **kwargs):
+        await self._truemsg.edit(**kwargs)
+
     async def fetch(self):
         return self._truemsg
 
@@ -459,6 +482,22 @@ class Channel(Object):
     async def create_webhook(self, name):
         return Webhook(self, name)
 
+    async def delete_messages(self, messages):
+        if not 2 <= len(messages) <= 100:
+            raise discord.ClientException()
+        for msg in messages:
+            self._messages.remove(msg)
+            msg._deleted = True
+        await instance.on_raw_bulk_message_delete(
+            discord.raw_models.RawBulkMessageDeleteEvent(
+                data={
+                    "ids": {msg.id for msg in messages},
+                    "channel_id": self.id,
+                    "guild_id": self.guild.id,
+                }
+            )
+        )
+
     async def fetch_message(self, msgid):
         msg = discord.utils.get(self._messages, id=msgid)
         if not msg:
@@ -652,6 +691,25 @@ class Attachment(Object):
         return self
 
 
+# smallest valid image, with some data in a text chunk to make it unique
+def png(text):
+    chunk = lambda kind, data: (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+    return b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0)),
+            chunk(b"tEXt", b"Comment\0" + text),
+            chunk(b"IDAT", zlib.compress(b"\0\0\0\0")),
+            chunk(b"IEND", b""),
+        )
+    )
+
+
 class Interaction:
     def __init__(self, message, user, button):
         (self.message, self.user) = (message, user)
@@ -662,12 +720,20 @@ class Interaction:
     def channel(self):
         return self.message.channel
 
+    @property
+    def guild(self):
+        return self.message.guild
+
     @property
     def response(self):
         return self  # lol
 
     async def send_message(self, **kwargs):
-        pass  # only used for ephemeral messages; bot never sees those
+        # only used for ephemeral messages; bot never sees those
+        self.sent = kwargs
+
+    async def edit_message(self, **kwargs):
+        await self.message.edit(**kwargs)
 
 
 invites = {}
@@ -727,6 +793,18 @@ class ClientSession:
         async def text(self, encoding):
             return self._data
 
+        @property
+        def content(self):
+            return self
+
+        @property
+        def content_length(self):
+            return len(self._data) if type(self._data) == bytes else None
+
+        async def iter_chunked(self, n):
+            for i in range(0, len(self._data), n):
+                yield self._data[i : i + n]
+
         @property
         def status(self):
             return self._data if type(self._data) == int else 200
@@ -765,7 +843,13 @@ class NotFound(discord.errors.NotFound):
 
 
 def run(coro):
-    return instance.loop.run_until_complete(coro)
+    result = instance.loop.run_until_complete(coro)
+    # originals are deleted in the background, but tests expect them to be gone
+    while instance.delete_tasks:
+        instance.loop.run_until_complete(
+            asyncio.gather(*instance.delete_tasks.values())
+        )
+    return result
 
 
 def send(user, channel, content, reference=None, files=[], orig=False, **kwargs):
@@ -1398,9 +1482,16 @@ class GestaltTest(unittest.TestCase):
             embed("http://cat.png")
             self.assertEqual(os.listdir(gestalt.AVATAR_DIRECTORY), [])
 
-        def attachment(content, sha):
+        def attachment(content):
             attach = Attachment(content, content_type="image/png")
-            name = r"[a-z]{5}_%s\.png" % sha
+            if avatars.Image:
+                with TemporaryDirectory() as tmp:
+                    with open(os.path.join(tmp, "cat"), "wb") as f:
+                        f.write(content)
+                    (image, ext) = avatars.transcode_avatar(f.name)
+            else:
+                (image, ext) = (content, "png")
+            name = re.escape("%s.%s" % (hashlib.sha1(image).hexdigest(), ext))
             self.assertCommand(alpha, chan, "gs;m temp avatar", files=[attach])
             display = self.assertProxied(alpha, chan, "temp:temp").author.display_avatar
             self.assertIsNotNone(re.fullmatch(gestalt.LINK_REGEX, display))
@@ -1412,12 +1503,19 @@ class GestaltTest(unittest.TestCase):
             self.assertEqual(len(files), 1)
             self.assertIsNotNone(re.fullmatch(name, files[0]))
 
-        attachment1 = partial(
-            attachment, b"a real cat", "5efbe0334783d12a60d190d24724fa469618278d"
-        )
-        attachment2 = partial(
-            attachment, b"a fake cat", "b26d9842c999fd47c67972fc47a86adfc6970c3f"
-        )
+        # animations are limited in frames, not just in size
+        if avatars.Image:
+            with TemporaryDirectory() as tmp:
+                frames = [
+                    avatars.Image.new("L", (2, 2), i % 256)
+                    for i in range(gestalt.AVATAR_MAX_FRAMES + 1)
+                ]
+                path = os.path.join(tmp, "cats.gif")
+                frames[0].save(path, save_all=True, append_images=frames[1:])
+                self.assertIsNone(avatars.transcode_avatar(path))
+
+        attachment1 = partial(attachment, png(b"a real cat"))
+        attachment2 = partial(attachment, png(b"a fake cat"))
 
         for first in [clear, url, attachment1]:
             for second in [clear, url, attachment1, attachment2]:
@@ -2602,7 +2700,7 @@ class GestaltTest(unittest.TestCase):
         g._add_member(instance.user)
 
         instance.execute(
-            "insert into masks values " '("mask", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("mask", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesDictator(user=alpha.id).to_json(),),
         )
         instance.load()
@@ -2629,7 +2727,7 @@ class GestaltTest(unittest.TestCase):
         self.assertIsNotNone(self.get_proxid(beta, "mask"))
 
         instance.execute(
-            "insert into masks values " '("mask2", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("mask2", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesUnanimous().to_json(),),
         )
         instance.load()
@@ -2690,7 +2788,7 @@ class GestaltTest(unittest.TestCase):
 
         users = [User(name=str(i)) for i in range(6)]
         instance.execute(
-            "insert into masks values " '("mask3", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("mask3", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesHandsOff(user=alpha.id).to_json(),),
         )
         instance.load()
@@ -2718,7 +2816,7 @@ class GestaltTest(unittest.TestCase):
             self.assertIsNotNone(self.get_proxid(candidate, "mask3"))
 
         instance.execute(
-            "insert into masks values " '("mask4", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("mask4", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesMajority().to_json(),),
         )
         instance.load()
@@ -2738,7 +2836,7 @@ class GestaltTest(unittest.TestCase):
 
         # ActionRules has the most complicated serialization
         instance.execute(
-            "insert into masks values " '("mask5", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("mask5", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesMajority().to_json(),),
         )
         instance.load()
@@ -2771,7 +2869,7 @@ class GestaltTest(unittest.TestCase):
         self.assertEqual(type(instance.get_rules("mask5")), gesp.RulesDictator)
 
         instance.execute(
-            "insert into masks values " '("mask6", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("mask6", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesDictator(user=alpha.id).to_json(),),
         )
         instance.load()
@@ -2796,21 +2894,23 @@ class GestaltTest(unittest.TestCase):
         c = alpha.dm_channel
         self.assertVote(alpha, c, "gs;m new unexpired")
         warptime.warp += int(timedelta(hours=12).total_seconds())
-        run(instance.cleanup())
+        run(instance.expire_due())
         interact(c[-1], alpha, "no")
         self.assertCommand(alpha, c, "gs;m unexpired leave")
         self.assertVote(alpha, c, "gs;m new expired")
         warptime.warp += int(timedelta(days=1).total_seconds())
         self.assertIn(c[-1].id, instance.votes)
-        run(instance.cleanup())
+        self.assertTrue(any(not button.disabled for button in c[-1].components))
+        run(instance.expire_due())
         self.assertNotIn(c[-1].id, instance.votes)
+        self.assertTrue(all(button.disabled for button in c[-1].components))
         interact(c[-1], alpha, "no")
         self.assertNotCommand(alpha, c, "gs;m expired leave")
         self.assertVote(alpha, c, "gs;m new expired")
         warptime.warp += int(timedelta(days=1).total_seconds())
         interact(c[-1], alpha, "no")
         self.assertNotCommand(alpha, c, "gs;m expired leave")
-        run(instance.cleanup())
+        run(instance.expire_due())
 
     def test_36_masks(self):
         mkguild = lambda name, *members: (
@@ -3170,7 +3270,7 @@ class GestaltTest(unittest.TestCase):
         g._add_member(instance.user)
 
         instance.execute(
-            "insert into masks values " '("legacy", "", NULL, NULL, ?, 0, 0, 0)',
+            "insert into masks values " '("legacy", "", NULL, NULL, ?, 0, 0, 0, NULL)',
             (gesp.RulesLegacy(role=role.id, guild=g.id).to_json(),),
         )
         instance.load()
@@ -3561,79 +3661,109 @@ class GestaltTest(unittest.TestCase):
             self.assertNotEqual(len(message.embeds), 0)
             self.assertEqual(message.embeds[0].title, title)
 
+        def button(message, control):
+            return next(
+                button
+                for button in message.components
+                if button.custom_id.endswith(":" + control)
+            )
+
+        def press(message, user, control):
+            interact(message, user, button(message, control).custom_id)
+
+        def enabled(message):
+            return {
+                button.custom_id.split(":")[-1]
+                for button in message.components
+                if not button.disabled
+            }
+
         for i in range(24):
             self.assertVote(newbie, c, f"gs;m new mask{i}")
             interact(c[-1], newbie, "no")
         send(newbie, c, "gs;p")
         assertPage(c[-1], "Proxies of newbie:")
-        self.assertNotEqual(len(c[-1].reactions), 5)
-        c[-1]._react(gestalt.REACT_NEXT, newbie)
-        assertPage(c[-1], "Proxies of newbie:")
-        self.assertIn(newbie.id, c[-1].reactions[gestalt.REACT_NEXT])
+        self.assertEqual(c[-1].components, [])
 
         self.assertVote(newbie, c, f"gs;m new mask24")
         interact(c[-1], newbie, "no")
         send(newbie, c, "gs;p")
-        assertPage(c[-1], "[1/2] Proxies of newbie:")
-        self.assertEqual(len(c[-1].reactions), 5)
+        # pages are built as they come up, so the total isn't known yet
+        assertPage(c[-1], "[1/?] Proxies of newbie:")
+        # controls are buttons now, only the delete reaction is left
+        self.assertEqual(list(c[-1].reactions), [gestalt.REACT_DELETE])
+        self.assertEqual(len(c[-1].components), 4)
+        self.assertEqual(enabled(c[-1]), {"next", "last"})
         self.assertEqual(len(c[-1].embeds[0].description.split("\n")), 25)
-        c[-1]._react(gestalt.REACT_NEXT, newbie)
+        press(c[-1], newbie, "next")
+        assertPage(c[-1], "[2/2] Proxies of newbie:")
         self.assertEqual(len(c[-1].embeds[0].description.split("\n")), 1)
+        self.assertEqual(enabled(c[-1]), {"first", "prev"})
 
         for i in range(25, 75):
             self.assertVote(newbie, c, f"gs;m new mask{i}")
             interact(c[-1], newbie, "no")
         send(newbie, c, "gs;p")
-        assertPage(c[-1], "[1/4] Proxies of newbie:")
-
-        timestamp = None
-        for react, index, edit in [
-            (gestalt.REACT_FIRST, 1, False),
-            (gestalt.REACT_PREV, 1, False),
-            (gestalt.REACT_NEXT, 2, True),
-            (gestalt.REACT_LAST, 4, True),
-            (gestalt.REACT_NEXT, 4, False),
-            (gestalt.REACT_LAST, 4, False),
-            (gestalt.REACT_PREV, 3, True),
-            (gestalt.REACT_FIRST, 1, True),
+        assertPage(c[-1], "[1/?] Proxies of newbie:")
+
+        for control, index, total in [
+            ("next", 2, "?"),
+            ("last", 4, 4),
+            ("prev", 3, 4),
+            ("first", 1, 4),
+            ("last", 4, 4),
         ]:
             prev = c[-1].embeds[0].title
-            c[-1]._react(react, alpha)
-            self.assertIn(instance.user.id, c[-1].reactions[react])
+            edited = c[-1].edited_at
+            press(c[-1], alpha, control)
             assertPage(c[-1], prev)
-            c[-1].reactions[react].remove(alpha.id)
-
-            c[-1]._react(react, newbie)
-            assertPage(c[-1], f"[{index}/4] Proxies of newbie:")
-            run(instance.cleanup())
-            self.assertIn(instance.user.id, c[-1].reactions[react])
-            self.assertNotIn(newbie.id, c[-1].reactions[react])
-            if edit:
-                timestamp = warptime.now()
-            self.assertTrue(
-                c[-1].edited_at == timestamp
-                or (timestamp - c[-1].edited_at) < timedelta(milliseconds=10)
+            self.assertEqual(c[-1].edited_at, edited)
+
+            press(c[-1], newbie, control)
+            assertPage(c[-1], f"[{index}/{total}] Proxies of newbie:")
+            self.assertEqual(
+                enabled(c[-1]),
+                ({"first", "prev"} if index > 1 else set())
+                | ({"next", "last"} if index < 4 else set()),
             )
             warptime.warp += 1
 
-        warptime.warp += gestalt.TIMEOUT_PAGES - int(
-            (warptime.now() - c[-1].created_at).total_seconds() + 1
-        )
-        run(instance.cleanup())
-        for react in instance.Pages.CONTROLS:
-            self.assertIn(instance.user.id, c[-1].reactions[react])
+        # the buttons say where they go, so they still work after a restart
+        instance.active_pages.clear()
+        press(c[-1], newbie, "prev")
+        assertPage(c[-1], "[3/?] Proxies of newbie:")
+        self.assertIn(c[-1].id, instance.active_pages)
+        # stale button for a page that's gone now
+        msg = c[-1]
+        stale = button(msg, "next").custom_id
+        instance.active_pages.clear()
+        for i in (73, 74):
+            self.assertCommand(newbie, c, f"gs;m mask{i} leave")
+        interact(msg, newbie, stale)
+        assertPage(msg, "[3/3] Proxies of newbie:")
+        self.assertEqual(enabled(msg), {"first", "prev"})
+        for i in (73, 74):
+            self.assertVote(newbie, c, f"gs;m new mask{i}")
+            interact(c[-1], newbie, "no")
+
+        send(newbie, c, "gs;p")
+        warptime.warp += gestalt.TIMEOUT_PAGES - 1
+        run(instance.expire_due())
+        self.assertNotEqual(enabled(c[-1]), set())
         warptime.warp += 2
-        run(instance.cleanup())
-        for react in instance.Pages.CONTROLS:
-            self.assertNotIn(react, c[-1].reactions)
+        edited = c[-1].edited_at
+        run(instance.expire_due())
+        self.assertNotEqual(c[-1].edited_at, edited)
+        self.assertEqual(len(c[-1].components), 4)
+        self.assertEqual(enabled(c[-1]), set())
+        self.assertNotIn(c[-1].id, instance.active_pages)
 
         send(newbie, newbie.dm_channel, "gs;p")
-        newbie.dm_channel[-1]._react(gestalt.REACT_NEXT, newbie)
-        assertPage(newbie.dm_channel[-1], "[2/4] Proxies of newbie:")
-        warptime.warp += gestalt.TIMEOUT_PAGES
-        run(instance.cleanup())
-        for react in instance.Pages.CONTROLS:
-            self.assertNotIn(instance.user.id, c[-1].reactions[react])
+        press(newbie.dm_channel[-1], newbie, "next")
+        assertPage(newbie.dm_channel[-1], "[2/?] Proxies of newbie:")
+        warptime.warp += gestalt.TIMEOUT_PAGES + 1
+        run(instance.expire_due())
+        self.assertEqual(enabled(newbie.dm_channel[-1]), set())
 
         sydney = User(name="sydney", bot=True)
         g._add_member(sydney)
@@ -3643,15 +3773,1117 @@ class GestaltTest(unittest.TestCase):
         sydney._onboard(c)
         send(sydney, c, "gs;p")
         assertPage(c[-1], "Proxies of sydney:")
-        self.assertNotEqual(len(c[-1].reactions), 5)
+        self.assertEqual(c[-1].components, [])
         for i in range(25):
             self.assertVote(sydney, c, f"gs;m new mask{i}")
             send(sydney, c, "no")
         send(sydney, c, "gs;p")
         assertPage(c[-1], "[2/2] Proxies of sydney:")
         assertPage(c[-2], "[1/2] Proxies of sydney:")
-        self.assertNotEqual(len(c[-1].reactions), 5)
-        self.assertNotEqual(len(c[-2].reactions), 5)
+        self.assertEqual(c[-1].components, [])
+        self.assertEqual(c[-2].components, [])
+
+    def test_45_avatar_store(self):
+        chan = g["main"]
+        path = gestalt.AVATAR_DIRECTORY
+        for name in ("dedup1", "dedup2"):
+            self.assertVote(alpha, chan, f"gs;m new {name}")
+            interact(chan[-1], alpha, "no")
+            attach = Attachment(png(b"the same cat"), content_type="image/png")
+            self.assertCommand(alpha, chan, f"gs;m {name} avatar", files=[attach])
+        # identical images are only stored once
+        files = os.listdir(path)
+        self.assertEqual(len(files), 1)
+        self.assertEqual(
+            instance.fetchone("select refs from avatars where avatar = ?", (files[0],))[
+                0
+            ],
+            2,
+        )
+        self.assertCommand(alpha, chan, "gs;m dedup1 leave")
+        self.assertEqual(os.listdir(path), files)
+        self.assertCommand(alpha, chan, "gs;m dedup2 avatar -clear")
+        self.assertEqual(os.listdir(path), [])
+        self.assertRowNotExists("select 1 from avatars")
+
+        # the claimed content type isn't trusted
+        self.assertCommand(
+            alpha,
+            chan,
+            "gs;m dedup2 avatar",
+            files=[Attachment(b"not a cat", content_type="image/png")],
+        )
+        self.assertEqual(os.listdir(path), [])
+        self.assertRowExists(
+            "select 1 from masks where (nick, avatar) is (?, NULL)", ("dedup2",)
+        )
+
+        # files that no mask refers to are collected, once they're old enough
+        self.assertCommand(
+            alpha,
+            chan,
+            "gs;m dedup2 avatar",
+            files=[Attachment(png(b"a used cat"), content_type="image/png")],
+        )
+        (used,) = os.listdir(path)
+        with open(os.path.join(path, "stray.png"), "wb") as f:
+            f.write(b"a stray cat")
+        run(instance.cleanup())
+        self.assertEqual(sorted(os.listdir(path)), sorted([used, "stray.png"]))
+        old = time.time() - gestalt.AVATAR_GC_GRACE - 1
+        for name in (used, "stray.png"):
+            os.utime(os.path.join(path, name), (old, old))
+        run(instance.cleanup())
+        self.assertEqual(os.listdir(path), [used])
+        # unless a download is about to reuse it, or just did
+        stray = os.path.join(path, "stray.png")
+        with open(stray, "wb") as f:
+            f.write(b"a stray cat")
+        os.utime(stray, (old, old))
+        instance.storing_avatars["stray.png"] += 1
+        run(instance.cleanup())
+        self.assertIn("stray.png", os.listdir(path))
+        instance.storing_avatars.clear()
+        self.assertEqual(instance.remove_avatars(["stray.png"]), 1)
+        with open(stray, "wb") as f:
+            f.write(b"a stray cat")
+        self.assertEqual(instance.remove_avatars(["stray.png"]), 0)
+        os.remove(stray)
+        # a download about to reuse the file keeps it from being removed
+        instance.storing_avatars[used] += 1
+        self.assertCommand(alpha, chan, "gs;m dedup2 avatar -clear")
+        self.assertEqual(os.listdir(path), [used])
+        instance.storing_avatars.clear()
+        self.assertCommand(
+            alpha,
+            chan,
+            "gs;m dedup2 avatar",
+            files=[Attachment(png(b"a used cat"), content_type="image/png")],
+        )
+        self.assertEqual(os.listdir(path), [used])
+        self.assertCommand(alpha, chan, "gs;m dedup2 leave")
+        self.assertEqual(os.listdir(path), [])
+
+        # downloads are capped and sniffed, and leave nothing behind if rejected
+        limit = gestalt.AVATAR_MAX_SIZE_MB * 1024 * 1024
+        instance.session._add("big", png(b"a big cat") + bytes(limit))
+        instance.session._add("fake", b"not a cat" + bytes(limit))
+        instance.session._add("short", b"GIF")
+        instance.session._add("404", 404)
+        for url in ("big", "fake", "short", "404"):
+            self.assertIsNone(run(instance.download_avatar(url)))
+        self.assertEqual(os.listdir(path), [])
+
+    def test_46_avatar_server(self):
+        data = png(b"a served cat")
+        sha = hashlib.sha1(data).hexdigest()
+        name = sha + ".png"
+        with open(os.path.join(gestalt.AVATAR_DIRECTORY, name), "wb") as f:
+            f.write(data)
+        stray = "0" * 40 + ".png"
+
+        async def fetch(*requests):
+            server = aiohttp.test_utils.TestServer(instance.make_avatar_app())
+            async with aiohttp.test_utils.TestClient(server) as client:
+                ret = []
+                for url, headers in requests:
+                    async with client.get(url, headers=headers) as r:
+                        ret.append((r.status, r.headers, await r.read()))
+                return ret
+
+        ok, cached, stale, missing, bad = run(
+            fetch(
+                ("/" + name, {}),
+                ("/" + name, {"If-None-Match": '"%s"' % sha}),
+                ("/" + name, {"If-None-Match": '"%s"' % ("0" * 40)}),
+                ("/" + stray, {}),
+                ("/..%2Fgestalt.db", {}),
+            )
+        )
+        self.assertEqual(ok[0], 200)
+        self.assertEqual(ok[2], data)
+        self.assertEqual(ok[1]["ETag"], '"%s"' % sha)
+        self.assertIn("immutable", ok[1]["Cache-Control"])
+        self.assertEqual(cached[0], 304)
+        self.assertEqual(cached[2], b"")
+        self.assertEqual(cached[1]["ETag"], '"%s"' % sha)
+        self.assertEqual(stale[0], 200)
+        self.assertEqual(missing[0], 404)
+        self.assertEqual(bad[0], 404)
+        self.assertEqual(instance.stats["avatar 200"], 2)
+        self.assertEqual(instance.stats["avatar 304"], 1)
+        self.assertEqual(instance.stats["avatar bytes"], 2 * len(data))
+        os.remove(os.path.join(gestalt.AVATAR_DIRECTORY, name))
+
+    def test_47_shards(self):
+        self.assertEqual(
+            gestalt.parse_shards("3/8"), {"shard_ids": [3], "shard_count": 8}
+        )
+        self.assertEqual(gestalt.parse_shards("0-2/8")["shard_ids"], [0, 1, 2])
+
+        # each process only loads and saves the votes for its own shards
+        vote = lambda guild: gesp.VoteCreate(
+            context=gesp.ProgramContext(initiator=alpha.id, guild=guild),
+            user=alpha.id,
+            name="sharded",
+        )
+        (ours, theirs) = (2 << 22, 1 << 22)
+        instance.save()
+        votes = instance.votes
+        try:
+            (instance.shard_count, instance.shard_ids) = (2, [0])
+            instance.execute("delete from votes")
+            instance.execute(
+                "insert into votes values (?, ?)", (1, vote(theirs).to_json())
+            )
+            instance.votes = {2: vote(ours), 3: vote(0)}
+            instance.save()
+            instance.load()
+            self.assertEqual(set(instance.votes), {2, 3})
+            instance.votes = {}
+            instance.save()
+            self.assertEqual(
+                [row[0] for row in instance.fetchall("select msgid from votes")], [1]
+            )
+        finally:
+            (instance.shard_count, instance.shard_ids) = (None, None)
+            instance.execute("delete from votes")
+            instance.votes = votes
+            instance.save()
+
+        # a fresh session might have missed events, so its caches are dropped
+        cache = instance.shard_cache(g)
+        run(instance.on_shard_ready(0))
+        self.assertIsNot(instance.shard_cache(g), cache)
+
+    def test_48_migrations(self):
+        version = lambda: instance.fetchone("pragma user_version")[0]
+        self.assertEqual(version(), current := gestalt.SCHEMA_VERSION)
+        instance.migrate()  # nothing to do
+        # a database from the future is left alone
+        instance.execute("pragma user_version = %i" % (current + 1))
+        with self.assertRaises(RuntimeError):
+            instance.migrate()
+        instance.execute("pragma user_version = %i" % current)
+
+        old = (gestalt.SCHEMA_DIRECTORY, gestalt.LEGACY_SCHEMA_VERSION)
+        with TemporaryDirectory() as gestalt.SCHEMA_DIRECTORY:
+
+            def script(version, text):
+                path = os.path.join(gestalt.SCHEMA_DIRECTORY, "%i.sql" % version)
+                with open(path, "w") as f:
+                    f.write(text)
+
+            script(current + 1, "create table first(x);")
+            script(current + 2, "create table second(x); select nonsense;")
+            gestalt.SCHEMA_VERSION = current + 2
+            # a failed migration is rolled back. the ones before it aren't
+            with self.assertRaises(gestalt.sqlite.OperationalError):
+                instance.migrate()
+            self.assertEqual(version(), current + 1)
+            self.assertRowExists("select 1 from sqlite_master where name = 'first'")
+            self.assertRowNotExists("select 1 from sqlite_master where name = 'second'")
+
+            # databases from before versioning are treated as legacy, not new
+            script(current + 2, "create table second(x);")
+            instance.execute("pragma user_version = 0")
+            gestalt.LEGACY_SCHEMA_VERSION = current + 1
+            instance.migrate()
+            self.assertEqual(version(), current + 2)
+            self.assertRowExists("select 1 from sqlite_master where name = 'second'")
+        (gestalt.SCHEMA_DIRECTORY, gestalt.LEGACY_SCHEMA_VERSION) = old
+        gestalt.SCHEMA_VERSION = current
+        instance.execute("drop table first")
+        instance.execute("drop table second")
+        instance.execute("pragma user_version = %i" % current)
+
+    def test_49_backfill(self):
+        rows = [row[0] for row in instance.fetchall("select msgid from history")]
+        self.assertGreater(len(rows), 10)
+        instance.execute("create table seen(msgid integer, chunk integer)")
+        backfill.BACKFILLS["test"] = backfill.Backfill(
+            "history",
+            "insert into seen select msgid, ?1 from history where msgid between ?1 and ?2",
+            ["create table cutover(x)"],
+        )
+        (backfill.BACKFILL_CHUNK, backfill.BACKFILL_DELAY) = (3, 0)
+        # ones that don't exist (anymore) don't hold up the others
+        instance.execute("insert into backfills values ('retired', 0, 0)")
+        # pretend it was interrupted partway through
+        instance.execute("insert into backfills values ('test', ?, 0)", (rows[4],))
+        run(instance.run_backfills())
+        (backfill.BACKFILL_CHUNK, backfill.BACKFILL_DELAY) = (
+            gestalt.BACKFILL_CHUNK,
+            gestalt.BACKFILL_DELAY,
+        )
+        del backfill.BACKFILLS["test"]
+
+        self.assertEqual(
+            [row[0] for row in instance.fetchall("select msgid from seen")], rows[5:]
+        )
+        self.assertTrue(
+            all(
+                count <= 3
+                for (count,) in instance.fetchall(
+                    "select count() from seen group by chunk"
+                )
+            )
+        )
+        self.assertRowExists("select 1 from sqlite_master where name = 'cutover'")
+        self.assertRowExists(
+            "select 1 from backfills where (name, position, done) = ('test', ?, 1)",
+            (rows[-1],),
+        )
+        # and it isn't run again, while the unknown one is left for its code
+        backfill.BACKFILLS["test"] = backfill.Backfill("history", "select nonsense")
+        run(instance.run_backfills())
+        del backfill.BACKFILLS["test"]
+        self.assertRowExists(
+            "select 1 from backfills where (name, done) = ('retired', 0)"
+        )
+        instance.execute("drop table seen")
+        instance.execute("drop table cutover")
+        instance.execute("delete from backfills")
+
+    def test_50_msgcount_flush(self):
+        chan = g["main"]
+        self.assertVote(alpha, chan, "gs;m new counted")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p counted tags counted:text")
+        proxid = instance.fetchone(
+            "select proxid from proxies where (userid, cmdname) = (?, ?)",
+            (alpha.id, "counted"),
+        )[0]
+        stored = lambda: instance.fetchone(
+            "select proxies.msgcount, masks.msgcount from proxies join masks "
+            "using (maskid) where proxid = ?",
+            (proxid,),
+        )
+        instance.commit()
+        self.assertEqual(tuple(stored()), (0, 0))
+
+        for i in range(3):
+            proxied = self.assertProxied(alpha, chan, "counted:hi")
+        send(alpha, chan, "gs;p counted")
+        field = lambda ind: discord.utils.get(
+            chan[-1].embeds[ind].fields, name="Message Count"
+        )
+        self.assertEqual((field(0).value, field(1).value), ("3", "3"))
+        # only written out on commit
+        self.assertEqual(tuple(stored()), (0, 0))
+        proxied._react(gestalt.REACT_DELETE, alpha)
+        instance.commit()
+        self.assertEqual(tuple(stored()), (2, 2))
+        self.assertEqual(instance.proxy_msgcounts, {})
+        self.assertCommand(alpha, chan, "gs;m counted leave")
+
+    def test_51_autoproxy_cache(self):
+        chan = g["main"]
+        key = (alpha.id, g.id)
+        row = lambda: tuple(
+            instance.fetchone(
+                "select proxkey, latch, become from members "
+                "where (userid, guildid) = (?, ?)",
+                key,
+            )
+            or ()
+        )
+        instance.commit()
+        before = row()
+        self.assertCommand(alpha, chan, "gs;ap latch")
+        self.assertEqual(row(), before)
+        instance.commit()
+        self.assertEqual(row(), (None, -1, 1.0))
+
+        # reads are served from memory, until it's cleared
+        instance.execute(
+            "update members set latch = 0 where (userid, guildid) = (?, ?)", key
+        )
+        send(alpha, chan, "gs;ap")
+        self.assertIn("latch", self.desc(chan[-1]))
+        run(instance.cleanup())
+        send(alpha, chan, "gs;ap")
+        self.assertNotIn("latch", self.desc(chan[-1]))
+
+    def test_52_history_buffer(self):
+        chan = g["main"]
+        self.assertVote(alpha, chan, "gs;m new buffered")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p buffered tags buffered:text")
+        instance.commit()
+        written = lambda msg: bool(
+            instance.fetchone("select 1 from history where msgid = ?", (msg.id,))
+        )
+        first = self.assertProxied(alpha, chan, "buffered:first")
+        self.assertFalse(written(first))
+        # but anything that reads history can still see it
+        self.assertDeleted(alpha, chan, "gs;edit edited")
+        self.assertEditedContent(first, "edited")
+        second = self.assertProxied(alpha, chan, "buffered:second")
+        second._react(gestalt.REACT_DELETE, alpha)
+        self.assertTrue(second._deleted)
+        instance.commit()
+        self.assertTrue(written(first))
+        self.assertFalse(written(second))
+
+        # written early if enough pile up
+        (old, gestalt.HISTORY_BATCH) = (gestalt.HISTORY_BATCH, 2)
+        third = self.assertProxied(alpha, chan, "buffered:third")
+        self.assertFalse(written(third))
+        fourth = self.assertProxied(alpha, chan, "buffered:fourth")
+        gestalt.HISTORY_BATCH = old
+        self.assertTrue(written(third) and written(fourth))
+        self.assertCommand(alpha, chan, "gs;m buffered leave")
+
+    def test_53_history_filter(self):
+        filt = cuckoo.CuckooFilter(1000)
+        ids = [
+            discord.utils.time_snowflake(discord.utils.utcnow()) + i for i in range(900)
+        ]
+        self.assertTrue(all(map(filt.add, ids)))
+        self.assertTrue(all(id in filt for id in ids))
+        for id in ids[::2]:
+            filt.discard(id)
+        self.assertEqual(len(filt), 450)
+        self.assertTrue(all(id in filt for id in ids[1::2]))
+        others = range(ids[-1] + 1, ids[-1] + 10001)
+        self.assertLess(sum(id in filt for id in others), 100)
+
+        # a full filter says so, and it gets rebuilt bigger
+        instance.history_filter = cuckoo.CuckooFilter(4)
+        chan = g["main"]
+        self.assertVote(alpha, chan, "gs;m new filtered")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p filtered tags filtered:text")
+        msgs = [self.assertProxied(alpha, chan, "filtered:%i" % i) for i in range(20)]
+        # off to the side, so meanwhile everything is looked up
+        self.assertIn(0, cuckoo.EverythingFilter())
+        self.assertTrue(instance.history_filter_task)
+        run(instance.history_filter_task)
+        self.assertIsInstance(instance.history_filter, cuckoo.CuckooFilter)
+        # a few rows at a time, which still gets all of them
+        (old, gestalt.HISTORY_FILTER_CHUNK) = (gestalt.HISTORY_FILTER_CHUNK, 7)
+        instance.history_filter = cuckoo.EverythingFilter()
+        try:
+            run(instance.rebuild_history_filter())
+        finally:
+            gestalt.HISTORY_FILTER_CHUNK = old
+        self.assertGreater(instance.fetchone("select count() from history")[0], 7)
+        self.assertTrue(
+            all(
+                row[0] in instance.history_filter
+                for row in instance.fetchall("select msgid from history")
+            )
+        )
+        self.assertGreaterEqual(len(instance.history_filter), 20)
+        self.assertTrue(all(msg.id in instance.history_filter for msg in msgs))
+
+        # messages that aren't ours don't get looked up
+        instance.stats.clear()
+        msg = send(alpha, chan, "not proxied")
+        # (or even have their channel looked up, which could be a fetch)
+        instance.get_channel = lambda id: self.fail("looked up channel %i" % id)
+        try:
+            msg._react(gestalt.REACT_QUERY, beta)
+        finally:
+            del instance.get_channel
+        self.assertEqual(instance.stats["history filter skips"], 1)
+        # (recently seen ones don't even get that far, see test_54)
+        instance.ignore_delete_cache.discard(msg.id)
+        run(msg.delete())
+        self.assertEqual(instance.stats["history filter skips"], 2)
+        msgs[0]._react(gestalt.REACT_DELETE, alpha)
+        self.assertTrue(msgs[0]._deleted)
+        self.assertNotIn(msgs[0].id, instance.history_filter)
+        self.assertEqual(instance.stats["history filter false positives"], 0)
+        stats = instance.history_filter_stats()
+        self.assertEqual(stats["history filter false positive rate"], 0)
+        self.assertGreater(stats["history filter KiB"], 0)
+        self.assertCommand(alpha, chan, "gs;m filtered leave")
+
+    def test_54_ignore_delete_cache(self):
+        now = [0]
+        recent = gestalt.Gestalt.RecentIds(30, 3, 6, clock=lambda: now[0])
+        recent.add(1)
+        now[0] = 15
+        recent.add(2)
+        self.assertIn(1, recent)
+        now[0] = 25
+        recent.add(3)
+        now[0] = 35
+        recent.add(4)
+        # 1 was in the oldest generation
+        self.assertNotIn(1, recent)
+        self.assertTrue(all(x in recent for x in (2, 3, 4)))
+        # filling up a generation starts the next one early, even if no time passed
+        for x in range(5, 105):
+            recent.add(x)
+        self.assertLessEqual(len(recent), 6)
+        self.assertIn(104, recent)
+        recent.discard(104)
+        self.assertNotIn(104, recent)
+
+        # proxied originals are deleted right away, and never get as far as the filter
+        chan = g["main"]
+        self.assertVote(alpha, chan, "gs;m new ignored")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p ignored tags ignored:text")
+        instance.stats.clear()
+        msg = self.assertProxied(alpha, chan, "ignored:hello")
+        self.assertEqual(instance.stats["history filter skips"], 0)
+        self.assertNotIn(msg.id, instance.ignore_delete_cache)
+        self.assertCommand(alpha, chan, "gs;m ignored leave")
+
+    def test_55_last_message_cache(self):
+        (old, (gestalt.LAST_MESSAGE_CACHE_SIZE, gestalt.LAST_MESSAGE_CACHE_MAX)) = (
+            (gestalt.LAST_MESSAGE_CACHE_SIZE, gestalt.LAST_MESSAGE_CACHE_MAX),
+            (2, 3),
+        )
+        (first, second) = (g._add_channel("lastfirst"), g._add_channel("lastsecond"))
+        self.assertVote(alpha, first, "gs;m new cached")
+        interact(first[-1], alpha, "no")
+        self.assertCommand(alpha, first, "gs;p cached tags cached:text")
+        cache = instance.shard_cache(g).last_message
+        msgs = [self.assertProxied(alpha, first, "cached:%i" % i) for i in range(3)]
+        self.assertEqual(list(cache[first.id]), [msg.id for msg in msgs[1:]])
+        last = cache.last(first)
+        self.assertEqual(
+            (last.nick, last.proxid),
+            (msgs[-1].author.name, self.get_proxid(alpha, name="cached")),
+        )
+
+        # the least recently used channel goes first
+        self.assertProxied(alpha, second, "cached:a")
+        self.assertProxied(alpha, second, "cached:b")
+        self.assertNotIn(first.id, cache)
+        self.assertEqual(cache.size, 2)
+        self.assertIsNone(cache.last(first))
+        self.assertNotIn(first.id, cache)
+        run(second[-1].delete())
+        run(second[-1].delete())
+        self.assertEqual((cache.size, len(cache)), (0, 0))
+        (gestalt.LAST_MESSAGE_CACHE_SIZE, gestalt.LAST_MESSAGE_CACHE_MAX) = old
+        self.assertCommand(alpha, first, "gs;m cached leave")
+
+    def test_56_proxy_record(self):
+        chan = g["main"]
+        self.assertVote(alpha, chan, "gs;m new recorded")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p recorded tags recorded:text")
+        (match, stripped, tags) = instance.get_proxy_match(
+            Message(
+                author=g.get_member(alpha.id),
+                channel=chan,
+                guild=g,
+                content="recorded:hi",
+            )
+        )
+        self.assertIsInstance(match, gestalt.Gestalt.ProxyRecord)
+        self.assertEqual((stripped, tags), ("hi", True))
+        self.assertEqual(match["proxid"], match.proxid)
+        self.assertEqual(match.proxid, self.get_proxid(alpha, name="recorded"))
+        self.assertEqual((match.type, match.guildid), (gestalt.ProxyType.mask, g.id))
+        self.assertEqual(match.ap, instance.get_autoproxy(g.get_member(alpha.id))["ap"])
+        self.assertCommand(alpha, chan, "gs;m recorded leave")
+
+    def test_57_sequencer(self):
+        chan = g._add_channel("sequenced")
+        self.assertVote(alpha, chan, "gs;m new sequenced")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p sequenced tags sequenced:text")
+        target = send(beta, chan, "reply to me")
+
+        # the first one takes longer to get ready, but still goes out first
+        async def slow_fetch(msgid):
+            # (asyncio.sleep is still patched from test_40)
+            later = instance.loop.create_future()
+            instance.loop.call_later(0.05, later.set_result, None)
+            await later
+            return await Channel.fetch_message(chan, msgid)
+
+        chan.fetch_message = slow_fetch
+        # and attachments are downloaded without waiting for it
+        attach = Attachment(b"sequenced file")
+        downloaded = []
+
+        async def watched_download(spoiler):
+            downloaded.append([msg.content for msg in chan if msg.webhook_id])
+            return attach
+
+        attach.to_file = watched_download
+        msgs = [
+            Message(
+                author=alpha,
+                content="sequenced:%s" % content,
+                reference=reference,
+                attachments=attachments,
+            )
+            for content, reference, attachments in (
+                ("slow", MessageReference(target, False), []),
+                ("fast", None, [attach]),
+                ("faster", None, []),
+            )
+        ]
+
+        async def send_all():
+            await asyncio.gather(*map(chan._add, msgs))
+
+        run(send_all())
+        del chan.fetch_message
+        self.assertTrue(all(msg._deleted for msg in msgs))
+        self.assertEqual([msg.content for msg in chan[-3:]], ["slow", "fast", "faster"])
+        self.assertEqual(downloaded, [[]])
+        self.assertEqual(chan[-2].files, [attach])
+        self.assertEqual(instance.sequencer.last, {})
+
+        # nothing is held up by a message that didn't get proxied
+        async def unproxied():
+            turn = instance.sequencer.turn(chan.id)
+            later = instance.sequencer.turn(chan.id)
+            turn.done()
+            await later.wait()
+            later.done()
+
+        run(unproxied())
+        self.assertEqual(instance.sequencer.last, {})
+        self.assertCommand(alpha, chan, "gs;m sequenced leave")
+
+    def test_58_scheduler(self):
+        (old, (gestalt.REST_CONCURRENCY, gestalt.REST_BACKLOG)) = (
+            (gestalt.REST_CONCURRENCY, gestalt.REST_BACKLOG),
+            ([None, 1, 1], 1),
+        )
+        scheduler = gestalt.Gestalt.Scheduler(Counter())
+        done = []
+
+        async def call(name, gate=None):
+            if gate:
+                await gate
+            done.append(name)
+            return name
+
+        # (asyncio.sleep is still patched from test_40)
+        async def tick():
+            later = instance.loop.create_future()
+            instance.loop.call_soon(later.set_result, None)
+            await later
+
+        async def busy():
+            gates = [instance.loop.create_future() for _ in range(2)]
+            tasks = [
+                instance.loop.create_task(scheduler.run(priority, call(name, gate)))
+                for priority, name, gate in (
+                    (2, "stuck", gates[0]),
+                    (2, "cosmetic", None),
+                    (1, "normal", gates[1]),
+                    (1, "next", None),
+                )
+            ]
+            await tick()
+            # too much waiting already; this one isn't worth it
+            self.assertIs(await scheduler.run(2, call("dropped")), False)
+            # and none of that holds up anything critical, nor does more of it
+            gates.append(instance.loop.create_future())
+            tasks.append(
+                instance.loop.create_task(scheduler.run(0, call("slow", gates[-1])))
+            )
+            self.assertEqual(await scheduler.run(0, call("critical")), "critical")
+            for gate in gates:
+                gate.set_result(None)
+                await tick()
+            return await asyncio.gather(*tasks)
+
+        self.assertEqual(run(busy()), ["stuck", "cosmetic", "normal", "next", "slow"])
+        (gestalt.REST_CONCURRENCY, gestalt.REST_BACKLOG) = old
+        self.assertEqual(
+            done, ["critical", "stuck", "cosmetic", "normal", "next", "slow"]
+        )
+        self.assertEqual(scheduler.stats["rest calls dropped"], 1)
+        self.assertEqual(scheduler.slots, [None, 1, 1])
+        self.assertFalse(any(scheduler.waiting))
+
+        # 429s are counted per route, and hold off cosmetic calls there for a bit
+        self.assertIn(
+            instance.scheduler.on_log, logging.getLogger("discord.http").filters
+        )
+        instance.scheduler.on_log(
+            logging.makeLogRecord(
+                {
+                    "msg": "We are being rate limited. %s %s responded with 429. "
+                    "Retrying in %.2f seconds.",
+                    "args": (
+                        "PUT",
+                        "https://discord.com/api/v10/channels/%i/messages/%i"
+                        "/reactions/%%E2%%9C%%85/@me" % (g["main"].id, g["main"].id),
+                        60,
+                    ),
+                }
+            )
+        )
+        self.assertEqual(
+            instance.stats["429 PUT /channels/:id/messages/:id/reactions/:emoji/@me"],
+            1,
+        )
+        msg = send(alpha, g["main"], "gs;p test-alpha rename test-alpha")
+        self.assertEqual(msg.reactions[gestalt.REACT_CONFIRM], set())
+        elsewhere = g._add_channel("elsewhere")
+        self.assertCommand(alpha, elsewhere, "gs;p test-alpha rename test-alpha")
+        # unless it's global
+        instance.scheduler.on_log(
+            logging.makeLogRecord(
+                {
+                    "msg": "Global rate limit has been hit. Retrying in %.2f seconds.",
+                    "args": (60,),
+                }
+            )
+        )
+        msg = send(alpha, elsewhere, "gs;p test-alpha rename test-alpha")
+        self.assertEqual(msg.reactions[gestalt.REACT_CONFIRM], set())
+        self.assertEqual(instance.stats["429 global"], 1)
+        instance.scheduler.backoff.clear()
+        # webhooks log theirs differently, and are what matters most
+        logger = logging.getLogger("discord.webhook.async_")
+        self.assertIn(instance.scheduler.on_log, logger.filters)
+        logger.filter(
+            logging.makeLogRecord(
+                {
+                    "msg": "Webhook ID %s is rate limited. Retrying in %.2f seconds.",
+                    "args": (g["main"].id, 60),
+                }
+            )
+        )
+        self.assertEqual(instance.stats["429 webhook"], 1)
+        self.assertEqual(list(instance.scheduler.backoff), [g["main"].id])
+        instance.scheduler.backoff.clear()
+        self.assertCommand(alpha, g["main"], "gs;p test-alpha rename test-alpha")
+
+    def test_59_bulk_delete(self):
+        chan = g._add_channel("bulk")
+        self.assertVote(alpha, chan, "gs;m new bulk")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p bulk tags bulk:text")
+        instance.stats.clear()
+
+        # the rest pile up while the first one is being deleted
+        msgs = [
+            Message(author=alpha, content="bulk:%i" % i, attachments=[])
+            for i in range(4)
+        ]
+        gate = instance.loop.create_future()
+
+        async def slow_delete(delay=None):
+            await gate
+            await Message.delete(msgs[0])
+
+        msgs[0].delete = slow_delete
+
+        async def send_all():
+            await chan._add(msgs[0])
+            await asyncio.gather(*(chan._add(msg) for msg in msgs[1:]))
+            # the proxies don't wait around for the deletes
+            self.assertFalse(gate.done())
+            self.assertIn(chan.id, instance.delete_tasks)
+            instance.loop.call_later(0.05, gate.set_result, None)
+
+        run(send_all())
+        self.assertTrue(all(msg._deleted for msg in msgs))
+        self.assertEqual([msg.content for msg in chan[-4:]], ["0", "1", "2", "3"])
+        self.assertEqual(instance.stats["bulk deletes"], 1)
+        self.assertEqual(instance.delete_queues, {})
+        self.assertEqual(instance.delete_tasks, {})
+
+        # too old for bulk deletes
+        old = [send(beta, chan, "old %i" % i) for i in range(3)]
+        warptime.warp += int(timedelta(days=15).total_seconds())
+        run(instance.delete_batch(chan, old))
+        self.assertTrue(all(msg._deleted for msg in old))
+        self.assertEqual(instance.stats["bulk deletes"], 1)
+        self.assertCommand(alpha, chan, "gs;m bulk leave")
+
+    def test_60_in_progress(self):
+        msg = send(alpha, g["main"], "working on it")
+        (old, gestalt.PROGRESS_DELAY) = (gestalt.PROGRESS_DELAY, 0.05)
+
+        async def work(duration):
+            async with instance.in_progress(msg):
+                later = instance.loop.create_future()
+                instance.loop.call_later(duration, later.set_result, None)
+                await later
+                return instance.user.id in msg.reactions[gestalt.REACT_WAIT]
+
+        # nothing for a quick one
+        self.assertFalse(run(work(0)))
+        self.assertFalse(msg.reactions[gestalt.REACT_WAIT])
+        # a slow one gets it for as long as it takes
+        self.assertTrue(run(work(0.1)))
+        self.assertFalse(msg.reactions[gestalt.REACT_WAIT])
+        gestalt.PROGRESS_DELAY = old
+
+    def test_61_lazy_pages(self):
+        built = []
+
+        def lines():
+            for i in range(100):
+                built.append(i)
+                yield str(i)
+
+        pages = instance.Pages(
+            discord.Embed(title="numbers"), lines(), lines, 0, ("", "")
+        )
+        # the first page, plus one more to know whether there is one
+        (index, page) = pages.make_page(0)
+        self.assertEqual(page.title, "[1/?] numbers")
+        self.assertEqual(page.description.split("\n"), list(map(str, range(25))))
+        self.assertLess(len(built), 75)
+
+        gestalt.PAGES_CACHED = 2
+        try:
+            (index, page) = pages.make_page(-1)
+            self.assertEqual((index, page.title), (3, "[4/4] numbers"))
+            self.assertEqual(page.description.split("\n")[0], "75")
+            self.assertEqual(len(built), 100)
+            self.assertEqual(list(pages.cache), [2, 3])
+
+            # let go of, so it has to start over
+            built.clear()
+            (index, page) = pages.make_page(0)
+            self.assertEqual(page.title, "[1/?] numbers")
+            self.assertEqual(page.description.split("\n")[0], "0")
+            self.assertTrue(built)
+            self.assertEqual(list(pages.cache), [1, 0])
+            # too few to build ahead is the same as enough
+            gestalt.PAGES_CACHED = 1
+            self.assertEqual(pages.make_page(2)[1].title, "[3/?] numbers")
+        finally:
+            gestalt.PAGES_CACHED = 4
+        # out of range, e.g. from a stale button
+        self.assertEqual(pages.make_page(10)[0], 3)
+
+        # lists from the database are read a few rows at a time, in the same order
+        chan = g["main"]
+        for name in ("listed1", "listed2"):
+            self.assertVote(alpha, chan, f"gs;m new {name}")
+            interact(chan[-1], alpha, "no")
+        proxies = list(instance.proxy_lines(alpha, g, True))
+        self.assertGreaterEqual(len(proxies), 3)
+        gestalt.commands.PAGES_ROWS = 1
+        try:
+            self.assertEqual(list(instance.proxy_lines(alpha, g, True)), proxies)
+        finally:
+            gestalt.commands.PAGES_ROWS = gestalt.PAGES_ROWS
+        for name in ("listed1", "listed2"):
+            self.assertCommand(alpha, chan, f"gs;m {name} leave")
+
+        # long lines split early; sizes are tracked as it goes
+        self.assertEqual(
+            list(map(len, instance.Pages.paginate(["x" * 1000] * 5))),
+            [2001, 2001, 1000],
+        )
+        self.assertEqual(list(instance.Pages.paginate([])), [""])
+
+        # buttons for a list that can't be made anymore still get an answer
+        msg = send(alpha, chan, "pages from long ago")
+        interaction = Interaction(msg, alpha, "pages:%i:gone::1:next" % alpha.id)
+        run(instance.Pages.on_interaction(instance, interaction))
+        self.assertEqual(
+            interaction.sent["embed"].description, "This list has expired."
+        )
+        self.assertTrue(interaction.sent["ephemeral"])
+
+    def test_62_expiry(self):
+        expiry = instance.Expiry()
+        fired = []
+        callback = lambda key: lambda: fired.append(key)
+        for key, when in (("b", 20), ("a", 10), ("c", 30)):
+            expiry.add(key, when, callback(key))
+        expiry.add("c", 15, callback("c"))  # replaces the old deadline
+        expiry.cancel("b")
+        self.assertEqual(len(expiry), 2)
+        self.assertEqual(expiry.delay(5), 5)
+        for f in expiry.pop_due(25):
+            f()
+        self.assertEqual(fired, ["a", "c"])
+        self.assertEqual(expiry.pop_due(100), [])
+        self.assertEqual(len(expiry), 0)
+        # cancelled entries don't pile up in the heap
+        for i in range(1000):
+            expiry.add(i, 50 + i, None)
+            expiry.cancel(i)
+        self.assertLess(len(expiry.heap), 100)
+
+        # the loop wakes up for new deadlines, not just on its timer
+        (expiry, instance.expiry) = (instance.expiry, instance.Expiry())
+        task = instance.loop.create_task(instance.expiry_loop())
+        try:
+            done = instance.loop.create_future()
+
+            async def fire():
+                done.set_result(True)
+
+            instance.expiry.add("now", warptime.now().timestamp() - 1, fire)
+            self.assertTrue(run(asyncio.wait_for(done, 1)))
+        finally:
+            task.cancel()
+            instance.expiry = expiry
+
+        # deleting the message drops its deadline
+        self.assertVote(alpha, g["main"], "gs;m new expiring")
+        msgid = g["main"][-1].id
+        self.assertIn(msgid, instance.expiry.due)
+        run(g["main"][-1].delete())
+        self.assertNotIn(msgid, instance.expiry.due)
+
+    def test_63_commands(self):
+        chan = g["main"]
+        stats = instance.stats
+        queries = []
+        instance.conn.set_trace_callback(queries.append)
+        try:
+            # unknown actions are turned away before anything is looked up
+            unknown = stats["command unknown"]
+            send(alpha, chan, "gs;m nonexistent frobnicate")
+            send(alpha, chan, "gs;p nonexistent frobnicate")
+            self.assertFalse(any("masks" in q or "proxies" in q for q in queries))
+            self.assertEqual(stats["command unknown"], unknown + 2)
+            # (but not quietly, unless it isn't a command at all)
+            send(alpha, chan, "gs;frobnicate")
+            self.assertEqual(stats["command unknown"], unknown + 2)
+            # and so are failed guards
+            errors = stats["command mask invite errors"]
+            send(alpha, alpha.dm_channel, "gs;m nonexistent invite")
+            self.assertEqual(stats["command mask invite errors"], errors + 1)
+            self.assertFalse(any("masks" in q or "proxies" in q for q in queries))
+            # but not when they pass
+            send(alpha, chan, "gs;m nonexistent invite")
+            self.assertEqual(stats["command mask invite errors"], errors + 2)
+            self.assertTrue(any("masks" in q for q in queries))
+        finally:
+            instance.conn.set_trace_callback(None)
+
+        # aliases and captured words
+        reader = gestalt.commands.CommandReader(
+            Message(content="P e: Autoadd off"), None
+        )
+        (command, raw) = gestalt.commands.COMMAND_TREE.find(reader)
+        self.assertEqual((command.name, raw), ("proxy flag", ["e:", "autoadd", 0]))
+        reader = gestalt.commands.CommandReader(Message(content="a config"), None)
+        self.assertEqual(
+            gestalt.commands.COMMAND_TREE.find(reader)[0].name, "config list"
+        )
+        reader = gestalt.commands.CommandReader(Message(content="a config nope"), None)
+        self.assertEqual(
+            gestalt.commands.COMMAND_TREE.find(reader)[0].name, "config unknown"
+        )
+        reader = gestalt.commands.CommandReader(Message(content="mode"), None)
+        self.assertIsNone(gestalt.commands.COMMAND_TREE.find(reader))
+        reader = gestalt.commands.CommandReader(Message(content="p me frob"), None)
+        self.assertEqual(gestalt.commands.COMMAND_TREE.find(reader), (None, ("user",)))
+        reader = gestalt.commands.CommandReader(Message(content="log frob"), None)
+        self.assertEqual(
+            gestalt.commands.COMMAND_TREE.find(reader),
+            (None, ("guild", "administrator")),
+        )
+
+        # some errors are particular to their command
+        self.assertVote(alpha, chan, "gs;m new particular")
+        interact(chan[-1], alpha, "no")
+        maskid = instance.fetchone(
+            "select maskid from masks where nick = ?", ("particular",)
+        )[0]
+        reader = gestalt.commands.CommandReader(
+            Message(
+                author=g.get_member(beta.id),
+                channel=chan,
+                guild=g,
+                content="m %s leave" % maskid,
+            )
+        )
+        user = instance.fetchone("select * from users where userid = ?", (beta.id,))
+        with self.assertRaisesRegex(gestalt.UserError, "can do that\\?"):
+            run(
+                instance.do_command(
+                    reader, gestalt.commands.COMMAND_TREE.find(reader), user
+                )
+            )
+        self.assertCommand(alpha, chan, "gs;m particular leave")
+
+        # unknown actions only get that far if the command would've been allowed
+        for guild, author, error in (
+            (None, beta, "in a server"),
+            (g, Member(beta, g, discord.Permissions.none()), "Manage Server"),
+            (g, g.get_member(beta.id), "Unknown action"),
+        ):
+            reader = gestalt.commands.CommandReader(
+                Message(author=author, channel=chan, guild=guild, content="log frob")
+            )
+            with self.assertRaisesRegex(gestalt.UserError, error):
+                run(
+                    instance.do_command(
+                        reader, gestalt.commands.COMMAND_TREE.find(reader), user
+                    )
+                )
+
+        # everything is counted
+        before = Counter(stats)
+        send(alpha, chan, "gs;help")
+        send(alpha, chan, "gs;a config nope")
+        self.assertEqual(stats["command help"], before["command help"] + 1)
+        self.assertEqual(stats["command help errors"], before["command help errors"])
+        self.assertGreater(
+            stats["command help seconds"], before["command help seconds"]
+        )
+        self.assertEqual(
+            stats["command config unknown errors"],
+            before["command config unknown errors"] + 1,
+        )
+        # not just the ones meant for the user
+        instance.cmd_invite = lambda message: 1 / 0
+        try:
+            with self.assertRaises(ZeroDivisionError):
+                send(alpha, chan, "gs;invite")
+        finally:
+            del instance.cmd_invite
+        self.assertEqual(
+            stats["command invite errors"], before["command invite errors"] + 1
+        )
+
+    def test_64_reader(self):
+        reader = lambda text: gestalt.commands.CommandReader(Message(content=text))
+
+        r = reader('GS;p  "my proxy"  tags [text] ')
+        self.assertTrue(r.read_token("gs;"))
+        self.assertFalse(r.read_token("-all"))
+        self.assertEqual(r.read_word(), "p")
+        self.assertEqual(r.read_quote(), "my proxy")
+        self.assertEqual(r.cmd, "tags [text]")
+        self.assertEqual(r.read_word(), "tags")
+        self.assertEqual(r.read_remainder(), "[text]")
+        self.assertTrue(r.is_empty())
+        self.assertEqual(r.read_word(), "")
+
+        # quotes only count if the rest is on the same line
+        r = reader('"a" b\nc')
+        self.assertIsNone(r.try_read_quote())
+        self.assertEqual(r.read_quote(), '"a"')
+        self.assertEqual(r.read_remainder(), "b\nc")
+        r = reader("\N{LEFT DOUBLE QUOTATION MARK}a b\N{RIGHT DOUBLE QUOTATION MARK}c ")
+        self.assertEqual(r.read_quote(), "a b")
+        self.assertEqual(r.read_word(), "c")
+
+        r = reader("https://example.com/a.png. and\u3000more  ")
+        self.assertEqual(r.read_link(), "https://example.com/a.png")
+        self.assertEqual(r.read_word(), ".")
+        self.assertEqual(r.read_word(), "and")
+        self.assertEqual(r.cmd, "more")
+        self.assertEqual(r.read_clear(), None)
+
+        r = reader("-clear\n\n  -CLEARX")
+        self.assertEqual(r.read_clear(), gestalt.CLEAR)
+        self.assertEqual(r.read_clear(), gestalt.CLEAR)
+        self.assertEqual(r.read_raw(), "X")
+
+        # lookahead
+        r = reader("one two")
+        state = r.tell()
+        r.read_word()
+        r.seek(state)
+        self.assertEqual(r.read_word(), "one")
+        r.cmd = "three"
+        self.assertEqual(r.read_word(), "three")
+
+    def test_65_throttle(self):
+        now = [0]
+        throttle = instance.Throttle(1, 3, 10, clock=lambda: now[0])
+        for _ in range(3):
+            self.assertEqual(throttle.wait("a"), 0)
+            throttle.take("a")
+        self.assertEqual(throttle.wait("a"), 1)
+        self.assertEqual(throttle.wait("b"), 0)
+        now[0] += 0.5
+        self.assertEqual(throttle.wait("a"), 0.5)
+        # queued, so whoever's next waits behind it
+        throttle.take("a")
+        self.assertEqual(throttle.wait("a"), 1.5)
+        # refilled buckets are forgotten
+        now[0] += 100
+        throttle.prune()
+        self.assertEqual(len(throttle), 0)
+        self.assertEqual(throttle.wait("a"), 0)
+        # and there's only ever so many
+        for i in range(25):
+            throttle.take(i)
+        self.assertLessEqual(len(throttle), 10)
+
+        chan = g["main"]
+        self.assertVote(alpha, chan, "gs;m new throttled")
+        interact(chan[-1], alpha, "no")
+        self.assertCommand(alpha, chan, "gs;p throttled tags throttled:text")
+
+        # time stands still, so tokens never come back
+        make = lambda rate, burst: instance.Throttle(rate, burst, 100, clock=lambda: 0)
+        (old, instance.throttles) = (
+            instance.throttles,
+            {
+                ("command", "user"): make(0.001, 2),
+                ("command", "guild"): make(0.001, 3),
+                ("heavy", "user"): make(0.001, 1),
+                ("heavy", "guild"): make(1000, 1000),
+                ("proxy", "user"): make(0.001, 1),
+                ("proxy", "guild"): make(1000, 1000),
+            },
+        )
+        stats = instance.stats
+        queries = []
+        instance.conn.set_trace_callback(queries.append)
+        try:
+            before = stats["command help"]
+            for _ in range(3):
+                send(alpha, chan, "gs;help")
+            self.assertEqual(stats["command help"], before + 2)
+            self.assertEqual(stats["throttled command by user"], 1)
+            # turned away before the db, aside from checking whether to say so
+            queries.clear()
+            send(alpha, chan, "gs;help")
+            self.assertEqual(queries, [])
+            self.assertEqual(stats["throttled command by user"], 2)
+
+            # one member can use up the guild, but not anyone's dms
+            send(beta, chan, "gs;help")
+            send(beta, chan, "gs;help")
+            self.assertEqual(stats["throttled command by guild"], 1)
+            send(gamma, gamma.dm_channel, "gs;help")
+            self.assertEqual(stats["command help"], before + 4)
+
+            # heavy commands have their own buckets
+            self.assertEqual(
+                instance.throttle_kind(
+                    instance.read_command(Message(author=gamma, content="gs;p list"))[1]
+                ),
+                "heavy",
+            )
+            send(gamma, gamma.dm_channel, "gs;permcheck")
+            send(gamma, gamma.dm_channel, "gs;permcheck")
+            self.assertEqual(stats["throttled heavy by user"], 1)
+
+            # short waits are queued instead
+            instance.throttles["command", "user"] = make(1, 1)
+            send(gamma, gamma.dm_channel, "gs;help")
+            send(gamma, gamma.dm_channel, "gs;help")
+            self.assertEqual(stats["throttle queued command"], 1)
+            self.assertEqual(stats["command help"], before + 6)
+
+            # proxies are only charged when they are proxies
+            self.assertNotProxied(alpha, chan, "not a proxy")
+            self.assertProxied(alpha, chan, "throttled:first")
+            # and turned away without looking like they're still on the way
+            msg = self.assertNotProxied(alpha, chan, "throttled:second")
+            self.assertEqual(stats["throttled proxy by user"], 1)
+            self.assertEqual(set(msg.reactions), {gestalt.REACT_THROTTLED})
+        finally:
+            instance.conn.set_trace_callback(None)
+            instance.throttles = old
+            instance.throttle_warned.clear()
+        self.assertCommand(alpha, chan, "gs;m throttled leave")
 
 
 def main():